@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+KAMBIOS - benchmarks
+Crea carpetas de prueba (en tmpfs y en disco) con nombres parecidos a los de verdad (ROMs, fotos,
+subtítulos) y mide cada fase: listar, los tres planes de la vista previa, aplicar (y, dentro, guardar
+el deshacer) y deshacer. De cada fase saca el tiempo, archivos por segundo, el pico de memoria (RSS) y cuántas
+llamadas al sistema hizo (con kambiosMetrics, igual que --metrics en la CLI).
+
+Los resultados se pueden guardar en JSON y usar como referencia: con --baseline se compara contra
+ella y sale con código 1 si algo empeora más de la cuenta (para pillarlo antes de que llegue a las
+carpetas de verdad).
+
+    python kambiosBench.py --sizes 1000 10000 100000 --save bench.json
+    python kambiosBench.py --sizes 1000 10000 100000 --baseline bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import kambiosCore as core
+import kambiosMetrics as metrics
+
+
+BENCH_FORMAT = "kambios_bench"
+DEFAULT_SIZES = (1000, 10000, 100000)
+TMPFS_DIR = "/dev/shm"
+
+# Cuánto puede empeorar cada medida respecto a la referencia (1.25 = un 25% más) y un mínimo absoluto,
+# para que el ruido en los casos pequeños (milisegundos, un par de megas) no cuente como empeorar.
+THRESHOLDS = {"seconds": 1.25, "peak_rss_mb": 1.25, "syscalls": 1.10}
+MIN_SLACK = {"seconds": 0.05, "peak_rss_mb": 8, "syscalls": 50}
+
+PHASES = ("scan", "number_plan", "full_replace_plan", "part_replace_plan", "apply", "history", "undo")
+
+
+# --- Nombres de prueba ---
+
+ROM_WORDS = ("Super", "Mario", "Zelda", "Legend", "Kart", "World", "Metroid", "Castlevania", "Final", "Fantasy",
+             "Mega", "Man", "Sonic", "Street", "Fighter", "Contra", "Kirby", "Dream", "Land", "Adventure",
+             "Tetris", "Donkey", "Kong", "Country", "Star", "Fox", "Pokemon", "Red", "Blue", "Gold")
+ROM_REGIONS = ("(USA)", "(Europe)", "(Japan)", "(USA, Europe)", "(World)", "(Spain)")
+ROM_EXTRAS = ("", "", "", " (Rev 1)", " (Rev 2)", " [!]", " (En,Fr,De)", " (Beta)")
+ROM_EXTS = (".nes", ".sfc", ".gba", ".gb", ".md", ".zip", ".7z")
+PHOTO_EXTS = (".jpg", ".JPG", ".heic", ".png")
+SHOW_WORDS = ("The", "Office", "Dark", "Lost", "Chernobyl", "Fargo", "Succession", "Severance", "Andor", "Narcos")
+SUB_LANGS = ("en", "es", "fr", "pt-BR")
+
+
+def rom_name(rng):
+    title = " ".join(rng.choice(ROM_WORDS) for _ in range(rng.randint(1, 4)))
+    return f"{title} {rng.choice(ROM_REGIONS)}{rng.choice(ROM_EXTRAS)}{rng.choice(ROM_EXTS)}"
+
+
+def photo_name(rng):
+    kind = rng.random()
+    if kind < 0.5:
+        return (f"IMG_{rng.randint(2010, 2026)}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}_"
+                f"{rng.randint(0, 23):02d}{rng.randint(0, 59):02d}{rng.randint(0, 59):02d}{rng.choice(PHOTO_EXTS)}")
+    if kind < 0.8:
+        return f"DSC{rng.randint(0, 99999):05d}{rng.choice(PHOTO_EXTS)}"
+    return f"PXL_{rng.randint(20200101, 20261231)}_{rng.randint(0, 235959999):09d}.jpg"
+
+
+def subtitle_names(rng):
+    # Un capítulo con su vídeo y sus subtítulos, como salen de una descarga.
+    show = ".".join(rng.choice(SHOW_WORDS) for _ in range(rng.randint(1, 3)))
+    stem = f"{show}.S{rng.randint(1, 9):02d}E{rng.randint(1, 24):02d}.1080p.WEB-DL.x264-GRP"
+    names = [stem + ".mkv"]
+    names += [f"{stem}.{lang}.srt" for lang in rng.sample(SUB_LANGS, rng.randint(1, 3))]
+    if rng.random() < 0.3:
+        names.append(stem + ".ass")
+    return names
+
+
+def synthetic_names(count, seed=0):
+    """
+    count nombres distintos: mitad ROMs, un tercio fotos y el resto capítulos con subtítulos.
+    Siempre los mismos para la misma semilla, para que las comparaciones sean justas.
+    """
+    rng = random.Random(seed)
+    names = []
+    taken = set()
+    while len(names) < count:
+        kind = rng.random()
+        if kind < 0.5:
+            batch = [rom_name(rng)]
+        elif kind < 0.85:
+            batch = [photo_name(rng)]
+        else:
+            batch = subtitle_names(rng)
+        for name in batch:
+            if name in taken:
+                stem, ext = os.path.splitext(name)
+                name = f"{stem} ({len(names)}){ext}"
+            taken.add(name)
+            names.append(name)
+    return names[:count]
+
+
+def make_folder(parent, count, seed=0):
+    # Archivos vacíos: lo que se mide es el trabajo con nombres y metadatos, no el contenido.
+    folder = tempfile.mkdtemp(prefix=f"kambios_bench_{count}_", dir=parent)
+    for name in synthetic_names(count, seed):
+        os.close(os.open(os.path.join(folder, name), os.O_CREAT | os.O_WRONLY, 0o644))
+    return folder
+
+
+# --- Medidas ---
+
+def measure(recorder, name, files, func):
+    """
+    Ejecuta func() como una fase de primer nivel y devuelve (resultado, medidas de la fase).
+    Las fases que marca el motor por dentro ("apply/rename"...) quedan en recorder.phases.
+    """
+    with recorder.phase(name, files):
+        result = func()
+    return result, recorder.phases[-1]
+
+
+def run_case(fs, parent, count, seed=0):
+    """
+    Un caso completo (una carpeta de count archivos en parent). Va en su propio proceso para que
+    la memoria de un caso no se mezcle con la del anterior.
+    """
+    folder = make_folder(parent, count, seed)
+    recorder = metrics.start(f"bench {fs}/{count}", reset_peak=True)
+    phases = {}
+    try:
+        snapshot, phases["scan"] = measure(recorder, "scan", count, lambda: core.scan_folder(folder))
+        files = snapshot.names
+        changes, phases["number_plan"] = measure(recorder, "number_plan", count,
+                                                 lambda: core.number_plan(files, "Bench"))
+        _, phases["full_replace_plan"] = measure(recorder, "full_replace_plan", count,
+                                                 lambda: core.full_replace_plan(files, "Bench"))
+        _, phases["part_replace_plan"] = measure(recorder, "part_replace_plan", count,
+                                                 lambda: core.part_replace_plan(files, " (USA)", ""))
+        # Se aplica la numeración, que renombra todos los archivos, y se deshace: la carpeta queda como estaba.
+        _, phases["apply"] = measure(recorder, "apply", count,
+                                     lambda: core.apply_plan(folder, changes, "kambios_bench"))
+        # apply_plan ya guarda el deshacer en el historial; esa escritura se mide dentro ("apply/history")
+        # y se saca como fase propia para que también se compare con la referencia.
+        phases["history"] = next(record for record in recorder.phases if record["phase"] == "apply/history")
+        _, phases["undo"] = measure(recorder, "undo", count, lambda: core.undo_operation(folder))
+    finally:
+        metrics.stop(recorder)
+        shutil.rmtree(folder, ignore_errors=True)
+    # Lo de dentro de cada fase ("apply/check", "apply/rename"...) va aparte: sirve para mirar, no se compara.
+    detail = [record for record in recorder.phases if "/" in record["phase"]]
+    return {"fs": fs, "files": count, "phases": phases, "detail": detail}
+
+
+# --- Referencias ---
+
+def case_key(case):
+    return f"{case['fs']}/{case['files']}"
+
+
+def compare(results, baseline):
+    """
+    Devuelve los empeoramientos respecto a la referencia: [(caso, fase, medida, antes, ahora), ...].
+    La referencia puede traer sus propios "thresholds" y "min_slack" (si no, los de arriba).
+    Solo se comparan los casos y fases que están en las dos.
+    """
+    thresholds = dict(THRESHOLDS, **baseline.get("thresholds", {}))
+    slack = dict(MIN_SLACK, **baseline.get("min_slack", {}))
+    before = {case_key(case): case for case in baseline["results"]}
+    regressions = []
+    for case in results["results"]:
+        old_case = before.get(case_key(case))
+        if old_case is None:
+            continue
+        for phase, now in case["phases"].items():
+            old = old_case["phases"].get(phase)
+            if old is None:
+                continue
+            for metric, factor in thresholds.items():
+                if old.get(metric) is None or now.get(metric) is None:
+                    continue
+                if now[metric] > old[metric] * factor and now[metric] - old[metric] > slack.get(metric, 0):
+                    regressions.append((case_key(case), phase, metric, old[metric], now[metric]))
+    return regressions
+
+
+def print_results(results, out=None):
+    out = out or sys.stdout
+    print(f"{'caso':<16} {'fase':<18} {'segundos':>10} {'arch/s':>12} {'RSS MB':>8} {'syscalls':>10}", file=out)
+    print("-" * 78, file=out)
+    for case in results["results"]:
+        for phase in PHASES:
+            m = case["phases"].get(phase)
+            if m is None:
+                continue
+            print(f"{case_key(case):<16} {phase:<18} {m['seconds']:>10.3f} {m['per_second'] or 0:>12,} "
+                  f"{m['peak_rss_mb'] or 0:>8.1f} {m['syscalls']:>10,}", file=out)
+        print(file=out)
+
+
+def locations(kinds, disk_dir):
+    # tmpfs mide el coste del propio Kambios; el disco, lo que se nota de verdad (journal, fsync...).
+    places = []
+    for kind in kinds:
+        if kind == "tmpfs":
+            if os.path.isdir(TMPFS_DIR):
+                places.append(("tmpfs", TMPFS_DIR))
+            else:
+                print(f"⚠️  No hay {TMPFS_DIR}: se salta tmpfs.", file=sys.stderr)
+        else:
+            places.append(("disk", disk_dir or tempfile.gettempdir()))
+    return places
+
+
+def run_bench(sizes, kinds, disk_dir=None, seed=0):
+    results = {
+        "format": BENCH_FORMAT,
+        "version": 1,
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [],
+    }
+    # spawn y un proceso nuevo por caso: cada uno empieza con la memoria limpia.
+    context = multiprocessing.get_context("spawn")
+    for fs, parent in locations(kinds, disk_dir):
+        for count in sizes:
+            print(f"⏱️  {fs}: {count:,} archivos...", file=sys.stderr)
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                results["results"].append(pool.submit(run_case, fs, parent, count, seed).result())
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="kambiosBench.py",
+                                     description="Benchmarks de Kambios con carpetas de prueba.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES), metavar="N",
+                        help="Archivos por carpeta de prueba (por defecto: 1000 10000 100000).")
+    parser.add_argument("--fs", nargs="+", choices=("tmpfs", "disk"), default=["tmpfs", "disk"],
+                        help="Dónde crear las carpetas de prueba.")
+    parser.add_argument("--disk-dir", help="Carpeta en disco donde crearlas (por defecto, la temporal del sistema).")
+    parser.add_argument("--seed", type=int, default=0, help="Semilla de los nombres de prueba.")
+    parser.add_argument("--save", metavar="JSON", help="Guarda los resultados (sirven como referencia).")
+    parser.add_argument("--baseline", metavar="JSON",
+                        help="Compara con una referencia; sale con código 1 si algo empeora.")
+    args = parser.parse_args(argv)
+
+    results = run_bench(args.sizes, args.fs, args.disk_dir, args.seed)
+    print_results(results)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Resultados guardados en {args.save}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        if regressions:
+            print("\n❌ Empeora respecto a la referencia:")
+            for case, phase, metric, old, now in regressions:
+                print(f"  {case} {phase}: {metric} {old} → {now}")
+            return 1
+        print("\n✅ Nada empeora respecto a la referencia.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,14 +7,33 @@ Versión de consola con vista previa, confirmación y sistema de deshacer.
 """
 
 import os                   # Interactuar con el sistema de archivos
-import json                 # Guardar/recuperar el plan de deshacer en formato legible
+import time                 # Fechas del historial
 import sys                  # Acceso a funcionalidades del sistema
+import argparse             # Subcomandos para usarlo sin preguntas (cron, scripts...)
+import signal               # Parar el modo vigilar con SIGTERM (systemd, docker...) sin cortar un lote
+import threading
+import shutil                 # Copiar un plan que llega por la entrada estándar
+import tempfile
+import contextlib
 from pathlib import Path    # Util para lidiar con rutas del sistema
 
+import kambiosCore as core  # El motor de renombrado, compartido con la GUI
+import kambiosRules as rules  # Reglas encadenadas y presets
+import kambiosDAT as dat      # Nombres oficiales desde un DAT (No-Intro/Redump)
+import kambiosMeta as meta    # Plantillas con fecha, tamaño, EXIF...
+import kambiosGroups as groups  # Reemplazar el nombre completo por títulos (vídeo + subtítulos)
+import kambiosTree as tree    # Subcarpetas: recorrido, planes por carpeta y deshacer de todo el árbol
+import kambiosWatch as watch  # Modo vigilar: renombrar lo que va llegando a una carpeta
+import kambiosPlan as plans   # Planes enormes sin cargarlos enteros en memoria
+import kambiosMetrics as metrics  # Tiempos por fase en JSON y modo perfil (--metrics, --profile)
+import kambiosJobs as jobs    # Archivos de trabajo: muchas carpetas a la vez, un proceso por carpeta
 
 # Nombre del archivo oculto que guarda la operación para deshacer
 # Comienza con punto para que sea "oculto" en Unix/macOS. En Windows no hace nada, pero bueno.
-UNDO_FILE = ".kambios_undo.json"
+UNDO_FILE = core.UNDO_FILE
+
+# Cuántas filas enseñar por arriba y por abajo en las vistas previas. Con 1M de archivos, imprimirlo todo tarda minutos.
+PREVIEW_ROWS = 10
 
 """
 Función principal que controla el flujo del programa.
@@ -35,15 +54,20 @@ def main():
             print(f"❌ Error: La carpeta '{folder}' no existe.")
             return  # Salir si no es válida
 
-    # Construir ruta completa al archivo de deshacer dentro de la carpeta seleccionada
-    undo_path = os.path.join(folder, UNDO_FILE)
+    # Si la última vez se cortó a mitad de renombrar, lo primero es arreglar eso.
+    if core.read_journal(folder) is not None:
+        if not recover_interrupted(folder):
+            return
 
-    # Si existe un archivo de deshacer, ofrecer deshacer antes de hacer algo nuevo
-    if os.path.exists(undo_path):
-        print(f"\n⚠️  Se detectó una operación anterior que se puede deshacer.")
-        choice = input("¿Quieres deshacerla ahora? (s/n): ").strip().lower()
-        if choice in ("s", "si", "y", "yes"):
-            undo_last_rename(folder, undo_path)
+    # Si hay operaciones en el historial, ofrecer deshacer la última antes de hacer algo nuevo
+    history = core.list_history(folder)
+    if history:
+        last = history[0]
+        print(f"\n⚠️  Se detectó una operación anterior que se puede deshacer ({last.count} archivos, "
+              f"{format_time(last.timestamp)}). Hay {len(history)} en el historial.")
+        if confirm("¿Quieres deshacerla ahora? (s/n): "):
+            with metrics.recording("undo"):
+                undo_last_rename(folder)
             return
 
     # Mostramos un menú de acciones
@@ -51,18 +75,21 @@ def main():
     print("1) Numerar archivos")
     print("2) Reemplazar nombre completo")
     print("3) Reemplazar parte del nombre")
-    print("4) Salir")
-
-    action = input("\nElige una opción (1-4): ").strip()
-
-    # Llamar a la función correspondiente según la elección
-    if action == "1":
-        number_preview(folder)
-    elif action == "2":
-        full_replace_preview(folder)
-    elif action == "3":
-        part_replace_preview(folder)
-    elif action == "4":
+    print("4) Varias reglas a la vez (presets)")
+    print("5) Nombres oficiales desde un DAT (No-Intro/Redump)")
+    print("6) Salir")
+
+    action = input("\nElige una opción (1-6): ").strip()
+
+    # Llamar a la función correspondiente según la elección.
+    # Con KAMBIOS_METRICS o KAMBIOS_PROFILE, cada operación se mide (el total incluye lo que tardes en confirmar).
+    actions = {"1": ("number", number_preview), "2": ("full", full_replace_preview),
+               "3": ("part", part_replace_preview), "4": ("rules", rules_preview), "5": ("dat", dat_preview)}
+    if action in actions:
+        name, preview = actions[action]
+        with metrics.recording(name):
+            preview(folder)
+    elif action == "6":
         print("👋 ¡Hasta luego!")
         return
     else:
@@ -73,68 +100,133 @@ def main():
 def list_files(folder):
     """
     Devuelve una lista de archivos (no carpetas) en la carpeta dada.
-    Usa comprensión de listas + os.path.isfile para filtrar (por cada cosa en la carpeta, si es un archivo, devuélvelo a main).
+    El escaneo lo hace el motor con os.scandir, una sola pasada y sin un stat extra por archivo.
     """
-    return [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f))]
+    return core.scan_folder(folder).names
 
 
-def show_preview(changes):
+def confirm(question):
+    """
+    Pregunta s/n. Sin nadie al otro lado (stdin cerrado o redirigido desde un script) input() lanza EOFError:
+    cuenta como un "no", avisando de que para no preguntar está --yes.
+    """
+    try:
+        choice = input(question).strip().lower()
+    except EOFError:
+        print("\n❌ No hay a quién preguntar (la entrada no es un terminal). Usa --yes para confirmar sin preguntar.",
+              file=sys.stderr)
+        return False
+    return choice in ("s", "si", "y", "yes")
+
+
+def show_preview(changes, files=None):
     """
     Muestra una vista previa de los cambios y pide confirmación.
     Devuelve True si el usuario confirma, False si... si no.
     También verifica duplicados, si dos archivos terminan con el mismo nombre, se aborta.
+    Si se pasan los archivos de la carpeta, también se aborta si algún nombre nuevo pisaría a uno que ya existe.
     """
     if not changes:
         print("🔍 No se encontraron cambios que aplicar.")
         return False
 
-    print("\n📄 VISTA PREVIA DE CAMBIOS:")
-    print("-" * 50)
-    for old, new in changes:
-        print(f"  {old}  →  {new}")
-    print("-" * 50)
+    summary = core.summarize_plan(changes, head=PREVIEW_ROWS)
+    print_plan_summary(summary)
 
     # Evitar la sobrescritura por nombres duplicados y abortar.
-    new_names = [new for _, new in changes]
-    if len(new_names) != len(set(new_names)):
+    if summary["duplicates"]:
         print("\n❌ ¡ERROR! Los nombres nuevos generan duplicados. Abortando.")
         return False
+    if files is not None and print_conflicts(core.find_conflicts(changes, set(files))):
+        return False
     # ¿Seguuuuro?
-    confirm = input(f"\n¿Aplicar estos {len(changes)} cambios? (s/n): ").strip().lower()
-    return confirm in ("s", "si", "y", "yes")
+    return confirm(f"\n¿Aplicar estos {len(changes)} cambios? (s/n): ")
+
+
+def print_plan_summary(summary, out=None):
+    """
+    Imprime el resumen de un plan: primeros y últimos cambios, cuántos hay en medio y los duplicados.
+    """
+    out = out or sys.stdout
+    print("\n📄 VISTA PREVIA DE CAMBIOS:", file=out)
+    print("-" * 50, file=out)
+    for old, new in summary["first"]:
+        print(f"  {old}  →  {new}", file=out)
+    hidden = summary["count"] - len(summary["first"]) - len(summary["last"])
+    if hidden > 0:
+        print(f"  ... ({hidden} cambios más) ...", file=out)
+    for old, new in summary["last"]:
+        print(f"  {old}  →  {new}", file=out)
+    print("-" * 50, file=out)
+    print(f"Total: {summary['count']} cambios", file=out)
+    if summary["duplicates"]:
+        shown = summary["duplicates"][:PREVIEW_ROWS]
+        print(f"⚠️  {len(summary['duplicates'])} nombres duplicados: {', '.join(shown)}", file=out)
+
+
+def print_conflicts(conflicts):
+    # Devuelve True si había conflictos (y los ha enseñado).
+    if not conflicts:
+        return False
+    print(f"\n❌ ¡ERROR! {len(conflicts)} conflictos con archivos de la carpeta.")
+    for name, reason in conflicts[:PREVIEW_ROWS]:
+        print(f"  {name}: {reason}")
+    if len(conflicts) > PREVIEW_ROWS:
+        print(f"  ... y {len(conflicts) - PREVIEW_ROWS} más")
+    return True
+
+
+def print_failures(failures):
+    # En paralelo puede fallar más de un archivo (cada uno por su lado): se enseñan todos los que quepan.
+    if len(failures) < 2:
+        return
+    for name, error in failures[:PREVIEW_ROWS]:
+        print(f"  {name}: {error.strerror or error}")
+    if len(failures) > PREVIEW_ROWS:
+        print(f"  ... y {len(failures) - PREVIEW_ROWS} más")
+
+
+def print_file_summary(folder, files):
+    # Enseña cuántos archivos hay y los primeros, en vez de volcarlos todos en una sola línea gigante.
+    shown = ", ".join(files[:PREVIEW_ROWS])
+    more = f" ... y {len(files) - PREVIEW_ROWS} más" if len(files) > PREVIEW_ROWS else ""
+    print(f"\n{len(files)} archivos en '{folder}': {shown}{more}")
 
 
 def save_undo_file(folder, changes):
     """
-    Guarda el plan inverso (para deshacer) en un archivo JSON dentro de la carpeta.
-    El plan de deshacer es: [(nuevo_nombre, nombre_original), ...]
+    Guarda en el historial de deshacer de la carpeta unos cambios ya hechos: [(nombre_original, nuevo_nombre), ...]
     """
-    undo_path = os.path.join(folder, UNDO_FILE)
-    undo_plan = [[new, old] for old, new in changes]  # Invertimos el orden.
-    with open(undo_path, "w", encoding="utf-8") as f:
-        # json.dump() traduce la serie a JSON.
-        json.dump({
-            "source": "kambios_cli",  # ¿De dónde viene el json? (Por si hay errores o algo.)
-            "renames": undo_plan
-        }, f, indent=2, ensure_ascii=False)  # indent=2 para que se lea facilito.
+    core.save_undo_file(folder, changes, "kambios_cli")  # ¿De dónde viene? (Por si hay errores o algo.)
 
 
-def apply_changes(folder, changes):
+def apply_changes(folder, changes, workers=None):
     """
     Aplica los renombres y guarda el archivo de deshacer.
-    Usa try/except para no romper el programa si falla un renombre.
+    changes puede ser una lista o cualquier cosa iterable (por ejemplo, un plan leído línea a línea).
+    El motor ordena los renombres para que ninguno pise a otro (cadenas y ciclos incluidos) y
+    comprueba antes que ningún nombre nuevo exista ya en la carpeta.
+    Usa try/except para no romper el programa si falla un renombre. Devuelve True si todo fue bien.
+    En carpetas de red (NFS/SMB) renombra varios a la vez; workers lo fuerza (1 = uno detrás de otro).
     """
     try:
-        for old_name, new_name in changes:
-            src = os.path.join(folder, old_name)  # Ruta completa del archivo original.
-            dst = os.path.join(folder, new_name)  # Ruta completa del nuevo nombre.
-            os.rename(src, dst)  # rename hace el cambio de src a dst.
-        print(f"\n✅ ¡{len(changes)} archivos renombrados correctamente!")
-        save_undo_file(folder, changes)
+        # Cada lote se apunta en un diario antes de renombrar: si esto se corta a mitad, se puede recuperar.
+        done = core.apply_plan(folder, changes, "kambios_cli", workers=workers)
+        print(f"\n✅ ¡{len(done)} archivos renombrados correctamente!")
         print("↩️  Puedes deshacer esta operación la próxima vez que abras esta carpeta.")
+        return True
+    except core.PlanConflictError as e:
+        print_conflicts(e.conflicts)
+        return False
+    except core.RenameError as e:
+        # El deshacer de lo que sí se hizo ya está guardado, para no dejar la carpeta a medias sin vuelta atrás.
+        print(f"\n❌ Error al renombrar: {e} ({len(e.done)} cambios hechos, se pueden deshacer)")
+        print_failures(e.failures)
+        return False
     except Exception as e:
         # Manejo genérico de errores, si pasa algo malo, sea lo que sea, debería decirlo aquí.
         print(f"\n❌ Error al renombrar: {e}")
+        return False
 
 
 # --- Funciones de acción con vista previa ---
@@ -146,21 +238,40 @@ def number_preview(folder):
         print("📁 La carpeta está vacía.")
         return
 
-    print(f"\nArchivos en '{folder}': {', '.join(files)}")
+    print_file_summary(folder, files)
+    print("(También vale una plantilla, ej: {date:%Y%m%d}_{n:04}{ext}. Campos: " + ", ".join(meta.FIELDS) + ")")
     text = input("Texto después del número: ").strip()
     if not text:
         print("❌ El texto no puede estar vacío.")
         return
 
-    # Generar lista de cambios: (nombre_actual, nombre_propuesto).
-    changes = []
-    for i, filename in enumerate(files):
-        name, ext = os.path.splitext(filename)  # Separa "foto.jpg" en "foto" y ".jpg", porque lo que queremos cambiar es el nombre, no la extensión (a lo mejor algún día).
-        new_name = f"{i} - {text}{ext}"
-        if filename != new_name:  # Evitar renombrar si no hay cambio.
-            changes.append((filename, new_name))
+    if meta.is_template(text):
+        sort = input(f"Ordenar por ({', '.join(meta.SORT_KEYS)}; vacío = como están): ").strip() or None
+        try:
+            with metrics.phase("plan", len(files)):
+                changes = meta.template_plan(files, text, meta.MetadataReader(folder), sort=sort)
+        except meta.TemplateError as e:
+            print(f"❌ {e}")
+            return
+    else:
+        # Si ya hay archivos numerados con ese texto, se puede seguir la numeración y tocar solo los nuevos.
+        # Contarlos es solo mirar los nombres; el plan se calcula una vez, el del modo que se elija.
+        numbering = core.Numbering(text)
+        numbered = sum(1 for filename in files if numbering.number_of(filename) is not None)
+        continue_numbering = fill_gaps = False
+        if numbered:
+            print(f"🔢 {numbered} archivos ya siguen el patrón 'N - {text}'.")
+            if confirm(f"¿Numerar solo los {len(files) - numbered} nuevos, siguiendo la numeración? (s/n): "):
+                continue_numbering = True
+                fill_gaps = confirm("¿Rellenar los huecos de la numeración primero? (s/n): ")
+        # Generar lista de cambios: (nombre_actual, nombre_propuesto). La extensión se conserva.
+        with metrics.phase("plan", len(files)):
+            if continue_numbering:
+                changes = core.continue_number_plan(files, text, fill_gaps=fill_gaps)
+            else:
+                changes = core.number_plan(files, text)
 
-    if show_preview(changes):
+    if show_preview(changes, files):
         apply_changes(folder, changes)
 
 
@@ -171,20 +282,28 @@ def full_replace_preview(folder):
         print("📁 La carpeta está vacía.")
         return
 
-    print(f"\nArchivos en '{folder}': {', '.join(files)}")
+    print_file_summary(folder, files)
+    titles = len(groups.group_by_stem(files)[0])
+    if titles > 1:
+        # Con varios vídeos, un mismo nombre para todo chocaría: mejor uno por título.
+        print(f"🎬 Hay {titles} vídeos. Para renombrar cada uno con sus subtítulos, usa campos: 'Serie - S01E{{n:02}}'")
     text = input("Nuevo nombre base: ").strip()
     if not text:
         print("❌ El nombre no puede estar vacío.")
         return
 
-    changes = []
-    for filename in files:
-        _, ext = os.path.splitext(filename)
-        new_name = f"{text}{ext}"
-        if filename != new_name:
-            changes.append((filename, new_name))
+    if meta.is_template(text):
+        start = input("Primer número de {n} (Enter = 1): ").strip()
+        try:
+            changes = grouped_plan(folder, files, text, start=int(start) if start else 1)
+        except ValueError as e:   # TemplateError o un número mal escrito
+            print(f"❌ {e}")
+            return
+    else:
+        with metrics.phase("plan", len(files)):
+            changes = core.full_replace_plan(files, text)
 
-    if show_preview(changes):
+    if show_preview(changes, files):
         apply_changes(folder, changes)
 
 
@@ -195,55 +314,771 @@ def part_replace_preview(folder):
         print("📁 La carpeta está vacía.")
         return
 
-    print(f"\nArchivos en '{folder}': {', '.join(files)}")
+    print_file_summary(folder, files)
     text_remove = input("Texto a quitar: ")
     if not text_remove:
         print("❌ Debes ingresar texto a quitar.")
         return
     text_replace = input("Texto a poner (puede estar vacío): ")
 
-    changes = []
-    for filename in files:
-        if text_remove in filename:  # Solo si el texto está presente.
-            new_name = filename.replace(text_remove, text_replace)
-            if filename != new_name:
-                changes.append((filename, new_name))
+    with metrics.phase("plan", len(files)):
+        changes = core.part_replace_plan(files, text_remove, text_replace)  # Solo si el texto está presente.
 
-    if show_preview(changes):
+    if show_preview(changes, files):
         apply_changes(folder, changes)
 
 
-def undo_last_rename(folder, undo_path):
-    # Lee el archivo de deshacer y revierte los cambios. Renombra cada archivo del "nuevo nombre" al "original".
+def undo_last_rename(folder, op_id=None, skip_missing=None, workers=None):
+    # Deshace la última operación del historial (o la que se diga) y la quita del historial.
+    # El motor lo valida todo antes contra una sola foto de la carpeta: si falta algo o algo estorba,
+    # lo dice todo junto y no toca nada. Si solo faltan archivos, se puede deshacer el resto.
+    # skip_missing=None significa preguntar.
     try:
-        with open(undo_path, "r", encoding="utf-8") as f:
-            data = json.load(f)  # carga el JSON en la variable data.
-        renames = data.get("renames", [])
+        entry = core.read_history_entry(folder, op_id) if op_id is not None else next(iter(core.list_history(folder)), None)
+        if entry is None:
+            print("❌ No hay operación previa para deshacer.")
+            return False
 
-        if not renames:
-            print("❌ El archivo de deshacer está vacío.")
-            return
+        problems = core.validate_undo(folder, entry.id)
+        if problems:
+            print_conflicts(problems)
+            if any(reason != "no existe" for _, reason in problems):
+                return False
+            if skip_missing is None:
+                skip_missing = confirm("¿Deshacer el resto? Los que faltan se quedarán fuera. (s/n): ")
+            if not skip_missing:
+                return False
 
-        print(f"\n🔄 Deshaciendo {len(renames)} cambios:")
-        for current, original in renames:
-            src = os.path.join(folder, current)
-            dst = os.path.join(folder, original)
-            if os.path.exists(src):
-                os.rename(src, dst)
-                print(f"  {current} → {original}")
-            else:
-                print(f"  ⚠️  {current} no encontrado (quizás ya fue movido).")
-
-        # Eliminar archivo de deshacer tras usarlo.
-        os.remove(undo_path)
-        print("\n✅ ¡Operación deshecha! El archivo de deshacer ha sido eliminado.")
+        print(f"\n🔄 Deshaciendo la operación {entry.id} ({entry.count} cambios)...")
+        core.undo_operation(folder, entry.id, "kambios_cli", skip_missing=bool(skip_missing), workers=workers)
+        remaining = len(core.list_history(folder))
+        print(f"\n✅ ¡Operación deshecha! Quedan {remaining} operaciones en el historial.")
+        return True
     except Exception as e:
         print(f"❌ Error al deshacer: {e}")
+        return False
+
+
+def format_time(timestamp):
+    # Fecha legible para el historial.
+    if not timestamp:
+        return "fecha desconocida"
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+
+
+def recover_interrupted(folder, mode=None):
+    """
+    Ofrece revertir o terminar una operación que se cortó a mitad (Ctrl+C, cierre, error...).
+    Si no se da mode, se le pregunta al usuario. Devuelve True si la carpeta quedó en un estado coherente.
+    """
+    try:
+        pending = core.read_journal(folder)
+        if pending is None:
+            return True
+        if pending.completed is None:
+            print("❌ Hay una operación interrumpida, pero la carpeta ha cambiado desde entonces y no se puede recuperar sola.")
+            print(f"   Revisa la carpeta y borra '{core.JOURNAL_FILE}' a mano cuando esté bien.")
+            return False
+        if not pending.committed and mode is None:
+            print(f"\n⚠️  La última operación se interrumpió: {pending.completed} de {len(pending.steps)} renombres hechos.")
+            choice = input("¿Revertirla (r), terminarla (t) o dejarlo para luego (n)? ").strip().lower()
+            mode = {"r": "rollback", "t": "forward"}.get(choice)
+            if mode is None:
+                return False
+        count = core.recover_journal(folder, mode or "forward")
+        if mode == "rollback":
+            print(f"✅ Operación revertida ({count} renombres deshechos).")
+        else:
+            print(f"✅ Operación terminada ({count} renombres pendientes hechos). Se puede deshacer como siempre.")
+        return True
+    except Exception as e:
+        print(f"❌ Error al recuperar la operación interrumpida: {e}")
+        return False
+
+
+def rules_preview(folder):
+    # Varias reglas (quitar etiquetas, regex, mayúsculas...) en una sola pasada y un solo deshacer.
+    files = list_files(folder)
+    if not files:
+        print("📁 La carpeta está vacía.")
+        return
+
+    print_file_summary(folder, files)
+    presets = rules.list_presets()
+    if presets:
+        print(f"Presets guardados: {', '.join(presets)}")
+    name = input("Preset a usar (deja vacío para escribir las reglas): ").strip()
+    try:
+        if name:
+            pipeline_rules = rules.load_preset(name)
+        else:
+            print("Escribe una regla por línea (lit, re, rei, case, squeeze). Línea vacía para terminar.")
+            print("  ej:  lit (USA) =>     re \\(Rev (\\d+)\\) => v\\1     squeeze")
+            lines = []
+            while True:
+                line = input("> ")
+                if not line.strip():
+                    break
+                lines.append(line)
+            pipeline_rules = rules.parse_rules("\n".join(lines))
+        with metrics.phase("plan", len(files)):
+            changes = rules.pipeline_plan(files, pipeline_rules)
+    except rules.RuleError as e:
+        print(f"❌ {e}")
+        return
+
+    if not name and pipeline_rules:
+        save_as = input("¿Guardar estas reglas como preset? (nombre o vacío): ").strip()
+        if save_as:
+            try:
+                print(f"💾 Guardado en {rules.save_preset(save_as, pipeline_rules)}")
+            except (rules.RuleError, OSError) as e:
+                print(f"❌ No se pudo guardar: {e}")
+
+    if show_preview(changes, files):
+        apply_changes(folder, changes)
+
+
+def print_dat_report(report, out=None):
+    out = out or sys.stdout
+    print(f"✔️  {report.verified} ya tienen su nombre oficial, {report.renamed} a renombrar.", file=out)
+    if report.unknown:
+        shown = ", ".join(report.unknown[:PREVIEW_ROWS])
+        more = f" (y {len(report.unknown) - PREVIEW_ROWS} más)" if len(report.unknown) > PREVIEW_ROWS else ""
+        print(f"❓ {len(report.unknown)} no están en el DAT: {shown}{more}", file=out)
+    for name, error in report.errors[:PREVIEW_ROWS]:
+        print(f"⚠️  No se pudo leer {name}: {error}", file=out)
+
+
+def dat_plan(folder, files, dat_path, workers=None, out=None):
+    # Carga el DAT y compara los hashes (los que ya estén en la caché no se vuelven a calcular).
+    index = dat.load_dat(dat_path)
+    print(f"📚 DAT: {index.name or os.path.basename(dat_path)} ({len(index)} ROMs). Calculando hashes...",
+          file=out or sys.stdout)
+    with metrics.phase("plan", len(files)):
+        changes, report = dat.dat_plan(folder, files, index, workers=workers)
+    print_dat_report(report, out=out)
+    return changes
+
+
+def grouped_plan(folder, files, template, start=1, workers=None, out=None):
+    # Reemplazar el nombre completo por títulos. Lo que no es de ningún vídeo se queda como está, avisando.
+    reader = meta.MetadataReader(folder, workers=workers or meta.META_WORKERS)
+    with metrics.phase("plan", len(files)):
+        changes, loose = groups.grouped_replace_plan(files, template, reader, start=start)
+    if loose:
+        print(f"⚠️  {len(loose)} archivos sin vídeo al que acompañar (no se tocan):", file=out or sys.stdout)
+        for name in loose[:PREVIEW_ROWS]:
+            print(f"   {name}", file=out or sys.stdout)
+        if len(loose) > PREVIEW_ROWS:
+            print(f"   ... y {len(loose) - PREVIEW_ROWS} más", file=out or sys.stdout)
+    return changes
+
+
+def dat_preview(folder):
+    # Renombrar ROMs a su nombre oficial comprobando el contenido, no adivinando por el nombre.
+    files = list_files(folder)
+    if not files:
+        print("📁 La carpeta está vacía.")
+        return
+
+    print_file_summary(folder, files)
+    dat_path = input("Ruta del archivo DAT: ").strip()
+    if not os.path.isfile(dat_path):
+        print(f"❌ No existe el archivo '{dat_path}'.")
+        return
+    try:
+        changes = dat_plan(folder, files, dat_path)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return
+
+    if show_preview(changes, files):
+        apply_changes(folder, changes)
+
+
+# --- Modo por lotes (sin preguntas) ---
+# kambiosCLI.py plan CARPETA --number "Texto" -o plan.jsonl   -> genera el plan
+# kambiosCLI.py show plan.jsonl                               -> resumen del plan
+# kambiosCLI.py apply plan.jsonl --yes                        -> lo aplica
+# kambiosCLI.py undo CARPETA --yes                            -> deshace la última operación
+# kambiosCLI.py history CARPETA                               -> lista las operaciones que se pueden deshacer
+# kambiosCLI.py recover CARPETA --rollback|--forward          -> arregla una operación interrumpida
+# kambiosCLI.py recover CARPETA --tree --forward              -> lo mismo con una operación de árbol
+# kambiosCLI.py plan CARPETA --preset roms -o plan.jsonl      -> varias reglas guardadas, en una pasada
+# kambiosCLI.py presets --save roms reglas.txt                -> guarda (o lista, enseña, borra) presets
+# kambiosCLI.py plan CARPETA --dat "Nintendo - NES.dat"       -> nombres oficiales, comprobando hashes
+# kambiosCLI.py plan CARPETA --template "{date:%Y%m%d}_{n:04}{ext}" --sort date   -> plantilla con metadatos
+# kambiosCLI.py watch CARPETA --part " (USA)"                 -> renombra lo que va llegando (Ctrl+C para parar)
+# kambiosCLI.py job noche.json --report informe.json          -> muchas carpetas a la vez, con un informe
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="kambiosCLI.py",
+        description="KAMBIOS - renombrador de archivos. Sin argumentos arranca el modo interactivo."
+    )
+    parser.add_argument("--metrics", metavar="ARCHIVO",
+                        help="Añade a ARCHIVO una línea JSON con los tiempos de cada fase ('-' para stderr)")
+    parser.add_argument("--profile", metavar="CARPETA",
+                        help="Guarda en CARPETA un perfil de cProfile y tracemalloc de la operación")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_plan = sub.add_parser("plan", help="Genera un plan de renombrado en JSONL")
+    p_plan.add_argument("folder", help="Carpeta a renombrar")
+    mode = p_plan.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--number", metavar="TEXTO", help="Numerar: 'N - TEXTO.ext'")
+    mode.add_argument("--full", metavar="NOMBRE",
+                      help="Reemplazar el nombre completo: 'NOMBRE.ext'. Con campos ('Serie - S01E{n:02}'), "
+                           "uno por título: cada vídeo con sus subtítulos")
+    mode.add_argument("--part", metavar="QUITAR", help="Reemplazar parte del nombre")
+    mode.add_argument("--rules", metavar="ARCHIVO", help="Aplicar las reglas de un archivo (una por línea o JSON)")
+    mode.add_argument("--preset", metavar="NOMBRE", help="Aplicar un preset de reglas guardado")
+    mode.add_argument("--dat", metavar="ARCHIVO", help="Nombres oficiales de un DAT No-Intro/Redump (por hash)")
+    mode.add_argument("--template", metavar="PLANTILLA",
+                      help="Plantilla con campos: " + ", ".join("{%s}" % f for f in meta.FIELDS))
+    p_plan.add_argument("--continue", dest="continue_numbering", action="store_true",
+                        help="Con --number: numerar solo los que no siguen ya 'N - TEXTO', desde el más alto")
+    p_plan.add_argument("--fill-gaps", action="store_true", help="Con --continue: usar primero los números libres")
+    p_plan.add_argument("--with", dest="replace_with", default="", metavar="PONER",
+                        help="Texto a poner con --part (por defecto, nada)")
+    p_plan.add_argument("--glob", help="Solo archivos que cumplan el patrón (ej: '*.zip')")
+    p_plan.add_argument("--ext", nargs="+", help="Solo estas extensiones (ej: zip 7z)")
+    p_plan.add_argument("--sort", choices=meta.SORT_KEYS, help="Con --template: orden antes de numerar")
+    p_plan.add_argument("--desc", action="store_true", help="Con --sort: de mayor a menor")
+    p_plan.add_argument("--start", type=int,
+                        help="Con --template o --full por títulos: primer número de {n} (por defecto, 0 y 1)")
+    p_plan.add_argument("--workers", type=int, help="Procesos para calcular hashes con --dat (por defecto, uno por CPU)")
+    p_plan.add_argument("-r", "--recursive", action="store_true",
+                        help="Incluir subcarpetas (un plan por carpeta, con rutas relativas)")
+    p_plan.add_argument("--depth", type=int, metavar="N", help="Con --recursive: profundidad máxima (0 = solo la carpeta)")
+    p_plan.add_argument("--exclude", nargs="+", default=[], metavar="GLOB",
+                        help="Con --recursive: saltar archivos o carpetas que cumplan estos patrones")
+    p_plan.add_argument("-o", "--output", default="-", help="Archivo de salida (por defecto, la salida estándar)")
+
+    p_show = sub.add_parser("show", help="Muestra el resumen de un plan")
+    p_show.add_argument("plan", help="Archivo de plan ('-' para la entrada estándar)")
+
+    p_apply = sub.add_parser("apply", help="Aplica un plan")
+    p_apply.add_argument("plan", help="Archivo de plan")
+    p_apply.add_argument("-y", "--yes", action="store_true", help="No pedir confirmación")
+    p_apply.add_argument("--workers", type=int,
+                         help="Renombres a la vez (por defecto, varios solo en carpetas de red; 1 = en fila)")
+
+    p_undo = sub.add_parser("undo", help="Deshace la última operación de una carpeta")
+    p_undo.add_argument("folder", help="Carpeta")
+    p_undo.add_argument("--id", type=int, help="Número de la operación del historial (por defecto, la última)")
+    p_undo.add_argument("--tree", action="store_true", help="Deshacer una operación de árbol (plan con --recursive)")
+    p_undo.add_argument("--skip-missing", action="store_true",
+                        help="Si faltan archivos, deshacer el resto en vez de abortar")
+    p_undo.add_argument("-y", "--yes", action="store_true", help="No pedir confirmación")
+    p_undo.add_argument("--workers", type=int, help="Renombres a la vez, como en apply")
+
+    p_history = sub.add_parser("history", help="Lista (y limpia) el historial de deshacer de una carpeta")
+    p_history.add_argument("folder", help="Carpeta")
+    p_history.add_argument("--tree", action="store_true", help="Listar las operaciones de árbol")
+    p_history.add_argument("--prune", action="store_true", help="Aplicar la política de retención ahora")
+    p_history.add_argument("--keep", type=int, default=core.HISTORY_KEEP,
+                           help=f"Operaciones a conservar (por defecto, {core.HISTORY_KEEP})")
+    p_history.add_argument("--max-age", type=float, metavar="DÍAS", help="Borrar las operaciones más viejas que esto")
+
+    p_recover = sub.add_parser("recover", help="Revierte o termina una operación interrumpida")
+    p_recover.add_argument("folder", help="Carpeta")
+    p_recover.add_argument("--tree", action="store_true",
+                           help="Recuperar una operación de árbol cortada (todas sus subcarpetas)")
+    how = p_recover.add_mutually_exclusive_group(required=True)
+    how.add_argument("--rollback", dest="mode", action="store_const", const="rollback",
+                     help="Dejar la carpeta como estaba antes")
+    how.add_argument("--forward", dest="mode", action="store_const", const="forward",
+                     help="Terminar los renombres que faltaban")
+
+    p_watch = sub.add_parser("watch", help="Vigila una carpeta y renombra los archivos nuevos según llegan")
+    p_watch.add_argument("folder", help="Carpeta a vigilar")
+    watch_mode = p_watch.add_mutually_exclusive_group(required=True)
+    watch_mode.add_argument("--number", metavar="TEXTO",
+                            help="Numerar lo nuevo como 'N - TEXTO', siguiendo la numeración que ya haya")
+    watch_mode.add_argument("--full", metavar="NOMBRE", help="Reemplazar el nombre completo: 'NOMBRE.ext'")
+    watch_mode.add_argument("--part", metavar="QUITAR", help="Reemplazar parte del nombre")
+    watch_mode.add_argument("--rules", metavar="ARCHIVO", help="Aplicar las reglas de un archivo")
+    watch_mode.add_argument("--preset", metavar="NOMBRE", help="Aplicar un preset de reglas guardado")
+    p_watch.add_argument("--with", dest="replace_with", default="", metavar="PONER",
+                         help="Texto a poner con --part (por defecto, nada)")
+    p_watch.add_argument("--fill-gaps", action="store_true", help="Con --number: usar primero los números libres")
+    p_watch.add_argument("--glob", help="Solo archivos que cumplan el patrón (ej: '*.pdf')")
+    p_watch.add_argument("--ext", nargs="+", help="Solo estas extensiones (ej: pdf jpg)")
+    p_watch.add_argument("--settle", type=float, default=watch.SETTLE_SECONDS, metavar="SEG",
+                         help=f"Segundos sin cambios para dar un archivo por terminado (por defecto, "
+                              f"{watch.SETTLE_SECONDS:g})")
+    p_watch.add_argument("--batch", type=int, default=watch.INGEST_BATCH, metavar="N",
+                         help=f"Archivos por lote, cada uno es una operación del historial "
+                              f"(por defecto, {watch.INGEST_BATCH})")
+
+    p_job = sub.add_parser("job", help="Ejecuta un archivo de trabajo: muchas carpetas a la vez, cada una con su deshacer")
+    p_job.add_argument("job", help="Archivo de trabajo (JSON con las carpetas y las reglas)")
+    p_job.add_argument("--workers", type=int, help="Carpetas a la vez, cada una en su proceso (por defecto, una por CPU)")
+    p_job.add_argument("--dry-run", action="store_true", help="Solo planear y revisar: no renombra nada")
+    p_job.add_argument("--report", metavar="ARCHIVO", help="Guarda el informe completo en JSON")
+
+    p_presets = sub.add_parser("presets", help="Lista, enseña, guarda o borra presets de reglas")
+    action = p_presets.add_mutually_exclusive_group()
+    action.add_argument("--show", metavar="NOMBRE", help="Enseña las reglas de un preset")
+    action.add_argument("--save", nargs=2, metavar=("NOMBRE", "ARCHIVO"),
+                        help="Guarda las reglas de ARCHIVO como preset ('-' para la entrada estándar)")
+    action.add_argument("--delete", metavar="NOMBRE", help="Borra un preset")
+
+    return parser
+
+
+def open_plan(path):
+    # '-' es la entrada estándar, como manda la tradición. Salir del with no la cierra.
+    if path == "-":
+        return contextlib.nullcontext(sys.stdin)
+    return open(path, "r", encoding="utf-8")
+
+
+def plan_builder(args):
+    """
+    Función foto -> cambios según el modo elegido. La misma para una carpeta o para cada carpeta de un árbol.
+    Los modos que miran cada nombre por separado van en streaming (ver is_streaming).
+    """
+    if args.number is not None and (args.continue_numbering or args.fill_gaps):
+        return lambda snapshot: core.continue_number_plan(snapshot.names, args.number, fill_gaps=args.fill_gaps)
+    if args.number is not None:
+        return lambda snapshot: core.iter_number_plan(snapshot.names, args.number)
+    if args.full is not None and meta.is_template(args.full):
+        return lambda snapshot: grouped_plan(snapshot.folder, snapshot.names, args.full,
+                                             start=1 if args.start is None else args.start,
+                                             workers=args.workers, out=sys.stderr)
+    if args.full is not None:
+        return lambda snapshot: core.iter_full_replace_plan(snapshot.names, args.full)
+    if args.rules is not None or args.preset is not None:
+        pipeline = rules.Pipeline(rules.load_rules_file(args.rules) if args.rules is not None
+                                  else rules.load_preset(args.preset))
+        return lambda snapshot: rules.iter_pipeline_plan(snapshot.names, pipeline)
+    if args.dat is not None:
+        return lambda snapshot: dat_plan(snapshot.folder, snapshot.names, args.dat, workers=args.workers,
+                                         out=sys.stderr)
+    if args.template is not None:
+        meta.Template(args.template)  # Los errores de la plantilla, antes de recorrer nada
+        return lambda snapshot: meta.template_plan(
+            snapshot.names, args.template, meta.MetadataReader(snapshot.folder, workers=args.workers or meta.META_WORKERS),
+            sort=args.sort, descending=args.desc, start=args.start or 0)
+    return lambda snapshot: core.iter_part_replace_plan(snapshot.names, args.part, args.replace_with)
+
+
+def is_streaming(args):
+    # Numerar, reemplazar y reglas no necesitan ver la carpeta entera: el plan sale según se lista.
+    # Por títulos sí: un subtítulo puede salir en el listado antes que su vídeo.
+    grouped = args.full is not None and meta.is_template(args.full)
+    return (args.template is None and args.dat is None and not grouped
+            and not (args.continue_numbering or args.fill_gaps))
+
+
+def cmd_plan(args):
+    if not os.path.isdir(args.folder):
+        print(f"❌ Error: La carpeta '{args.folder}' no existe.", file=sys.stderr)
+        return 1
+    build = plan_builder(args)
+    if args.recursive:
+        if args.dat is not None:
+            # Un pool de procesos por subcarpeta no tiene sentido; para DAT, carpeta a carpeta.
+            print("❌ Error: --dat no se puede usar con --recursive.", file=sys.stderr)
+            return 1
+        walked = tree.walk_tree(args.folder, include=args.glob, extensions=args.ext, exclude=args.exclude,
+                                max_depth=args.depth)
+        for path, error in walked.errors:
+            print(f"⚠️  No se pudo leer {path}: {error}", file=sys.stderr)
+        plan = tree.tree_plan(walked, build)
+        changes = plan.flat()
+        print(f"🌳 {len(walked.folders)} carpetas, {len(walked)} archivos, {len(plan.plans)} con cambios.",
+              file=sys.stderr)
+    elif is_streaming(args):
+        # Ni el listado ni el plan se guardan enteros: cada nombre pasa del scandir al archivo de plan.
+        names = (entry.name for entry in core.iter_scan(args.folder, args.glob, args.ext))
+        changes = build(core.FolderSnapshot(args.folder, names))
+    else:
+        changes = build(core.scan_folder(args.folder, pattern=args.glob, extensions=args.ext))
+
+    # Se revisa según se escribe (duplicados con memoria acotada), en la misma pasada. La fase es "write":
+    # "plan" es la de los constructores que calculan el plan antes (DAT, por títulos); en streaming, el plan
+    # sale dentro de esta.
+    checker = plans.PlanChecker(head=PREVIEW_ROWS)
+    with metrics.phase("write") as phase:
+        if args.output == "-":
+            core.write_plan(sys.stdout, args.folder, checker.feed(changes), tree=args.recursive)
+        else:
+            with open(args.output, "w", encoding="utf-8") as f:
+                core.write_plan(f, args.folder, checker.feed(changes), tree=args.recursive)
+        phase.files = checker.count
+
+    # El resumen va a stderr para no mezclarse con el plan si sale por stdout.
+    with metrics.phase("check", checker.count):
+        summary = checker.finish().summary()
+    print_plan_summary(summary, out=sys.stderr)
+    return 1 if summary["duplicates"] else 0
+
+
+def cmd_show(args):
+    with open_plan(args.plan) as f:
+        header = core.read_plan_header(f)
+        with metrics.phase("check") as phase:
+            summary = plans.check_plan(core.iter_plan(f, tree=header.get("tree")), head=PREVIEW_ROWS)
+            phase.files = summary["count"]
+    print(f"Carpeta: {header['folder']}")
+    print_plan_summary(summary)
+    return 1 if summary["duplicates"] else 0
+
+
+def cmd_apply(args):
+    if args.plan == "-":
+        # La entrada estándar solo se puede leer una vez: se copia a un temporal para poder hacer las dos pasadas.
+        with tempfile.TemporaryDirectory(prefix="kambios_") as tmp:
+            path = os.path.join(tmp, "plan.jsonl")
+            with open(path, "w", encoding="utf-8") as f:
+                shutil.copyfileobj(sys.stdin, f)
+            return apply_plan_file(args, path)
+    return apply_plan_file(args, args.plan)
+
+
+def apply_plan_file(args, path):
+    # Primera pasada: resumen y duplicados, leyendo en streaming. Segunda pasada: renombrar.
+    with open_plan(path) as f:
+        header = core.read_plan_header(f)
+        with metrics.phase("check") as phase:
+            summary = plans.check_plan(core.iter_plan(f, tree=header.get("tree")), head=PREVIEW_ROWS)
+            phase.files = summary["count"]
+    folder = header["folder"]
+    print(f"Carpeta: {folder}")
+    print_plan_summary(summary)
+
+    if summary["count"] == 0:
+        print("🔍 No se encontraron cambios que aplicar.")
+        return 0
+    if summary["duplicates"]:
+        print("\n❌ ¡ERROR! Los nombres nuevos generan duplicados. Abortando.")
+        return 1
+    if not args.yes:
+        if not confirm(f"\n¿Aplicar estos {summary['count']} cambios? (s/n): "):
+            return 1
+
+    if summary["count"] > plans.PLAN_MEMORY_BUDGET and not header.get("tree"):
+        if args.workers is not None and args.workers > 1:
+            print(f"⚠️  Plan de más de {plans.PLAN_MEMORY_BUDGET} cambios: se aplica sin cargarlo entero y "
+                  f"de uno en uno (--workers no se usa).")
+        return 0 if apply_large_plan(folder, path) else 1
+    with open_plan(path) as f:
+        core.read_plan_header(f)
+        if header.get("tree"):
+            return 0 if apply_tree_changes(folder, list(core.iter_plan(f, tree=True))) else 1
+        ok = apply_changes(folder, core.iter_plan(f), workers=args.workers)
+    return 0 if ok else 1
+
+
+def apply_large_plan(folder, path):
+    """
+    Un plan de millones de cambios: se lee del archivo dos veces (revisar y renombrar) en vez de cargarlo.
+    """
+    def open_changes():
+        with open(path, "r", encoding="utf-8") as f:
+            core.read_plan_header(f)
+            yield from core.iter_plan(f)
+
+    # Lo hecho vuelve en un PlanStore (que puede tener un archivo temporal): se cierra en cuanto se ha contado.
+    try:
+        with plans.apply_large(folder, open_changes, "kambios_cli") as done:
+            print(f"\n✅ ¡{len(done)} archivos renombrados correctamente!")
+        print("↩️  Puedes deshacer esta operación la próxima vez que abras esta carpeta.")
+        return True
+    except core.PlanConflictError as e:
+        print_conflicts(e.conflicts)
+        return False
+    except core.RenameError as e:
+        with e.done:
+            print(f"\n❌ Error al renombrar: {e} ({len(e.done)} cambios hechos, se pueden deshacer)")
+        return False
+
+
+def apply_tree_changes(root, changes):
+    """
+    Aplica un plan de árbol: cada subcarpeta con su diario, varias a la vez. Lo que falle en una carpeta
+    no para a las demás, y todo lo hecho se deshace junto con 'undo --tree'.
+    """
+    plan = tree.TreePlan(root, tree.split_flat(changes))
+    try:
+        result = tree.apply_tree(plan, "kambios_cli")
+    except core.Cancelled:
+        print("\n🛑 Cancelado. Lo hecho se puede deshacer con 'undo --tree'.")
+        return False
+    print(f"\n✅ ¡{result.count} archivos renombrados en {len(result.done)} carpetas!")
+    for reldir, error in result.errors:
+        print(f"❌ {reldir or '.'}: {error}")
+    if result.tree_id is not None:
+        print(f"↩️  Se puede deshacer todo junto con 'undo --tree' (operación de árbol {result.tree_id}).")
+    return not result.errors
+
+
+def undo_tree(root, tree_id=None, skip_missing=None):
+    # Como undo_last_rename, pero para todas las carpetas de una operación de árbol a la vez.
+    entries = tree.list_tree_history(root)
+    entry = next((e for e in entries if tree_id is None or e.id == tree_id), None)
+    if entry is None:
+        print("❌ No hay operación de árbol para deshacer.")
+        return False
+    problems = tree.validate_tree_undo(root, entry)
+    if problems:
+        print_conflicts(problems)
+        if any(reason != "no existe" for _, reason in problems):
+            return False
+        if skip_missing is None:
+            skip_missing = confirm("¿Deshacer el resto? Los que faltan se quedarán fuera. (s/n): ")
+        if not skip_missing:
+            return False
+
+    print(f"\n🔄 Deshaciendo la operación de árbol {entry.id} ({entry.count} cambios en {len(entry.folders)} carpetas)...")
+    result = tree.undo_tree(root, entry.id, "kambios_cli", skip_missing=bool(skip_missing))
+    for reldir, error in result.errors:
+        print(f"❌ {reldir or '.'}: {error}")
+    if result.errors:
+        print("⚠️  Las carpetas que fallaron siguen en el historial del árbol para reintentar.")
+        return False
+    print(f"\n✅ ¡Operación deshecha en {len(result.done)} carpetas!")
+    return True
+
+
+def recover_tree(root, mode):
+    # Como recover_interrupted, pero para las subcarpetas de una operación de árbol que se cortó.
+    if all(entry.complete for entry in tree.list_tree_history(root)):
+        print("No hay ninguna operación de árbol interrumpida en esa carpeta.")
+        return True
+    result = tree.recover_tree(root, mode)
+    for reldir, error in result.errors:
+        print(f"❌ {reldir or '.'}: {error}")
+    if result.errors:
+        print("⚠️  Arregla esas carpetas (recover CARPETA) y vuelve a lanzar recover --tree.")
+        return False
+    done = "revertida" if mode == "rollback" else "terminada"
+    print(f"✅ Operación de árbol {done} ({result.count} renombres en {len(result.done)} carpetas).")
+    print("↩️  Lo que llegó a hacerse se puede deshacer con 'undo --tree'.")
+    return True
+
+
+def cmd_undo(args):
+    if args.tree:
+        if not args.yes:
+            which = f"la operación de árbol {args.id}" if args.id is not None else "la última operación de árbol"
+            if not confirm(f"¿Deshacer {which}? (s/n): "):
+                return 1
+        return 0 if undo_tree(args.folder, args.id, args.skip_missing or (False if args.yes else None)) else 1
+
+    # Una operación interrumpida va antes que el deshacer normal: "deshacer" aquí es revertirla.
+    if core.read_journal(args.folder) is not None:
+        if not args.yes:
+            if not confirm("La última operación se interrumpió. ¿Revertirla? (s/n): "):
+                return 1
+        return 0 if recover_interrupted(args.folder, "rollback") else 1
+
+    if not core.has_undo(args.folder):
+        print("❌ No hay operación previa para deshacer.", file=sys.stderr)
+        return 1
+    if not args.yes:
+        which = f"la operación {args.id}" if args.id is not None else "la última operación"
+        if not confirm(f"¿Deshacer {which}? (s/n): "):
+            return 1
+    skip_missing = args.skip_missing or (False if args.yes else None)
+    return 0 if undo_last_rename(args.folder, args.id, skip_missing, workers=args.workers) else 1
+
+
+def cmd_history(args):
+    if args.tree:
+        entries = tree.list_tree_history(args.folder)
+        if not entries:
+            print("No hay operaciones de árbol en el historial.")
+        for entry in entries:
+            print(f"  {entry.id:>5}  {format_time(entry.timestamp)}  {entry.count:>8} archivos  "
+                  f"{len(entry.folders):>5} carpetas  ({entry.source})"
+                  f"{'' if entry.complete else '  ⚠️ interrumpida: recover --tree'}")
+        return 0
+    if args.prune:
+        removed = core.prune_history(args.folder, keep=args.keep, max_age_days=args.max_age)
+        print(f"🧹 {removed} operaciones borradas del historial.")
+    history = core.list_history(args.folder)
+    if not history:
+        print("El historial está vacío.")
+        return 0
+    for entry in history:
+        print(f"  {entry.id:>5}  {format_time(entry.timestamp)}  {entry.count:>8} archivos  ({entry.source})")
+    return 0
+
+
+def cmd_recover(args):
+    if args.tree:
+        return 0 if recover_tree(args.folder, args.mode) else 1
+    if core.read_journal(args.folder) is None:
+        print("No hay ninguna operación interrumpida en esa carpeta.")
+        return 0
+    return 0 if recover_interrupted(args.folder, args.mode) else 1
+
+
+def watch_planner(args):
+    """
+    Qué hacerle a cada archivo nuevo: función nombres -> cambios, que solo ve los archivos de cada lote.
+    Numerar sigue la numeración de la carpeta (core.Numbering), que hay que cebar con lo que ya hay.
+    """
+    if args.number is not None:
+        return core.Numbering(args.number, fill_gaps=args.fill_gaps)
+    if args.full is not None:
+        return lambda names: core.full_replace_plan(names, args.full)
+    if args.rules is not None or args.preset is not None:
+        pipeline = rules.Pipeline(rules.load_rules_file(args.rules) if args.rules is not None
+                                  else rules.load_preset(args.preset))
+        return lambda names: rules.pipeline_plan(names, pipeline)
+    return lambda names: core.part_replace_plan(names, args.part, args.replace_with)
+
+
+def print_watch_batch(done, problems):
+    # Una línea por lote (con hora), pensado para ir a un log.
+    stamp = time.strftime("%H:%M:%S")
+    if done:
+        shown = ", ".join(f"{old} → {new}" for old, new in done[:3])
+        more = f" (y {len(done) - 3} más)" if len(done) > 3 else ""
+        print(f"[{stamp}] ✅ {len(done)} renombrados: {shown}{more}", flush=True)
+    for name, reason in problems:
+        print(f"[{stamp}] ⚠️  {name}: {reason} (se deja como está)", flush=True)
+
+
+def cmd_watch(args):
+    if not os.path.isdir(args.folder):
+        print(f"❌ Error: La carpeta '{args.folder}' no existe.", file=sys.stderr)
+        return 1
+    if not watch.inotify_available():
+        print("❌ Error: el modo vigilar necesita inotify (Linux).", file=sys.stderr)
+        return 1
+    if core.read_journal(args.folder) is not None:
+        print("❌ Error: hay una operación interrumpida en la carpeta. Arréglala antes con recover.", file=sys.stderr)
+        return 1
+    planner = watch_planner(args)
+    numbering = planner if isinstance(planner, core.Numbering) else None
+    watcher = watch.IngestWatcher(args.folder, numbering.plan if numbering else planner, settle=args.settle,
+                                  batch_size=args.batch, pattern=args.glob, extensions=args.ext,
+                                  source="kambios_watch", on_batch=print_watch_batch,
+                                  metrics_sink=args.metrics, profile_dir=args.profile)
+    existing = watcher.start()
+    if numbering:
+        numbering.add_existing(existing)
+    # SIGTERM para como Ctrl+C, pero sin cortar un lote a medias: el bucle lo mira entre lote y lote.
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    print(f"👀 Vigilando {args.folder} ({len(existing)} archivos ya estaban). Ctrl+C para parar.", flush=True)
+    try:
+        watcher.run(stop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.stop()
+    print("🛑 Vigilancia parada. Cada lote se puede deshacer con undo.")
+    return 0
+
+
+def print_job_result(result):
+    # Una línea por carpeta, según van acabando.
+    name = result["folder"]
+    status = result["status"]
+    if status == "ok" and result["renamed"]:
+        print(f"✅ {name}: {result['renamed']} renombrados ({result['seconds']:.1f} s)", flush=True)
+    elif status == "ok":
+        verb = "a renombrar" if result["changes"] else "sin cambios"
+        count = f"{result['changes']} " if result["changes"] else ""
+        print(f"⚪ {name}: {count}{verb} ({result['seconds']:.1f} s)", flush=True)
+    elif status == "error":
+        print(f"💥 {name}: {result['error']}", flush=True)
+    else:
+        what = {"duplicates": "nombres duplicados", "conflicts": "conflictos", "failed": "fallos al renombrar"}[status]
+        count = result[{"duplicates": "duplicates", "conflicts": "conflicts", "failed": "failures"}[status]]
+        print(f"❌ {name}: {count} {what}", flush=True)
+        for problem, reason in result["problems"][:3]:
+            print(f"   {problem}: {reason}", flush=True)
+
+
+def print_job_report(report):
+    totals = report.totals()
+    statuses = totals["status"]
+    print("\n" + "=" * 50)
+    print(f"📋 {totals['folders']} carpetas en {totals['seconds']:.1f} s con {report.workers} "
+          f"{'proceso' if report.workers == 1 else 'procesos'} "
+          f"({totals['folder_seconds']:.1f} s sumando todas)")
+    print(f"   {totals['files']} archivos, {totals['changes']} cambios, {totals['renamed']} renombrados")
+    print(f"   {statuses.get('ok', 0)} bien · {statuses.get('duplicates', 0)} con duplicados · "
+          f"{statuses.get('conflicts', 0)} con conflictos · {statuses.get('failed', 0)} con fallos · "
+          f"{totals['errors']} con errores")
+    if totals["slowest"]:
+        print(f"   La más lenta: {totals['slowest'][0]} ({totals['slowest'][1]:.1f} s)")
+    if report.dry_run:
+        print("🔍 Solo prueba: no se ha renombrado nada.")
+    elif totals["renamed"]:
+        print("↩️  Cada carpeta se deshace por su cuenta: kambiosCLI.py undo CARPETA")
+
+
+def cmd_job(args):
+    job_list = jobs.load_jobs(args.job)
+    print(f"🗂️  {len(job_list)} carpetas en {args.job}", flush=True)
+    try:
+        report = jobs.run_jobs(job_list, workers=args.workers, dry_run=args.dry_run, path=args.job,
+                               on_result=print_job_result)
+    except KeyboardInterrupt:
+        print("\n🛑 Parado: no se empiezan más carpetas. Lo ya renombrado se puede deshacer carpeta a carpeta.")
+        return 1
+    print_job_report(report)
+    if args.report:
+        report.save(args.report)
+        print(f"💾 Informe guardado en {args.report}")
+    return 0 if report.ok else 1
+
+
+def cmd_presets(args):
+    if args.show:
+        print(rules.format_rules(rules.load_preset(args.show)))
+    elif args.save:
+        name, path = args.save
+        text = sys.stdin.read() if path == "-" else None
+        preset_rules = rules.parse_rules(text) if text is not None else rules.load_rules_file(path)
+        print(f"💾 Preset '{name}' guardado ({len(preset_rules)} reglas): {rules.save_preset(name, preset_rules)}")
+    elif args.delete:
+        rules.delete_preset(args.delete)
+        print(f"🗑️  Preset '{args.delete}' borrado.")
+    else:
+        presets = rules.list_presets()
+        if not presets:
+            print(f"No hay presets guardados (se guardan en {rules.presets_dir()}).")
+        for name in presets:
+            print(f"  {name}")
+    return 0
+
+
+def cli(argv):
+    args = build_parser().parse_args(argv)
+    commands = {"plan": cmd_plan, "show": cmd_show, "apply": cmd_apply, "undo": cmd_undo,
+                "history": cmd_history, "recover": cmd_recover, "presets": cmd_presets, "watch": cmd_watch,
+                "job": cmd_job}
+    try:
+        if args.command == "watch":
+            # No acaba nunca: se mide cada lote por separado (ver IngestWatcher), no el proceso entero.
+            return cmd_watch(args)
+        # Sin --metrics ni --profile (ni KAMBIOS_METRICS/KAMBIOS_PROFILE), recording no hace nada.
+        with metrics.recording(args.command, args.metrics, args.profile) as recorder:
+            code = commands[args.command](args)
+            if recorder:
+                recorder.ok = code == 0
+        return code
+    except (OSError, ValueError) as e:
+        print(f"❌ Error: {e}", file=sys.stderr)
+        return 1
 
 
 # --- Punto de entrada del programa ---
 if __name__ == "__main__":
     # Al parecer es convención empezar los archivos Python así, así que eso hice.
+    # Con argumentos va en modo por lotes; sin ellos, el menú interactivo de siempre.
+    if len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))
     try:
         main()
     except KeyboardInterrupt:
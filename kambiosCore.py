@@ -0,0 +1,1535 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+KAMBIOS - motor de renombrado
+Lógica compartida por la versión CLI y la GUI. No depende de PyQt6, así que se puede importar desde cualquier lado.
+"""
+
+import os                   # Interactuar con el sistema de archivos
+import json                 # Planes y deshacer en formato legible
+import time                 # Marcas de tiempo del deshacer y del diario
+import fnmatch              # Filtros tipo "*.zip" al escanear
+import re                   # Reconocer lo que ya está numerado
+import threading            # Renombres en paralelo (carpetas de red)
+import sys
+import errno
+import ctypes               # renameat2 (Linux), que os no trae
+import ctypes.util
+from collections import deque
+
+import kambiosMetrics as metrics  # Tiempos por fase (solo si la CLI o la GUI lo activan)
+
+
+# Archivo de deshacer de versiones anteriores (ahora se usa el historial, ver HISTORY_DIR)
+UNDO_FILE = ".kambios_undo.json"
+# Diario de la operación en curso (ver RenameJournal)
+JOURNAL_FILE = ".kambios_journal.jsonl"
+INTERNAL_FILES = (UNDO_FILE, JOURNAL_FILE)
+
+
+class FolderSnapshot:
+    """
+    Foto fija del contenido de una carpeta: solo archivos, en el orden en el que los devuelve el sistema.
+    Se escanea una vez y se reutiliza en todas las vistas previas hasta que alguien pida refrescarla.
+    """
+
+    def __init__(self, folder, names, inodes=None):
+        self.folder = folder
+        self.names = names
+        self.inodes = inodes   # {nombre: inodo}, solo si se pidió al escanear (lo usa el diario)
+        self._name_set = None  # Se construye solo si alguien pregunta "¿existe X?"
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        if self._name_set is None:
+            self._name_set = set(self.names)
+        return name in self._name_set
+
+    def filter(self, pattern=None, extensions=None):
+        """
+        Devuelve otra foto con solo los nombres que cumplen el filtro, sin volver a tocar el disco.
+        """
+        return FolderSnapshot(self.folder, [n for n in self.names if name_matches(n, pattern, extensions)])
+
+
+def normalize_extensions(extensions):
+    # Acepta "zip", ".zip" o ".ZIP" y lo deja todo como ".zip" para comparar rápido.
+    if not extensions:
+        return None
+    return tuple("." + e.lower().lstrip(".") for e in extensions)
+
+
+def name_matches(name, pattern, extensions):
+    # El filtro de scan_folder para un nombre suelto; extensions ya pasadas por normalize_extensions.
+    if extensions and not name.lower().endswith(extensions):
+        return False
+    if pattern and not fnmatch.fnmatch(name, pattern):
+        return False
+    return True
+
+
+def scan_folder(folder, pattern=None, extensions=None, inodes=False):
+    """
+    Escanea la carpeta una sola vez con os.scandir y devuelve un FolderSnapshot.
+    DirEntry.is_file() usa el tipo que ya viene en el listado, así que no hace falta un stat por archivo
+    (salvo en sistemas de archivos que no lo dan, donde Python hace el stat él solito).
+    El filtro por extensión o patrón glob se aplica mientras se escanea.
+    Los archivos propios de Kambios (deshacer, diario) no cuentan: no hay que renombrarlos.
+    Con inodes=True también guarda el inodo de cada archivo (en POSIX viene gratis en el listado).
+    """
+    names = []
+    ino = {} if inodes else None
+    with metrics.phase("scan") as phase:
+        for entry in iter_scan(folder, pattern, extensions):
+            names.append(entry.name)
+            if inodes:
+                ino[entry.name] = entry.inode()
+        phase.files = len(names)
+    return FolderSnapshot(folder, names, ino)
+
+
+def iter_scan(folder, pattern=None, extensions=None):
+    """
+    Lo mismo que scan_folder, pero va soltando los DirEntry de los archivos según los lee
+    (para quien quiera ir enseñando resultados o poder cancelar a mitad).
+    """
+    extensions = normalize_extensions(extensions)
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.name in INTERNAL_FILES:
+                continue
+            if entry.is_file() and name_matches(entry.name, pattern, extensions):
+                yield entry
+
+
+# --- Constructores de planes: (nombre_actual, nombre_propuesto) ---
+
+# Los planes que solo miran cada nombre por separado tienen versión iter_*, que va soltando los cambios
+# según lee los nombres: con un listado en streaming (iter_scan) no hace falta tener nada entero en memoria.
+
+def iter_number_plan(files, text):
+    # Numerar archivos: 0 - texto.ext, 1 - texto.ext,...
+    for i, filename in enumerate(files):
+        _, ext = os.path.splitext(filename)
+        new_name = f"{i} - {text}{ext}"
+        if filename != new_name:  # Evitar renombrar si no hay cambio.
+            yield filename, new_name
+
+
+def number_plan(files, text):
+    return list(iter_number_plan(files, text))
+
+
+def continue_number_plan(files, text, fill_gaps=False):
+    """
+    Como number_plan, pero sin tocar los archivos que ya se llaman "N - texto.ext": solo se numeran los nuevos,
+    a partir del número más alto (o rellenando los huecos, con fill_gaps). El plan y el deshacer crecen con
+    lo que ha llegado nuevo, no con el tamaño de la carpeta.
+    """
+    return Numbering(text, fill_gaps).plan(files)
+
+
+class Numbering:
+    """
+    Los números "N - texto" que ya están cogidos en una carpeta, para seguir numerando lo que va llegando.
+    plan(nombres) apunta los que ya están numerados y numera el resto con los siguientes números libres;
+    se puede llamar muchas veces (el modo vigilar le pasa solo los archivos nuevos de cada lote).
+    """
+
+    def __init__(self, text, fill_gaps=False):
+        self.text = text
+        self.fill_gaps = fill_gaps
+        self.used = set()   # Números que ya están cogidos (el "índice" de la numeración que hay)
+        self._numbered = re.compile(r"(\d+) - " + re.escape(text))
+        self._top = -1      # El número más alto cogido
+        self._low = 0       # Por debajo de aquí no queda ningún hueco (con fill_gaps)
+
+    def number_of(self, filename):
+        stem, _ = os.path.splitext(filename)
+        match = self._numbered.fullmatch(stem)
+        return int(match.group(1)) if match else None
+
+    def add_existing(self, files):
+        # Solo apunta los números que ya están cogidos, sin numerar nada (para empezar a vigilar una carpeta).
+        for filename in files:
+            number = self.number_of(filename)
+            if number is not None:
+                self._take(number)
+
+    def _take(self, i):
+        self.used.add(i)
+        self._top = max(self._top, i)
+
+    def _free_numbers(self):
+        i = self._low if self.fill_gaps else self._top + 1
+        while True:
+            if i not in self.used:
+                self._take(i)
+                if self.fill_gaps:
+                    self._low = i + 1
+                yield i
+            i += 1
+
+    def plan(self, files):
+        pending = []
+        for filename in files:
+            number = self.number_of(filename)
+            if number is not None:
+                self._take(number)
+            else:
+                pending.append(filename)
+        changes = []
+        for filename, i in zip(pending, self._free_numbers()):
+            _, ext = os.path.splitext(filename)
+            changes.append((filename, f"{i} - {self.text}{ext}"))
+        return changes
+
+
+def iter_full_replace_plan(files, text):
+    # Mismo nombre base para todos, conservando la extensión.
+    for filename in files:
+        _, ext = os.path.splitext(filename)
+        new_name = f"{text}{ext}"
+        if filename != new_name:
+            yield filename, new_name
+
+
+def full_replace_plan(files, text):
+    return list(iter_full_replace_plan(files, text))
+
+
+def iter_part_replace_plan(files, text_remove, text_replace):
+    # Reemplazar un trozo del nombre, solo en los archivos que lo contienen.
+    for filename in files:
+        if text_remove in filename:
+            new_name = filename.replace(text_remove, text_replace)
+            if filename != new_name:
+                yield filename, new_name
+
+
+def part_replace_plan(files, text_remove, text_replace):
+    return list(iter_part_replace_plan(files, text_remove, text_replace))
+
+
+def has_duplicates(changes):
+    """
+    True si dos archivos terminarían con el mismo nombre nuevo.
+    """
+    seen = set()
+    for _, new in changes:
+        if new in seen:
+            return True
+        seen.add(new)
+    return False
+
+
+def find_duplicates(changes):
+    """
+    Devuelve los nombres nuevos que aparecen más de una vez (vacío si no hay conflicto).
+    """
+    seen = set()
+    dups = set()
+    for _, new in changes:
+        if new in seen:
+            dups.add(new)
+        seen.add(new)
+    return sorted(dups)
+
+
+def summarize_plan(changes, head=5):
+    """
+    Resumen de un plan en una sola pasada: total, primeros y últimos N cambios y nombres duplicados.
+    Sirve para enseñar algo útil sin imprimir un millón de líneas en la terminal.
+    """
+    first = []
+    last = deque(maxlen=head)
+    seen = set()
+    dups = set()
+    count = 0
+    for old, new in changes:
+        if count < head:
+            first.append((old, new))
+        else:
+            last.append((old, new))
+        if new in seen:
+            dups.add(new)
+        seen.add(new)
+        count += 1
+    return {"count": count, "first": first, "last": list(last), "duplicates": sorted(dups)}
+
+
+# --- Archivos de plan (JSONL) ---
+# Primera línea: cabecera con la carpeta. Resto: una línea ["viejo", "nuevo"] por cambio.
+# Así se puede generar en una máquina y aplicar en otra, o más tarde, leyendo línea a línea.
+
+PLAN_FORMAT = "kambios_plan"
+
+
+def write_plan(f, folder, changes, tree=False):
+    """
+    Escribe el plan en el archivo abierto f, línea a línea. Devuelve cuántos cambios se escribieron.
+    Con tree=True es un plan de árbol (kambiosTree): los nombres llevan la ruta relativa a la carpeta.
+    """
+    header = {"format": PLAN_FORMAT, "version": 1, "folder": os.path.abspath(folder)}
+    if tree:
+        header["tree"] = True
+    f.write(json.dumps(header, ensure_ascii=False) + "\n")
+    count = 0
+    for old, new in changes:
+        f.write(json.dumps([old, new], ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def read_plan_header(f):
+    """
+    Lee y valida la cabecera de un plan. Lanza ValueError si no parece un plan de Kambios.
+    """
+    try:
+        header = json.loads(f.readline())
+    except json.JSONDecodeError:
+        header = None
+    if not isinstance(header, dict) or header.get("format") != PLAN_FORMAT:
+        raise ValueError("El archivo no es un plan de Kambios.")
+    return header
+
+
+def is_plain_name(name):
+    """
+    True si name es un nombre de archivo a secas: ni vacío, ni "." o "..", ni con separadores de ruta o NUL.
+    Un plan solo renombra dentro de su carpeta; "../x" o "sub/x" sacarían el archivo de ella.
+    """
+    return (isinstance(name, str) and name not in ("", ".", "..") and os.sep not in name
+            and not (os.altsep and os.altsep in name) and "\0" not in name)
+
+
+def _is_plan_path(name, tree):
+    # En un plan de árbol los nombres llevan delante la subcarpeta: cada trozo tiene que ser un nombre a secas.
+    if not tree or not isinstance(name, str):
+        return is_plain_name(name)
+    parts = name.replace(os.altsep, os.sep).split(os.sep) if os.altsep else name.split(os.sep)
+    return all(is_plain_name(part) for part in parts)
+
+
+def iter_plan(f, tree=False):
+    """
+    Recorre los cambios de un plan (después de la cabecera) sin cargarlo entero en memoria.
+    Lanza ValueError (con el número de línea) si un cambio no son dos nombres de archivo válidos.
+    tree: el plan es de árbol (cabecera "tree"), con la ruta relativa delante de cada nombre.
+    """
+    for line_no, line in enumerate(f, start=2):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            raise ValueError(f"Línea {line_no} del plan mal formada.")
+        if not isinstance(entry, list) or len(entry) != 2:
+            raise ValueError(f"Línea {line_no} del plan mal formada.")
+        for name in entry:
+            if not _is_plan_path(name, tree):
+                raise ValueError(f"Línea {line_no} del plan: {name!r} no es un nombre de archivo válido.")
+        yield entry[0], entry[1]
+
+
+# --- Ejecutor seguro: conflictos, cadenas y ciclos ---
+# Renombrar en el orden de la lista puede pisar archivos: si "1 - a.pdf" pasa a "0 - a.pdf" antes de que
+# "0 - a.pdf" se haya movido, en Linux el primero se come al segundo sin decir nada.
+# Como cada nombre nuevo es único, cada archivo tiene como mucho un "sucesor" y un "predecesor":
+# el plan se parte en cadenas (a→b→c→libre) y ciclos (a→b→a). Las cadenas se ejecutan de atrás
+# hacia delante y cada ciclo necesita exactamente un nombre temporal. Todo en tiempo lineal.
+
+class PlanConflictError(ValueError):
+    """
+    El plan no se puede aplicar tal cual. conflicts es una lista de (nombre, motivo).
+    """
+
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        super().__init__(f"{len(conflicts)} conflictos en el plan: " + ", ".join(
+            f"{name} ({reason})" for name, reason in conflicts[:5]))
+
+
+class Cancelled(Exception):
+    """
+    Alguien pidió cancelar. done tiene los cambios que sí se hicieron, como (original, actual).
+    En modo árbol, result es el TreeResult con lo que se hizo en cada carpeta hasta cancelar.
+    """
+
+    def __init__(self, done=(), result=None):
+        self.done = list(done)
+        self.result = result
+        super().__init__("Operación cancelada.")
+
+
+class RenameError(OSError):
+    """
+    Falló un renombre a mitad del plan. done tiene los cambios que sí se hicieron, como (original, actual).
+    """
+
+    def __init__(self, error, done, failures=None):
+        self.error = error
+        self.done = done
+        self.failures = failures or []  # (nombre, error) de cada archivo que falló (en paralelo puede ser más de uno)
+        super().__init__(str(error))
+
+
+def find_conflicts(changes, existing):
+    """
+    Comprueba el plan contra los archivos que hay en la carpeta (un FolderSnapshot o un set de nombres).
+    Devuelve una lista de (nombre, motivo): archivos que faltan, nombres duplicados, nombres nuevos
+    que ya existen en disco y que no se van a mover (que serían sobrescritos) y nombres nuevos que no son
+    un nombre de archivo (una ruta, "..", vacío...).
+    """
+    sources = {old for old, _ in changes}
+    conflicts = []
+    targets = set()
+    for old, new in changes:
+        if old not in existing:
+            conflicts.append((old, "no existe"))
+        if not is_plain_name(new):
+            conflicts.append((str(new), "nombre no válido"))
+        elif new in targets:
+            conflicts.append((new, "duplicado"))
+        elif new in existing and new not in sources:
+            conflicts.append((new, "ya existe"))
+        targets.add(new)
+    return conflicts
+
+
+TEMP_PREFIX = ".kambios_tmp_"
+
+
+# --- Renombrar sin pisar ---
+# os.rename con rutas absolutas resuelve la ruta entera dos veces por llamada, y pisa sin avisar a un archivo
+# que haya aparecido después de la vista previa. En Linux se abre la carpeta una vez y se renombra con
+# renameat2(RENAME_NOREPLACE) relativo a ese descriptor: si el destino ya existe, el núcleo lo dice (EEXIST)
+# en la misma llamada, sin comprobar antes y renombrar después. Si no se puede (glibc vieja, sistemas de archivos
+# que no lo soportan, otros sistemas), se cae a os.rename con dir_fd y una comprobación antes, como hasta ahora.
+
+RENAME_NOREPLACE = 1
+_renameat2 = None
+
+
+def _load_renameat2():
+    global _renameat2
+    if _renameat2 is None:
+        _renameat2 = False
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                func = libc.renameat2
+                func.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+                func.restype = ctypes.c_int
+                _renameat2 = func
+            except (OSError, AttributeError):
+                pass
+    return _renameat2 or None
+
+
+class DirRenamer:
+    """
+    Renombra archivos dentro de una carpeta sin pisar nunca uno que exista (FileExistsError si lo hay).
+    Se usa como context manager; se puede compartir entre hilos (el descriptor es de solo lectura).
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.fd = None
+        self.noreplace = _load_renameat2() is not None
+        if os.rename in os.supports_dir_fd and hasattr(os, "O_DIRECTORY"):
+            try:
+                self.fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+            except OSError:
+                self.fd = None
+        if self.fd is None:
+            self.noreplace = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def rename(self, src, dst):
+        metrics.count("rename")
+        if self.noreplace:
+            src_bytes, dst_bytes = os.fsencode(src), os.fsencode(dst)
+            # c_char_p corta en el primer NUL: "q\0.txt" acabaría como "q". os.rename lo rechaza; aquí igual.
+            if b"\0" in src_bytes or b"\0" in dst_bytes:
+                raise ValueError("embedded null byte")
+            if _renameat2(self.fd, src_bytes, self.fd, dst_bytes, RENAME_NOREPLACE) == 0:
+                return
+            err = ctypes.get_errno()
+            if err in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                self.noreplace = False  # Este sistema de archivos no lo soporta: plan B desde ya
+            elif err == errno.EEXIST and self._same_file(src, dst):
+                # Cambiar solo mayúsculas en un sistema que no las distingue: el "destino" es el propio archivo.
+                os.rename(src, dst, src_dir_fd=self.fd, dst_dir_fd=self.fd)
+                return
+            else:
+                raise OSError(err, os.strerror(err), src, None, dst)
+        if self.fd is None:
+            src, dst = os.path.join(self.folder, src), os.path.join(self.folder, dst)
+            if sys.platform != "win32" and os.path.lexists(dst) and not os.path.samefile(src, dst):
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), src, None, dst)
+            os.rename(src, dst)  # En Windows os.rename ya falla si el destino existe
+            return
+        if self._exists(dst) and not self._same_file(src, dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), src, None, dst)
+        os.rename(src, dst, src_dir_fd=self.fd, dst_dir_fd=self.fd)
+
+    def _exists(self, name):
+        try:
+            os.stat(name, dir_fd=self.fd, follow_symlinks=False)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _same_file(self, src, dst):
+        try:
+            a = os.stat(src, dir_fd=self.fd, follow_symlinks=False)
+            b = os.stat(dst, dir_fd=self.fd, follow_symlinks=False)
+        except OSError:
+            return False
+        return (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino)
+
+
+def _temp_name(taken, counter, existing=()):
+    # Nombre temporal que no choque con nada de la carpeta ni del plan.
+    while True:
+        name = f"{TEMP_PREFIX}{os.getpid()}_{counter[0]}"
+        counter[0] += 1
+        if name not in taken and name not in existing:
+            taken.add(name)
+            return name
+
+
+def order_renames(changes, existing=()):
+    """
+    Ordena el plan para que ningún renombre pise a un archivo que todavía no se ha movido.
+    Devuelve la lista de pasos (origen, destino) a ejecutar en orden, con un temporal por ciclo.
+    existing (la carpeta) solo se consulta con "in", sin copiarlo: el coste va con el plan, no con la carpeta.
+    """
+    dst_of = {}
+    for old, new in changes:
+        if old != new:
+            dst_of[old] = new
+    targeted = set(dst_of.values())
+    taken = set(dst_of) | targeted
+    counter = [0]
+    steps = []
+    visited = set()
+
+    # Cadenas: empiezan en un archivo que nadie quiere ocupar. Se recorren hacia delante y se ejecutan al revés.
+    for head in dst_of:
+        if head in targeted:
+            continue
+        path = []
+        node = head
+        while node in dst_of:
+            path.append(node)
+            visited.add(node)
+            node = dst_of[node]
+        for src in reversed(path):
+            steps.append((src, dst_of[src]))
+
+    # Lo que queda sin visitar son ciclos. Uno se aparta a un temporal, el resto se mueve y el temporal va al final.
+    for start in dst_of:
+        if start in visited:
+            continue
+        cycle = [start]
+        visited.add(start)
+        node = dst_of[start]
+        while node != start:
+            cycle.append(node)
+            visited.add(node)
+            node = dst_of[node]
+        temp = _temp_name(taken, counter, existing)
+        steps.append((start, temp))
+        for src in reversed(cycle[1:]):
+            steps.append((src, dst_of[src]))
+        steps.append((temp, dst_of[start]))
+
+    return steps
+
+
+def net_changes(steps):
+    """
+    Convierte una secuencia de pasos (con temporales incluidos) en cambios netos (original, final).
+    """
+    location = {}
+    origin_of = {}
+    for step in steps:
+        src, dst = step[0], step[1]
+        original = origin_of.pop(src, src)
+        location[original] = dst
+        origin_of[dst] = original
+    return [(orig, cur) for orig, cur in location.items() if orig != cur]
+
+
+def execute_plan(folder, changes, existing=None, journal=None, progress=None, cancel=None, workers=None):
+    """
+    Aplica el plan de forma segura: comprueba conflictos contra la carpeta, ordena y renombra.
+    existing es una foto de la carpeta (si no se da, se escanea ahora).
+    Si se da un RenameJournal, cada lote de pasos se apunta en él antes de ejecutarse; entonces también
+    se puede pasar progress(hechos, total) y cancel (un threading.Event) para ir informando y poder parar.
+    workers: renombres a la vez (ver rename_workers; None = en paralelo solo si la carpeta es de red).
+    Devuelve los cambios hechos como (original, nuevo). Si algo falla a mitad, lanza RenameError
+    con lo que sí se hizo, para poder guardar un deshacer exacto (y Cancelled si se canceló).
+    """
+    changes = [(old, new) for old, new in changes if old != new]
+    if existing is None:
+        existing = scan_folder(folder, inodes=journal is not None)
+    with metrics.phase("check", len(changes)):
+        conflicts = find_conflicts(changes, existing)
+    if conflicts:
+        raise PlanConflictError(conflicts)
+
+    with metrics.phase("order", len(changes)):
+        steps = order_renames(changes, existing)
+        if journal and getattr(existing, "inodes", None):
+            steps = with_inodes(steps, existing.inodes)
+    done = []
+    try:
+        with metrics.phase("rename", len(steps)):
+            if journal and can_run_parallel(steps) and rename_workers(folder, workers) > 1:
+                run_steps_parallel(folder, steps, journal, rename_workers(folder, workers), progress, cancel)
+                done = steps
+            elif journal:
+                run_steps(folder, steps, journal, progress, cancel)
+                done = steps
+            else:
+                with DirRenamer(folder) as renamer:
+                    for src, dst in steps:
+                        try:
+                            renamer.rename(src, dst)
+                        except Exception as e:   # Lo mismo que en _run_batch: no solo OSError
+                            raise RenameError(e, []) from e
+                        done.append((src, dst))
+    except RenameError as e:
+        # En paralelo lo hecho no es un prefijo de steps: viene ya en la excepción.
+        made = e.done or (done if journal is None else steps[:journal.steps_done])
+        raise RenameError(e.error, net_changes(made), e.failures) from e.error
+    except Cancelled as e:
+        raise Cancelled(net_changes(e.done or steps[:journal.steps_done]))
+    except OSError as e:
+        raise RenameError(e, net_changes(done)) from e
+    return net_changes(done)
+
+
+def with_inodes(steps, inodes):
+    """
+    Añade a cada paso el inodo del archivo que mueve: (origen, destino, inodo).
+    Con eso la recuperación sabe dónde está cada archivo aunque un ciclo deje los mismos nombres que al empezar.
+    """
+    at = dict(inodes)
+    result = []
+    for src, dst in steps:
+        ino = at.pop(src, 0)
+        at[dst] = ino
+        result.append((src, dst, ino))
+    return result
+
+
+def run_steps(folder, steps, journal, progress=None, cancel=None, total=None):
+    """
+    Ejecuta pasos (origen, destino) en orden, apuntándolos por lotes en el diario.
+    Si steps es una lista, el plan entero se apunta antes de empezar (un solo fsync), para poder
+    terminarlo si se corta. Si es un iterable cualquiera (un deshacer leído en streaming), cada lote
+    se apunta justo antes de ejecutarlo.
+    progress(hechos, total) se llama tras cada renombre. Si cancel (un threading.Event) se activa, se para
+    en el siguiente punto seguro (nunca con un archivo aparcado en un nombre temporal) y se lanza Cancelled.
+    Si falla un renombre, lanza RenameError; journal.steps_done dice cuántos pasos se hicieron.
+    """
+    with DirRenamer(folder) as renamer:
+        if isinstance(steps, list):
+            total = len(steps)
+            batches = [steps[i:i + journal.batch_size] for i in range(0, len(steps), journal.batch_size)]
+            for batch in batches:
+                journal.intent(batch, sync=False)
+            journal.sync()
+            for batch in batches:
+                _run_batch(renamer, batch, journal, progress, cancel, total)
+            return
+        batch = []
+        for step in steps:
+            batch.append(step)
+            if len(batch) >= journal.batch_size:
+                journal.intent(batch)
+                _run_batch(renamer, batch, journal, progress, cancel, total)
+                batch = []
+        if batch:
+            journal.intent(batch)
+            _run_batch(renamer, batch, journal, progress, cancel, total)
+
+
+def _run_batch(renamer, batch, journal, progress, cancel, total):
+    for step in batch:
+        src, dst = step[0], step[1]
+        if cancel is not None and cancel.is_set() and journal.temps_open == 0:
+            raise Cancelled()
+        try:
+            renamer.rename(src, dst)
+        except Exception as e:   # No solo OSError: un nombre imposible tampoco puede dejar el diario a medias
+            raise RenameError(e, []) from e
+        journal.steps_done += 1
+        if dst.startswith(TEMP_PREFIX):
+            journal.temps_open += 1
+        if src.startswith(TEMP_PREFIX):
+            journal.temps_open -= 1
+        if progress is not None:
+            progress(journal.steps_done, total)
+    journal.done(len(batch))
+
+
+# --- Renombres en paralelo (NFS/SMB) ---
+# En una carpeta de red cada os.rename es un viaje de ida y vuelta al servidor (varios ms), así que 50k
+# renombres en fila son minutos de esperar a la red. Los pasos que no comparten ningún nombre no dependen
+# unos de otros: cada cadena y cada ciclo del plan es un grupo que va en orden, y los grupos van a la vez.
+# En local no compensa (un rename son microsegundos y todos se pelean por el mismo directorio).
+
+RENAME_WORKERS = 16   # Renombres a la vez en carpetas de red
+NETWORK_FS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "glusterfs", "lustre",
+              "fuse.sshfs", "fuse.rclone", "fuse.davfs", "davfs")
+
+
+def is_network_fs(folder):
+    """
+    True si la carpeta está en un sistema de archivos de red (mirando /proc/self/mountinfo; fuera de Linux, False).
+    """
+    try:
+        with open("/proc/self/mountinfo", "r", encoding="utf-8") as f:
+            lines = f.readlines()
+    except OSError:
+        return False
+    path = os.path.realpath(folder)
+    best, fstype = "", None
+    for line in lines:
+        fields = line.split()
+        if " - " not in line or len(fields) < 5:
+            continue
+        # Los espacios del punto de montaje vienen como \040.
+        mount = fields[4].replace("\\040", " ")
+        if (path == mount or path.startswith(mount.rstrip("/") + "/")) and len(mount) > len(best):
+            best, fstype = mount, line.split(" - ", 1)[1].split()[0]
+    return fstype in NETWORK_FS
+
+
+def rename_workers(folder, workers=None):
+    # Cuántos renombres a la vez: los que se pidan, o automático (en paralelo solo en carpetas de red).
+    if workers is None:
+        return RENAME_WORKERS if is_network_fs(folder) else 1
+    return max(1, workers)
+
+
+def can_run_parallel(steps):
+    # En paralelo la recuperación tras un corte busca cada archivo por su inodo: sin inodos, en fila.
+    return bool(steps) and all(len(step) > 2 and step[2] for step in steps)
+
+
+def step_groups(steps):
+    """
+    Parte una lista de pasos (en un orden seguro) en grupos que no comparten ningún nombre: cada grupo
+    tiene que ir en orden, pero grupos distintos se pueden hacer a la vez. Devuelve listas de índices.
+    Los nombres se comparan sin mayúsculas, por si el recurso de red no las distingue.
+    """
+    parent = []
+    owner = {}
+
+    def find(group):
+        while parent[group] != group:
+            parent[group] = parent[parent[group]]
+            group = parent[group]
+        return group
+
+    step_group = []
+    for step in steps:
+        src, dst = step[0].casefold(), step[1].casefold()
+        a, b = owner.get(src), owner.get(dst)
+        if a is None and b is None:
+            group = len(parent)
+            parent.append(group)
+        elif a is None or b is None:
+            group = find(b if a is None else a)
+        else:
+            group, other = find(a), find(b)
+            if group != other:
+                parent[other] = group
+        owner[src] = owner[dst] = group
+        step_group.append(group)
+    groups = {}
+    for index, group in enumerate(step_group):
+        groups.setdefault(find(group), []).append(index)
+    return list(groups.values())
+
+
+def run_steps_parallel(folder, steps, journal, workers, progress=None, cancel=None):
+    """
+    Como run_steps, pero con varios renombres a la vez (un grupo de step_groups por hilo).
+    Todo el plan se apunta en el diario antes de empezar. Si un renombre falla (OSError), solo se para ese
+    grupo: el resto sigue, y al final se lanza RenameError con todos los fallos (failures) y lo hecho (done).
+    Cualquier otro error (un nombre imposible, un fallo de ctypes...) para todos los grupos en su siguiente
+    punto seguro y sale igual, como RenameError: que un hilo muera no puede parecer una cancelación.
+    Si se cancela, cada grupo para en su siguiente punto seguro y se lanza Cancelled.
+    Si no se hizo todo, el diario se reescribe con solo lo hecho, en un orden que se deshace sin problemas.
+    """
+    groups = step_groups(steps)
+    total = len(steps)
+    journal.parallel()
+    for start in range(0, total, journal.batch_size):
+        journal.intent(steps[start:start + journal.batch_size], sync=False)
+    journal.sync()
+
+    lock = threading.Lock()
+    pending = iter(enumerate(groups))
+    done = [0] * len(groups)
+    failures = []
+    broken = threading.Event()   # Un error inesperado: paran todos los grupos
+
+    def stopped():
+        return broken.is_set() or (cancel is not None and cancel.is_set())
+
+    def run_group(number, indices):
+        temps = 0
+        for count, index in enumerate(indices):
+            src, dst = steps[index][0], steps[index][1]
+            if stopped() and temps == 0:
+                return
+            try:
+                renamer.rename(src, dst)
+            except BaseException as e:
+                if not isinstance(e, OSError):
+                    broken.set()
+                if src.startswith(TEMP_PREFIX):
+                    # El archivo de un ciclo: se informa con su nombre original, no con el temporal.
+                    src = next(steps[i][0] for i in indices[:count] if steps[i][1] == src)
+                with lock:
+                    failures.append((src, e))
+                return
+            done[number] = count + 1
+            temps += dst.startswith(TEMP_PREFIX) - src.startswith(TEMP_PREFIX)
+            with lock:
+                journal.steps_done += 1
+                if progress is not None:
+                    progress(journal.steps_done, total)
+
+    def worker():
+        while not stopped():
+            with lock:
+                item = next(pending, None)
+            if item is None:
+                return
+            try:
+                run_group(*item)
+            except BaseException as e:   # Fuera del renombre (progress, el diario...): también para todos
+                broken.set()
+                number, indices = item
+                with lock:
+                    failures.append((steps[indices[min(done[number], len(indices) - 1)]][0], e))
+                return
+
+    with DirRenamer(folder) as renamer:
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(workers, len(groups)))]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            # Ctrl+C llega al hilo principal: los grupos paran en su punto seguro antes de seguir.
+            broken.set()
+            for thread in threads:
+                thread.join()
+            raise
+
+    if journal.steps_done == total and not failures:
+        return
+    finished = [steps[i] for number, indices in enumerate(groups) for i in indices[:done[number]]]
+    journal.rewrite(finished)
+    if failures:
+        raise RenameError(failures[0][1], finished, failures)
+    raise Cancelled(finished)
+
+
+# --- Diario de renombrado (write-ahead) ---
+# Antes de cada lote de renombres se apunta qué se va a hacer y se hace fsync; después se marca como hecho.
+# Si el programa muere a mitad (Ctrl+C, corte de luz, excepción), la próxima vez que se abra la carpeta
+# el diario dice qué estaba pasando y se puede revertir o terminar.
+# Un fsync por lote (y no por archivo): las marcas de "hecho" se sincronizan como mucho cada JOURNAL_SYNC_MS,
+# porque la recuperación no se fía de ellas a ciegas, sino que comprueba la carpeta.
+# Cuando la operación termina, el diario entero pasa a ser una entrada del historial de deshacer.
+
+JOURNAL_BATCH = 512       # Pasos por lote (un fsync por lote)
+JOURNAL_SYNC_MS = 200     # Cada cuánto, como mucho, se sincronizan las marcas de "hecho"
+
+
+class RenameJournal:
+    """
+    Diario de una operación de renombrado en curso. Se usa como context manager.
+    undo_of: si la operación es deshacer otra del historial, su número.
+    """
+
+    def __init__(self, folder, source, undo_of=None, batch_size=JOURNAL_BATCH, sync_ms=JOURNAL_SYNC_MS):
+        self.folder = folder
+        self.source = source
+        self.undo_of = undo_of
+        self.batch_size = batch_size
+        self.sync_ms = sync_ms
+        self.path = os.path.join(folder, JOURNAL_FILE)
+        self.steps_done = 0
+        self.steps_logged = 0
+        self.temps_open = 0    # Archivos aparcados ahora mismo en un nombre temporal (ciclos a medias)
+        self.op_id = None      # Número en el historial, una vez cerrada con commit()
+        self.timestamp = None
+        self._f = None
+        self._last_sync = 0.0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def open(self, resume=False):
+        if resume:
+            self._f = open(self.path, "a", encoding="utf-8")
+            return
+        if os.path.exists(self.path):
+            raise ValueError("Hay una operación interrumpida pendiente de recuperar en esta carpeta.")
+        self._f = open(self.path, "w", encoding="utf-8")
+        self.timestamp = time.time()
+        record = {"op": "begin", "source": self.source, "timestamp": self.timestamp}
+        if self.undo_of is not None:
+            record["undo_of"] = self.undo_of
+        self._write(record, sync=True)
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+
+    def discard(self):
+        # No se llegó a tocar nada: el diario sobra.
+        self.close()
+        os.remove(self.path)
+
+    def abort(self):
+        """
+        Tras un error inesperado (Ctrl+C, algo que no es un fallo de renombrar): mira en la carpeta qué pasos
+        se llegaron a hacer, los deshace y borra el diario. Si ni eso se puede, el diario se queda para recover.
+        """
+        self.close()
+        try:
+            recover_journal(self.folder, "rollback")
+        except Exception:
+            pass
+
+    def _write(self, record, sync=False):
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        now = time.monotonic()
+        if sync or (now - self._last_sync) * 1000 >= self.sync_ms:
+            self.sync()
+
+    def sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        metrics.count("fsync")
+        self._last_sync = time.monotonic()
+
+    def intent(self, steps, sync=True):
+        # Esto sí tiene que llegar al disco antes de tocar ningún archivo.
+        # "at" es la posición del primer paso del lote: así el historial se puede leer del final al principio.
+        # Cada paso es [origen, destino] o [origen, destino, inodo].
+        self._write({"op": "intent", "at": self.steps_logged, "steps": [list(step) for step in steps]}, sync=sync)
+        self.steps_logged += len(steps)
+
+    def done(self, count):
+        self._write({"op": "done", "steps": count})
+
+    def parallel(self):
+        # Los pasos que vienen se hacen en paralelo: al recuperar, lo hecho no es un prefijo (ver read_journal).
+        self._write({"op": "parallel"})
+
+    def rewrite(self, steps):
+        """
+        Cambia el diario por otro con solo estos pasos, todos hechos. Tras un paralelo a medias, lo hecho no es
+        un prefijo de lo apuntado; así el historial vuelve a ser una lista que se deshace de atrás hacia delante.
+        El cambio es atómico (os.replace): si se corta aquí, vale cualquiera de los dos diarios.
+        """
+        self.close()
+        history = os.path.join(self.folder, HISTORY_DIR)
+        os.makedirs(history, exist_ok=True)
+        tmp = os.path.join(history, ".journal.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            record = {"op": "begin", "source": self.source, "timestamp": self.timestamp}
+            if self.undo_of is not None:
+                record["undo_of"] = self.undo_of
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            for start in range(0, len(steps), self.batch_size):
+                batch = [list(step) for step in steps[start:start + self.batch_size]]
+                f.write(json.dumps({"op": "intent", "at": start, "steps": batch}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._f = open(self.path, "a", encoding="utf-8")
+        self.steps_logged = self.steps_done = len(steps)
+
+    def commit(self, count, keep=None):
+        """
+        Cierra la operación. Una operación normal pasa al historial de deshacer; un deshacer borra del
+        historial la operación que ha deshecho. count es el número de archivos que cambiaron de nombre.
+        """
+        with metrics.phase("history", self.steps_done):
+            try:
+                self._write({"op": "commit", "steps": self.steps_done, "count": count}, sync=True)
+                _fsync_dir(self.folder)
+                self.close()
+                self.op_id = _finish_journal(self.folder, self.undo_of, keep)
+            except BaseException:
+                # Si la marca de commit llegó al diario, abort solo lo pasa al historial; si no, lo deshace.
+                self.abort()
+                raise
+
+
+def _finish_journal(folder, undo_of, keep=None):
+    path = os.path.join(folder, JOURNAL_FILE)
+    if undo_of is None:
+        history = os.path.join(folder, HISTORY_DIR)
+        os.makedirs(history, exist_ok=True)
+        op_id = _next_history_id(folder)
+        os.rename(path, os.path.join(history, _segment_name(op_id)))
+        prune_history(folder, keep=HISTORY_KEEP if keep is None else keep)
+        return op_id
+    segment = os.path.join(folder, HISTORY_DIR, _segment_name(undo_of))
+    if os.path.exists(segment):
+        os.remove(segment)
+    os.remove(path)
+    return None
+
+
+def _fsync_dir(folder):
+    # Para que los renombres en sí también lleguen al disco. En Windows no se puede abrir una carpeta así.
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+        metrics.count("fsync")
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def apply_plan(folder, changes, source, existing=None, keep=None, progress=None, cancel=None, workers=None):
+    """
+    Aplica un plan con diario y lo deja en el historial de deshacer. Es lo que usan la CLI y la GUI.
+    Devuelve los cambios hechos; si falla un renombre lanza RenameError (y lo hecho ya se puede deshacer).
+    Si se cancela, lanza Cancelled, y lo hecho hasta ese momento también queda en el historial.
+    workers como en execute_plan (por defecto, en paralelo solo en carpetas de red).
+    """
+    with RenameJournal(folder, source) as journal:
+        try:
+            done = execute_plan(folder, changes, existing, journal=journal, progress=progress, cancel=cancel,
+                                workers=workers)
+        except PlanConflictError:
+            journal.discard()
+            raise
+        except (RenameError, Cancelled) as e:
+            # El programa sigue vivo y sabe qué se hizo: se cierra el diario con lo hecho, que se puede deshacer.
+            if e.done:
+                journal.commit(len(e.done), keep)
+            else:
+                journal.discard()
+            raise
+        except BaseException:
+            journal.abort()
+            raise
+        journal.commit(len(done), keep)
+    return done
+
+
+class PendingJournal:
+    """
+    Una operación interrumpida encontrada en la carpeta.
+    steps: todos los pasos apuntados. completed: cuántos se hicieron (None si la carpeta no cuadra con el diario).
+    undo_of: si lo interrumpido era un deshacer, el número de la operación que se estaba deshaciendo.
+    """
+
+    def __init__(self, folder, source, steps, committed, completed, undo_of=None):
+        self.folder = folder
+        self.source = source
+        self.steps = steps
+        self.committed = committed
+        self.completed = completed
+        self.undo_of = undo_of
+
+
+def _count_completed(steps, snapshot, confirmed=0):
+    """
+    Cuántos pasos (en orden) se llegaron a hacer, mirando la carpeta tal y como está ahora.
+    Si los pasos llevan inodo, se busca dónde está cada archivo y hasta qué punto de su recorrido llegó.
+    Si no (Windows, diarios viejos), se simula qué nombres existen tras cada paso y se busca el que
+    coincide con la carpeta, empezando por lo que las marcas de "hecho" ya confirman. Lineal en ambos casos.
+    """
+    if snapshot.inodes and steps and all(len(step) > 2 and step[2] for step in steps):
+        return _count_by_inode(steps, snapshot.inodes)
+
+    present = snapshot
+    state = {}
+    for step in steps:
+        state.setdefault(step[0], True)   # Lo primero que se ve de un nombre: si es origen, existía al empezar.
+        state.setdefault(step[1], False)
+    mismatches = sum(1 for name, here in state.items() if here != (name in present))
+    if mismatches == 0 and confirmed == 0:
+        return 0
+    for count, step in enumerate(steps, start=1):
+        for name, value in ((step[0], False), (step[1], True)):
+            if state[name] != value:
+                before = state[name] != (name in present)
+                state[name] = value
+                after = value != (name in present)
+                mismatches += after - before
+        if mismatches == 0 and count >= confirmed:
+            return count
+    return None
+
+
+def _inode_names(steps, inodes):
+    # Nombre actual de cada archivo del diario. Si alguno no está, la carpeta ha cambiado por otro lado.
+    name_of = {}
+    wanted = {step[2] for step in steps}
+    for name, ino in inodes.items():
+        if ino in wanted:
+            name_of[ino] = name
+    return name_of
+
+
+def _count_by_inode(steps, inodes, name_of=None):
+    if name_of is None:
+        name_of = _inode_names(steps, inodes)
+    reached = {}  # inodo -> índice del último paso suyo que ya se hizo
+    for index, (src, dst, ino) in enumerate(steps):
+        current = name_of.get(ino)
+        if current is None:
+            return None
+        if current == dst:
+            reached[ino] = index
+    done = set()
+    for index, (src, dst, ino) in enumerate(steps):
+        if index <= reached.get(ino, -1):
+            done.add(index)
+    count = len(done)
+    if done != set(range(count)):
+        return None  # Los pasos se hacen en orden: si no es un prefijo, algo no cuadra.
+    return count
+
+
+def _count_parallel(steps, inodes):
+    """
+    Para un diario en paralelo: cada grupo de step_groups llega hasta un punto distinto. Devuelve los pasos
+    reordenados (primero todo lo hecho, grupo a grupo; luego lo que falta) y cuántos se hicieron, así que
+    revertir o terminar funciona igual que con un diario normal. (pasos, None) si la carpeta no cuadra.
+    """
+    if not inodes or not can_run_parallel(steps):
+        return steps, None
+    name_of = _inode_names(steps, inodes)
+    finished = []
+    remaining = []
+    for indices in step_groups(steps):
+        group = [steps[i] for i in indices]
+        count = _count_by_inode(group, inodes, name_of)
+        if count is None:
+            return steps, None
+        finished += group[:count]
+        remaining += group[count:]
+    return finished + remaining, len(finished)
+
+
+def read_journal(folder):
+    """
+    Devuelve un PendingJournal si hay una operación interrumpida en la carpeta, o None si no hay.
+    """
+    path = os.path.join(folder, JOURNAL_FILE)
+    if not os.path.exists(path):
+        return None
+    source = None
+    undo_of = None
+    steps = []
+    confirmed = 0
+    committed = None
+    parallel = False
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break  # Última línea a medio escribir: lo que viene detrás no llegó a pasar.
+            op = record.get("op")
+            if op == "begin":
+                source = record.get("source")
+                undo_of = record.get("undo_of")
+            elif op == "intent":
+                steps.extend(tuple(step) for step in record["steps"])
+            elif op == "parallel":
+                parallel = True
+            elif op == "done":
+                confirmed += record.get("steps", 0)  # Si la marca llegó al archivo, el lote se hizo entero.
+            elif op == "commit":
+                committed = record["steps"]
+    if committed is not None:
+        return PendingJournal(folder, source, steps, True, committed, undo_of)
+    snapshot = scan_folder(folder, inodes=True)
+    if parallel:
+        steps, completed = _count_parallel(steps, snapshot.inodes)
+    else:
+        completed = _count_completed(steps, snapshot, confirmed)
+    return PendingJournal(folder, source, steps, False, completed, undo_of)
+
+
+def recover_journal(folder, mode):
+    """
+    Recupera una operación interrumpida. mode es "rollback" (dejarlo todo como estaba) o
+    "forward" (terminar lo que faltaba y guardarlo en el historial). Devuelve cuántos renombres se hicieron.
+    Si lo interrumpido era un deshacer, "forward" lo revierte y lo vuelve a lanzar entero.
+    """
+    pending = read_journal(folder)
+    if pending is None:
+        return 0
+    if pending.committed:
+        # Solo faltaba pasarlo al historial (o quitar del historial lo deshecho).
+        _finish_journal(folder, pending.undo_of)
+        return 0
+    if pending.completed is None:
+        raise ValueError("La carpeta ha cambiado desde la operación interrumpida y no se puede recuperar sola.")
+    if mode not in ("rollback", "forward"):
+        raise ValueError(f"Modo de recuperación desconocido: {mode}")
+    path = os.path.join(folder, JOURNAL_FILE)
+    count = 0
+    if mode == "rollback" or pending.undo_of is not None:
+        with DirRenamer(folder) as renamer:
+            for step in reversed(pending.steps[:pending.completed]):
+                renamer.rename(step[1], step[0])
+                count += 1
+        _fsync_dir(folder)
+        os.remove(path)
+        if mode == "forward":
+            count += undo_operation(folder, pending.undo_of, pending.source)
+        return count
+
+    journal = RenameJournal(folder, pending.source)
+    journal.open(resume=True)
+    journal.steps_done = pending.completed
+    try:
+        with DirRenamer(folder) as renamer:
+            for step in pending.steps[pending.completed:]:
+                renamer.rename(step[0], step[1])
+                journal.steps_done += 1
+                count += 1
+        journal.commit(len(net_changes(pending.steps)))
+    finally:
+        journal.close()
+    return count
+
+
+# --- Historial de deshacer ---
+# Cada operación terminada es un segmento JSONL en .kambios_history/NNNNNNNN.jsonl (el propio diario).
+# Acceso O(1) a cualquier operación por su número, y el deshacer lee el segmento del final al principio
+# por bloques: los pasos se deshacen en orden inverso, sin cargar la operación entera en memoria.
+# Como los pasos se hicieron en un orden seguro, deshacerlos al revés también es seguro (temporales incluidos).
+
+HISTORY_DIR = ".kambios_history"
+HISTORY_KEEP = 50          # Operaciones que se guardan por carpeta
+HISTORY_MAX_AGE_DAYS = None  # Sin límite de edad por defecto
+
+
+class HistoryEntry:
+    """
+    Una operación del historial: número, de dónde vino, cuándo y cuántos archivos cambió.
+    """
+
+    def __init__(self, op_id, path, source, timestamp, count):
+        self.id = op_id
+        self.path = path
+        self.source = source
+        self.timestamp = timestamp
+        self.count = count
+
+
+def _segment_name(op_id):
+    return f"{op_id:08d}.jsonl"
+
+
+def _history_ids(folder):
+    history = os.path.join(folder, HISTORY_DIR)
+    ids = []
+    try:
+        with os.scandir(history) as it:
+            for entry in it:
+                stem, ext = os.path.splitext(entry.name)
+                if ext == ".jsonl" and stem.isdigit():
+                    ids.append(int(stem))
+    except FileNotFoundError:
+        pass
+    return sorted(ids)
+
+
+def _next_history_id(folder):
+    ids = _history_ids(folder)
+    return ids[-1] + 1 if ids else 1
+
+
+def _reverse_lines(path, block_size=65536):
+    """
+    Lee las líneas de un archivo de la última a la primera, por bloques, sin cargarlo entero.
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        tail = b""
+        while pos > 0:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            lines = (f.read(size) + tail).split(b"\n")
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line.decode("utf-8")
+        if tail.strip():
+            yield tail.decode("utf-8")
+
+
+def read_history_entry(folder, op_id):
+    """
+    Cabecera de una operación del historial (primera y última línea del segmento), o None si no existe.
+    """
+    path = os.path.join(folder, HISTORY_DIR, _segment_name(op_id))
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            begin = json.loads(f.readline())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    commit = json.loads(next(_reverse_lines(path)))
+    return HistoryEntry(op_id, path, begin.get("source"), begin.get("timestamp"), commit.get("count", 0))
+
+
+def list_history(folder):
+    """
+    Operaciones que se pueden deshacer en la carpeta, de la más reciente a la más antigua.
+    """
+    _migrate_legacy_undo(folder)
+    entries = (read_history_entry(folder, op_id) for op_id in reversed(_history_ids(folder)))
+    return [e for e in entries if e is not None]
+
+
+def has_undo(folder):
+    """
+    True si hay algo que deshacer en la carpeta (sin leer ningún segmento).
+    """
+    return os.path.exists(os.path.join(folder, UNDO_FILE)) or bool(_history_ids(folder))
+
+
+def iter_undo_steps(path):
+    """
+    Pasos para deshacer una operación del historial, ya en orden (del último al primero), en streaming.
+    Cada paso es (actual, original) o (actual, original, inodo) si el segmento guardó inodos.
+    """
+    total = None
+    for line in _reverse_lines(path):
+        record = json.loads(line)
+        op = record.get("op")
+        if op == "commit":
+            total = record["steps"]
+        elif op == "intent":
+            if total is None:
+                raise ValueError("La operación del historial está incompleta.")
+            steps = record["steps"][:max(0, total - record["at"])]
+            for step in reversed(steps):
+                yield (step[1], step[0]) + tuple(step[2:])
+
+
+def _history_path(folder, op_id):
+    # Ruta del segmento de una operación (por defecto, la última). Lanza ValueError si no existe.
+    _migrate_legacy_undo(folder)
+    if op_id is None:
+        ids = _history_ids(folder)
+        if not ids:
+            raise ValueError("No hay operación previa para deshacer.")
+        op_id = ids[-1]
+    path = os.path.join(folder, HISTORY_DIR, _segment_name(op_id))
+    if not os.path.exists(path):
+        raise ValueError(f"La operación {op_id} no está en el historial.")
+    return op_id, path
+
+
+def validate_undo(folder, op_id=None, snapshot=None):
+    """
+    Comprueba de una vez si una operación del historial se puede deshacer, contra una sola foto de la carpeta
+    (nada de un os.path.exists por archivo). Simula los pasos del deshacer y devuelve todos los problemas
+    juntos como (nombre, motivo): archivos que ya no están y nombres originales ocupados por otro archivo.
+    """
+    op_id, path = _history_path(folder, op_id)
+    if snapshot is None:
+        snapshot = scan_folder(folder)
+    moved = {}  # Solo los nombres que el deshacer va tocando; el resto se mira en la foto.
+    problems = []
+    for step in iter_undo_steps(path):
+        src, dst = step[0], step[1]
+        if not moved.get(src, src in snapshot):
+            problems.append((src, "no existe"))
+        elif moved.get(dst, dst in snapshot):
+            problems.append((dst, "ya existe"))
+        # Se sigue simulando como si el paso se hubiera hecho, para no arrastrar errores en cadena.
+        moved[src] = False
+        moved[dst] = True
+    return problems
+
+
+def undo_operation(folder, op_id=None, source=None, skip_missing=False, progress=None, cancel=None, workers=None):
+    """
+    Deshace una operación del historial (por defecto, la última) y la borra del historial.
+    Antes de tocar nada se valida todo el deshacer contra una foto de la carpeta; si hay problemas se lanza
+    PlanConflictError con todos ellos y la carpeta queda intacta (nada de deshacer a medias).
+    Con skip_missing=True, los archivos que ya no están se saltan y el resto se deshace con el ejecutor seguro.
+    El deshacer también lleva diario: si se corta a mitad, se puede recuperar. Devuelve cuántos pasos se hicieron.
+    Si se cancela (cancel, un threading.Event) o algo falla a mitad, lo deshecho se vuelve a hacer, la
+    operación sigue en el historial tal cual y se lanza Cancelled (o el error). workers como en execute_plan.
+    """
+    op_id, path = _history_path(folder, op_id)
+    snapshot = scan_folder(folder, inodes=True)
+    with metrics.phase("validate"):
+        problems = validate_undo(folder, op_id, snapshot)
+    blocking = [p for p in problems if not skip_missing or p[1] != "no existe"]
+    if blocking:
+        raise PlanConflictError(problems)
+
+    total = read_history_entry(folder, op_id).count
+    with RenameJournal(folder, source, undo_of=op_id) as journal:
+        try:
+            if problems:
+                # Faltan archivos: el orden guardado ya no vale, así que se rehace el plan con lo que queda.
+                changes = [(cur, orig) for cur, orig in net_changes(iter_undo_steps(path)) if cur in snapshot]
+                done = execute_plan(folder, changes, snapshot, journal=journal, progress=progress, cancel=cancel,
+                                    workers=workers)
+                journal.commit(len(done))
+            else:
+                steps = iter_undo_steps(path)
+                workers = rename_workers(folder, workers)
+                if workers > 1:
+                    # En paralelo hace falta tener todos los pasos para agruparlos (en fila se leen en streaming).
+                    steps = list(steps)
+                with metrics.phase("rename", total):
+                    if workers > 1 and can_run_parallel(steps):
+                        run_steps_parallel(folder, steps, journal, workers, progress, cancel)
+                    else:
+                        run_steps(folder, steps, journal, progress, cancel, total)
+                journal.commit(journal.steps_done)
+        except Cancelled:
+            journal.abort()
+            raise Cancelled()
+        except BaseException:
+            # Nada de deshacer a medias: lo deshecho se vuelve a hacer y la operación sigue en el historial.
+            journal.abort()
+            raise
+    return journal.steps_done
+
+
+def prune_history(folder, keep=HISTORY_KEEP, max_age_days=HISTORY_MAX_AGE_DAYS):
+    """
+    Política de retención: se quedan las keep operaciones más recientes (None = sin límite) y, si se da
+    max_age_days, solo las que sean más nuevas que eso. Devuelve cuántas se borraron.
+    """
+    ids = _history_ids(folder)
+    evict = ids[:max(0, len(ids) - keep)] if keep is not None else []
+    if max_age_days is not None:
+        limit = time.time() - max_age_days * 86400
+        for op_id in ids:
+            if op_id in evict:
+                continue
+            entry = read_history_entry(folder, op_id)
+            if entry is not None and (entry.timestamp or 0) < limit:
+                evict.append(op_id)
+    for op_id in evict:
+        os.remove(os.path.join(folder, HISTORY_DIR, _segment_name(op_id)))
+    return len(evict)
+
+
+def save_undo_file(folder, changes, source, timestamp=None):
+    """
+    Guarda en el historial una operación ya hecha (cambios (original, nuevo)) para poder deshacerla.
+    Los pasos se ordenan como si se fueran a aplicar, así que deshacerlos al revés es seguro.
+    """
+    with metrics.phase("history", len(changes)):
+        steps = order_renames(changes)
+        history = os.path.join(folder, HISTORY_DIR)
+        os.makedirs(history, exist_ok=True)
+        path = os.path.join(history, _segment_name(_next_history_id(folder)))
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"op": "begin", "source": source, "timestamp": timestamp or time.time()},
+                               ensure_ascii=False) + "\n")
+            for at in range(0, len(steps), JOURNAL_BATCH):
+                batch = steps[at:at + JOURNAL_BATCH]
+                f.write(json.dumps({"op": "intent", "at": at, "steps": batch}, ensure_ascii=False) + "\n")
+            f.write(json.dumps({"op": "commit", "steps": len(steps), "count": len(changes)}) + "\n")
+    return path
+
+
+def _migrate_legacy_undo(folder):
+    # El .kambios_undo.json de versiones anteriores pasa al historial como una operación más.
+    legacy = os.path.join(folder, UNDO_FILE)
+    if not os.path.exists(legacy):
+        return
+    with open(legacy, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    changes = [(old, new) for new, old in data.get("renames", [])]
+    if changes:
+        save_undo_file(folder, changes, data.get("source"), data.get("timestamp"))
+    os.remove(legacy)
+
+
+# --- Búsqueda incremental para la vista previa en vivo ---
+
+class SubstringMatcher:
+    """
+    Qué nombres contienen un texto, recordando las últimas búsquedas.
+    Si el texto nuevo contiene al anterior (el usuario sigue escribiendo), solo se mira entre los que ya
+    coincidían; si vuelve a uno reciente (borra), se devuelve lo que ya se calculó.
+    """
+
+    def __init__(self, names, memory=16):
+        self.names = names
+        self.memory = memory
+        self._cache = {}   # patrón -> nombres que lo contienen (los dict guardan el orden de inserción)
+
+    def matching(self, pattern):
+        if pattern in self._cache:
+            matches = self._cache.pop(pattern)
+        else:
+            base = self.names
+            # El candidato más pequeño entre los patrones recordados que estén dentro del nuevo.
+            for previous, found in self._cache.items():
+                if previous in pattern and len(found) < len(base):
+                    base = found
+            matches = [name for name in base if pattern in name]
+        self._cache[pattern] = matches
+        if len(self._cache) > self.memory:
+            del self._cache[next(iter(self._cache))]
+        return matches
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+KAMBIOS - nombres canónicos desde un DAT
+Carga un DAT de No-Intro/Redump (XML tipo Logiqx), calcula CRC32 y SHA1 de cada archivo (y de lo que hay
+dentro de los .zip) y propone renombrarlo al nombre oficial. El plan sale como cualquier otro, así que
+pasa por la misma vista previa, diario y deshacer.
+
+Los hashes se guardan en una caché (sqlite) con la clave (dispositivo, inodo, tamaño, mtime): volver a
+pasar por una colección de 2 TB solo calcula lo nuevo o lo que ha cambiado. Lo que falta se calcula en
+varios procesos a la vez (hashlib y zlib sueltan el GIL, pero leer zips no).
+"""
+
+import os
+import json
+import mmap
+import zlib
+import hashlib
+import sqlite3
+import zipfile
+import xml.etree.ElementTree as ET
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import kambiosCore as core
+
+
+READ_BLOCK = 1024 * 1024   # Bloque al leer dentro de un zip
+HASH_CHUNK = 16            # Archivos por tarea del pool (para no pagar un viaje entre procesos por archivo)
+UNSAFE_CHARS = {"/", "\0", os.sep, os.altsep} - {None}   # No pueden ir en un nombre de archivo
+SAFE_CHAR = "_"            # Lo que se pone en su lugar
+
+
+# --- El DAT ---
+
+class DatIndex:
+    """
+    Las ROMs de un DAT indexadas por SHA1 y por (CRC32, tamaño), con el juego al que pertenecen.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.by_sha1 = {}
+        self.by_crc = {}
+        self.games = {}      # juego -> número de ROMs que tiene
+
+    def add(self, game, rom, size, crc, sha1):
+        entry = (game, rom, size)
+        if sha1:
+            self.by_sha1.setdefault(sha1.lower(), entry)
+        if crc:
+            self.by_crc.setdefault((crc.lower().zfill(8), size), entry)
+        self.games[game] = self.games.get(game, 0) + 1
+
+    def lookup(self, size, crc, sha1):
+        # El SHA1 manda; si el DAT no lo trae, CRC32 más el tamaño.
+        return self.by_sha1.get(sha1) or self.by_crc.get((crc, size))
+
+    def __len__(self):
+        return sum(self.games.values())
+
+
+def load_dat(path):
+    """
+    Lee el DAT en streaming (iterparse): los de Redump tienen decenas de miles de juegos.
+    Vale <game> y <machine>, como en los DAT de MAME.
+    """
+    index = DatIndex()
+    try:
+        for _, elem in ET.iterparse(path, events=("end",)):
+            if elem.tag == "name" and index.name is None:
+                index.name = (elem.text or "").strip() or None
+            elif elem.tag in ("game", "machine"):
+                game = elem.get("name")
+                for rom in elem.iter("rom"):
+                    size = rom.get("size")
+                    index.add(game, rom.get("name"), int(size) if size and size.isdigit() else None,
+                              rom.get("crc"), rom.get("sha1"))
+                elem.clear()
+    except ET.ParseError as e:
+        raise ValueError(f"El DAT no es un XML válido: {e}")
+    if not index.games:
+        raise ValueError("El DAT no tiene ningún juego (¿es un DAT de clrmamepro en texto?)")
+    return index
+
+
+# --- Hashes ---
+
+def hash_file(path):
+    """
+    [(miembro, tamaño, crc32, sha1)] de un archivo: uno solo con miembro None si es un archivo normal,
+    o uno por archivo de dentro si es un .zip. Los archivos normales van por mmap (sin copiar a Python).
+    """
+    if path.lower().endswith(".zip") and zipfile.is_zipfile(path):
+        return _hash_zip(path)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return [(None, 0, "00000000", hashlib.sha1().hexdigest())]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return [(None, size, f"{zlib.crc32(data):08x}", hashlib.sha1(data).hexdigest())]
+
+
+def _hash_zip(path):
+    result = []
+    with zipfile.ZipFile(path) as z:
+        for info in z.infolist():
+            if info.is_dir():
+                continue
+            crc = 0
+            sha1 = hashlib.sha1()
+            with z.open(info) as member:
+                for block in iter(lambda: member.read(READ_BLOCK), b""):
+                    crc = zlib.crc32(block, crc)
+                    sha1.update(block)
+            result.append((info.filename, info.file_size, f"{crc:08x}", sha1.hexdigest()))
+    return result
+
+
+def _hash_many(paths):
+    # Lo que corre en cada proceso del pool. Un archivo roto no tumba al resto del trozo.
+    results = []
+    for path in paths:
+        try:
+            results.append((path, hash_file(path), None))
+        except (OSError, zipfile.BadZipFile, RuntimeError, EOFError) as e:
+            results.append((path, None, str(e)))
+    return results
+
+
+# --- Caché persistente ---
+
+def default_cache_path():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "kambios", "hashes.sqlite")
+
+
+class HashCache:
+    """
+    (dispositivo, inodo, tamaño, mtime_ns) -> hashes. Si el archivo se toca o se sustituye, la clave cambia
+    y se vuelve a calcular; si solo se renombra (que es lo que hace Kambios), la clave se queda igual.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_cache_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                        "dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, entries TEXT, "
+                        "PRIMARY KEY (dev, ino, size, mtime))")
+
+    def get(self, key):
+        row = self.db.execute("SELECT entries FROM hashes WHERE dev=? AND ino=? AND size=? AND mtime=?",
+                              key).fetchone()
+        return [tuple(e) for e in json.loads(row[0])] if row else None
+
+    def put_many(self, items):
+        # Todo en una transacción: miles de inserts sueltos serían miles de fsync.
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                                [key + (json.dumps(entries),) for key, entries in items])
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def hash_folder(folder, files, cache=None, workers=None, progress=None, cancel=None):
+    """
+    Hashes de los archivos de la carpeta: {nombre: entradas}, más {nombre: error} de los que no se pudieron
+    leer. Lo que ya está en la caché no se vuelve a leer; el resto va al pool de procesos por trozos.
+    progress(hechos, total) y cancel (threading.Event) como en el motor.
+    """
+    own_cache = cache is None
+    cache = HashCache() if own_cache else cache
+    results = {}
+    errors = {}
+    keys = {}
+    missing = []
+    try:
+        for name in files:
+            path = os.path.join(folder, name)
+            try:
+                keys[path] = key = _stat_key(path)
+            except OSError as e:
+                errors[name] = str(e)
+                continue
+            entries = cache.get(key)
+            if entries is None:
+                missing.append(path)
+            else:
+                results[name] = entries
+        total = len(files)
+        done = total - len(missing)
+        if progress:
+            progress(done, total)
+        if not missing:
+            return results, errors
+
+        chunks = [missing[i:i + HASH_CHUNK] for i in range(0, len(missing), HASH_CHUNK)]
+        # "spawn" también en Linux: hacer fork desde la GUI (con hilos de Qt vivos) no es buena idea.
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            pending = {pool.submit(_hash_many, chunk) for chunk in chunks}
+            try:
+                while pending:
+                    finished, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                    if cancel is not None and cancel.is_set():
+                        raise core.Cancelled()
+                    fresh = []
+                    for future in finished:
+                        for path, entries, error in future.result():
+                            name = os.path.basename(path)
+                            if error is not None:
+                                errors[name] = error
+                                continue
+                            results[name] = entries
+                            fresh.append((keys[path], entries))
+                    # Se guarda según llega: si se cancela a mitad, lo calculado no se pierde.
+                    if fresh:
+                        cache.put_many(fresh)
+                    done += sum(len(f.result()) for f in finished)
+                    if progress:
+                        progress(done, total)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+        return results, errors
+    finally:
+        if own_cache:
+            cache.close()
+
+
+# --- El plan ---
+
+class DatReport:
+    """
+    Qué salió al comparar con el DAT: cuántos ya tenían el nombre bueno, cuáles no están en el DAT
+    y cuáles no se pudieron leer.
+    """
+
+    def __init__(self):
+        self.verified = 0
+        self.renamed = 0
+        self.unknown = []    # Nombres que no coinciden con nada del DAT
+        self.errors = []     # (nombre, error)
+
+
+def safe_name(name):
+    """
+    Un nombre del DAT listo para la carpeta: las barras y los \\0 pasan a SAFE_CHAR ("AC/DC" -> "AC_DC").
+    None si no queda un nombre de archivo ("", "." o "..").
+    """
+    for char in UNSAFE_CHARS:
+        name = name.replace(char, SAFE_CHAR)
+    return name if core.is_plain_name(name) else None
+
+
+def canonical_name(filename, entries, index):
+    """
+    Nombre oficial de un archivo según sus hashes, o None si no está en el DAT (o su nombre no vale aquí).
+    Un archivo suelto toma el nombre de la ROM; un .zip, el del juego si todo lo de dentro es de ese juego.
+    """
+    matches = [index.lookup(size, crc, sha1) for member, size, crc, sha1 in entries]
+    if not matches or None in matches:
+        return None
+    if entries[0][0] is None:
+        # Algunos DAT traen subcarpetas en el nombre de la ROM ("Disc 1\\pista.bin"): solo vale el archivo.
+        return safe_name(matches[0][1].replace("\\", "/").rsplit("/", 1)[-1])
+    games = {game for game, rom, size in matches}
+    if len(games) != 1:
+        return None
+    return safe_name(games.pop() + os.path.splitext(filename)[1])
+
+
+def dat_plan(folder, files, index, cache=None, workers=None, progress=None, cancel=None):
+    """
+    Plan para dejar cada archivo con su nombre del DAT, más un DatReport con lo que no cuadra.
+    """
+    hashes, errors = hash_folder(folder, files, cache=cache, workers=workers, progress=progress, cancel=cancel)
+    report = DatReport()
+    report.errors = sorted(errors.items())
+    changes = []
+    for filename in files:
+        entries = hashes.get(filename)
+        if entries is None:
+            continue
+        new_name = canonical_name(filename, entries, index)
+        if new_name is None:
+            report.unknown.append(filename)
+        elif new_name == filename:
+            report.verified += 1
+        else:
+            changes.append((filename, new_name))
+    report.renamed = len(changes)
+    return changes, report
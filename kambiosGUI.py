@@ -2,8 +2,9 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
-import json
 import time
+import heapq
+import threading
 
 os.environ["QT_QPA_PLATFORM_PLUGIN_PATH"] = ""
 os.environ["QT_QPA_PLATFORM"] = "xcb"
@@ -11,12 +12,201 @@ os.environ["QT_LOGGING_RULES"] = "*.debug=false;qt.qpa.plugin.debug=false;kf.kio
 
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,
-    QLabel, QLineEdit, QTextEdit, QFileDialog, QMessageBox, QGroupBox,
-    QTableWidget, QTableWidgetItem, QHeaderView
+    QLabel, QLineEdit, QFileDialog, QMessageBox, QGroupBox,
+    QTableView, QListView, QHeaderView, QAbstractItemView, QProgressBar,
+    QComboBox, QPlainTextEdit, QInputDialog, QCheckBox
 )
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import (
+    Qt, QAbstractTableModel, QAbstractListModel, QModelIndex,
+    QObject, QRunnable, QThreadPool, QTimer, QSocketNotifier, QFileSystemWatcher, pyqtSignal
+)
+
+import kambiosCore as core
+import kambiosWatch as watch
+import kambiosRules as rules
+import kambiosDAT as dat
+import kambiosMeta as meta
+import kambiosGroups as groups
+import kambiosTree as tree
+import kambiosMetrics as metrics
+
+
+# Modelos para las vistas: las filas se pintan bajo demanda (solo las visibles), sin crear un objeto por celda.
+# Ordenar y filtrar se hace sobre una lista de índices, así que el plan en sí no se copia nunca.
+
+class PlanTableModel(QAbstractTableModel):
+    HEADERS = ("Original", "Nuevo")
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._plan = []
+        self._rows = None        # Índices visibles (None = todos, en orden)
+        self._filter = ""
+        self._sort = None        # (columna, descendente)
+
+    def set_plan(self, plan):
+        self.beginResetModel()
+        self._plan = plan
+        self._rebuild()
+        self.endResetModel()
+
+    def append_rows(self, rows):
+        # Para ir enseñando el plan según llega del hilo de trabajo. Con filtro u orden solo se miran las
+        # filas nuevas: las que pasan el filtro se ordenan y se mezclan con las que ya había.
+        start = len(self._plan)
+        if self._rows is None:
+            self.beginInsertRows(QModelIndex(), start, start + len(rows) - 1)
+            self._plan.extend(rows)
+            self.endInsertRows()
+            return
+        self._plan.extend(rows)
+        new = self._select(range(start, len(self._plan)))
+        if not new:
+            return
+        if self._sort is None:
+            first = len(self._rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(new) - 1)
+            self._rows.extend(new)
+            self.endInsertRows()
+            return
+        key, descending = self._sort_key()
+        new.sort(key=key, reverse=descending)
+        self.beginResetModel()
+        self._rows = list(heapq.merge(self._rows, new, key=key, reverse=descending))
+        self.endResetModel()
+
+    def set_filter(self, text):
+        self.beginResetModel()
+        self._filter = text.lower()
+        self._rebuild()
+        self.endResetModel()
+
+    def _select(self, indices):
+        # Los índices que pasan el filtro (todos si no hay).
+        if not self._filter:
+            return list(indices)
+        needle = self._filter
+        plan = self._plan
+        return [i for i in indices if needle in plan[i][0].lower() or needle in plan[i][1].lower()]
+
+    def _sort_key(self):
+        column, descending = self._sort
+        plan = self._plan
+        return (lambda i: plan[i][column].lower()), descending
+
+    def _rebuild(self):
+        rows = self._select(range(len(self._plan))) if self._filter else None
+        if self._sort is not None:
+            key, descending = self._sort_key()
+            rows = sorted(range(len(self._plan)) if rows is None else rows, key=key, reverse=descending)
+        self._rows = rows
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._plan) if self._rows is None else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 2
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role not in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.ToolTipRole) or not index.isValid():
+            return None
+        row = index.row() if self._rows is None else self._rows[index.row()]
+        return self._plan[row][index.column()]
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        self.layoutAboutToBeChanged.emit()
+        self._sort = (column, order == Qt.SortOrder.DescendingOrder)
+        self._rebuild()
+        self.layoutChanged.emit()
+
+
+class FileListModel(QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._names = []
+
+    def set_names(self, names):
+        self.beginResetModel()
+        self._names = names
+        self.endResetModel()
+
+    def append_names(self, names):
+        start = len(self._names)
+        self.beginInsertRows(QModelIndex(), start, start + len(names) - 1)
+        self._names.extend(names)
+        self.endInsertRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._names)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and index.isValid():
+            return self._names[index.row()]
+        return None
+
+
+# Trabajo en segundo plano: escanear, previsualizar, aplicar y deshacer van en un QThreadPool para que la
+# ventana no se congele (en un SMB, 20k renombres son minutos). Los resultados vuelven por señales.
 
-UNDO_FILE = ".kambios_undo.json"
+class TaskSignals(QObject):
+    chunk = pyqtSignal(object)          # Un trozo de resultados (nombres o filas del plan)
+    progress = pyqtSignal(int, int)     # (hechos, total); total 0 si no se sabe
+    finished = pyqtSignal(object)       # Lo que devolvió la función
+    failed = pyqtSignal(object)         # La excepción (core.Cancelled si se canceló)
+
+
+class Task(QRunnable):
+    """
+    Ejecuta fn(task) en un hilo del pool. Desde fn se puede llamar a task.report(hechos, total),
+    task.emit_chunk(lista) y mirar task.cancel (un threading.Event) para parar.
+    """
+
+    PROGRESS_INTERVAL = 0.1  # Segundos entre avisos de progreso, para no inundar la cola de eventos
+
+    def __init__(self, fn):
+        super().__init__()
+        self.fn = fn
+        self.signals = TaskSignals()
+        self.cancel = threading.Event()
+        self._last_report = 0.0
+
+    def report(self, done, total=0):
+        now = time.monotonic()
+        if now - self._last_report >= self.PROGRESS_INTERVAL or (total and done >= total):
+            self._last_report = now
+            self.signals.progress.emit(done, total or 0)
+
+    def emit_chunk(self, items):
+        if items:
+            self.signals.chunk.emit(items)
+
+    def check_cancel(self):
+        if self.cancel.is_set():
+            raise core.Cancelled()
+
+    def run(self):
+        # Con KAMBIOS_METRICS o KAMBIOS_PROFILE, cada tarea se mide; la operación es la función que la lanzó
+        # ("apply_renames", "run_preview"...), sacada del nombre de fn.
+        operation = self.fn.__qualname__.split(".<locals>")[0].rsplit(".", 1)[-1]
+        try:
+            with metrics.recording(operation):
+                result = self.fn(self)
+        except Exception as e:
+            self.signals.failed.emit(e)
+            return
+        self.signals.finished.emit(result)
+
+
+CHUNK_SIZE = 5000  # Filas por trozo al ir mandando resultados a la vista
+LIVE_DELAY_MS = 250  # Espera tras la última tecla antes de recalcular la vista previa en vivo
+WATCH_DELAY_MS = 150  # Los cambios de la carpeta se agrupan durante este rato antes de repintar
 
 
 class KambiosGUI(QWidget):
@@ -26,10 +216,40 @@ class KambiosGUI(QWidget):
         self.resize(750, 650)
         self.folder_path = ""
         self.rename_plan = []
+        self.snapshot = None
         self.undo_available = False
+        self.task = None
+        self.task_started = 0.0
+        self.pool = QThreadPool.globalInstance()
+        self.matcher = None       # Búsqueda incremental sobre la foto de la carpeta
+        self.live_mode = None     # Qué acción se está escribiendo ("number", "full", "part" o "rules")
+        self.cache = None         # watch.DirCache de la carpeta (con inotify)
+        self.notifier = None      # Avisa cuando el inotify tiene eventos
+        self.fs_watcher = None    # Sin inotify: QFileSystemWatcher y volver a listar
+        self.meta_reader = None   # Metadatos para las plantillas (se queda en memoria mientras no cambie la carpeta)
+        self.meta_snapshot = None # Foto de la carpeta con la que se leyeron por última vez
+        self.tree_plan = None     # Con "Incluir subcarpetas": los planes de cada carpeta (tree.TreePlan)
 
         self.init_ui()
 
+        # Vista previa en vivo: cada tecla reinicia el temporizador, y al parar de escribir se recalcula
+        # contra la foto en memoria (sin tocar el disco hasta aplicar).
+        self.live_timer = QTimer(self)
+        self.live_timer.setSingleShot(True)
+        self.live_timer.setInterval(LIVE_DELAY_MS)
+        self.live_timer.timeout.connect(self.live_preview)
+        self.num_text.textChanged.connect(lambda: self.schedule_live("number"))
+        self.full_text.textChanged.connect(lambda: self.schedule_live("full"))
+        self.part_remove.textChanged.connect(lambda: self.schedule_live("part"))
+        self.part_replace.textChanged.connect(lambda: self.schedule_live("part"))
+        self.rules_text.textChanged.connect(lambda: self.schedule_live("rules"))
+
+        # Cambios en la carpeta (nuestros o de otro programa): se acumulan y se repinta una vez por ráfaga.
+        self.watch_timer = QTimer(self)
+        self.watch_timer.setSingleShot(True)
+        self.watch_timer.setInterval(WATCH_DELAY_MS)
+        self.watch_timer.timeout.connect(self.refresh_from_watch)
+
     def init_ui(self):
         layout = QVBoxLayout()
 
@@ -42,20 +262,27 @@ class KambiosGUI(QWidget):
         folder_layout.addWidget(self.folder_label)
         folder_layout.addWidget(self.folder_line)
         folder_layout.addWidget(self.folder_button)
+        self.tree_check = QCheckBox("Incluir subcarpetas")
+        self.tree_check.setToolTip("Un plan por carpeta, aplicado en paralelo y deshecho todo junto")
+        self.tree_check.toggled.connect(self.on_tree_toggled)
+        folder_layout.addWidget(self.tree_check)
         layout.addLayout(folder_layout)
 
         # Vista previa de archivos actuales
         self.preview_label = QLabel("Archivos actuales:")
-        self.preview_text = QTextEdit()
-        self.preview_text.setReadOnly(True)
-        self.preview_text.setMaximumHeight(80)
+        self.file_model = FileListModel(self)
+        self.file_list = QListView()
+        self.file_list.setModel(self.file_model)
+        self.file_list.setUniformItemSizes(True)  # Con esto no mide cada fila: clave con 100k archivos
+        self.file_list.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.file_list.setMaximumHeight(100)
         layout.addWidget(self.preview_label)
-        layout.addWidget(self.preview_text)
+        layout.addWidget(self.file_list)
 
         # Botón de deshacer
         self.undo_button = QPushButton("↩️ Deshacer último cambio")
         self.undo_button.setEnabled(False)
-        self.undo_button.clicked.connect(self.undo_last_rename)
+        self.undo_button.clicked.connect(lambda: self.undo_last_rename())
         layout.addWidget(self.undo_button)
 
         # Acciones
@@ -65,10 +292,27 @@ class KambiosGUI(QWidget):
         num_group = QGroupBox("1. Numerar archivos")
         num_layout = QHBoxLayout()
         self.num_text = QLineEdit()
-        self.num_text.setPlaceholderText("Texto después del número (ej: Factura)")
+        self.num_text.setPlaceholderText("Texto después del número (ej: Factura) o plantilla: {date:%Y%m%d}_{n:04}{ext}")
+        self.num_text.setToolTip("Campos de plantilla: " + ", ".join("{%s}" % f for f in meta.FIELDS))
+        self.num_sort = QComboBox()
+        self.num_sort.addItem("Orden del listado", None)
+        for key, label in (("name", "Por nombre"), ("mtime", "Por fecha de modificación"),
+                           ("date", "Por fecha (EXIF)"), ("size", "Por tamaño"), ("duration", "Por duración")):
+            self.num_sort.addItem(label, key)
+        self.num_sort.currentIndexChanged.connect(lambda: self.schedule_live("number"))
+        self.num_continue = QCheckBox("Solo nuevos")
+        self.num_continue.setToolTip("Deja como están los que ya se llaman 'N - texto' y sigue desde el más alto")
+        self.num_fill_gaps = QCheckBox("Rellenar huecos")
+        self.num_fill_gaps.setEnabled(False)
+        self.num_continue.toggled.connect(self.num_fill_gaps.setEnabled)
+        self.num_continue.toggled.connect(lambda: self.schedule_live("number"))
+        self.num_fill_gaps.toggled.connect(lambda: self.schedule_live("number"))
         self.num_preview_button = QPushButton("Vista previa")
         self.num_preview_button.clicked.connect(self.preview_number)
         num_layout.addWidget(self.num_text)
+        num_layout.addWidget(self.num_sort)
+        num_layout.addWidget(self.num_continue)
+        num_layout.addWidget(self.num_fill_gaps)
         num_layout.addWidget(self.num_preview_button)
         num_group.setLayout(num_layout)
         layout.addWidget(num_group)
@@ -77,7 +321,7 @@ class KambiosGUI(QWidget):
         full_group = QGroupBox("2. Reemplazar nombre completo")
         full_layout = QHBoxLayout()
         self.full_text = QLineEdit()
-        self.full_text.setPlaceholderText("Nuevo nombre base (ej: documento)")
+        self.full_text.setPlaceholderText("Nuevo nombre base (ej: documento, o 'Serie - S01E{n:02}' para uno por vídeo)")
         self.full_preview_button = QPushButton("Vista previa")
         self.full_preview_button.clicked.connect(self.preview_full_replace)
         full_layout.addWidget(self.full_text)
@@ -100,14 +344,77 @@ class KambiosGUI(QWidget):
         part_group.setLayout(part_layout)
         layout.addWidget(part_group)
 
+        # 4. Varias reglas en una pasada (un solo plan y un solo deshacer)
+        rules_group = QGroupBox("4. Varias reglas a la vez")
+        rules_layout = QVBoxLayout()
+        rules_top = QHBoxLayout()
+        self.preset_combo = QComboBox()
+        self.preset_combo.currentIndexChanged.connect(self.load_preset)
+        self.save_preset_button = QPushButton("Guardar preset...")
+        self.save_preset_button.clicked.connect(self.save_preset)
+        self.rules_preview_button = QPushButton("Vista previa")
+        self.rules_preview_button.clicked.connect(self.preview_rules)
+        rules_top.addWidget(QLabel("Preset:"))
+        rules_top.addWidget(self.preset_combo, 1)
+        rules_top.addWidget(self.save_preset_button)
+        rules_top.addWidget(self.rules_preview_button)
+        self.rules_text = QPlainTextEdit()
+        self.rules_text.setPlaceholderText("Una regla por línea, ej:\nlit (USA) =>\nre \\(Rev (\\d+)\\) => v\\1\nsqueeze")
+        self.rules_text.setMaximumHeight(80)
+        rules_layout.addLayout(rules_top)
+        rules_layout.addWidget(self.rules_text)
+        rules_group.setLayout(rules_layout)
+        layout.addWidget(rules_group)
+        self.refresh_presets()
+
+        # 5. Nombres oficiales según un DAT (comprobando los hashes)
+        dat_group = QGroupBox("5. Nombres oficiales desde un DAT (No-Intro/Redump)")
+        dat_layout = QHBoxLayout()
+        self.dat_line = QLineEdit()
+        self.dat_line.setPlaceholderText("Archivo .dat")
+        self.dat_button = QPushButton("Elegir DAT...")
+        self.dat_button.clicked.connect(self.select_dat)
+        self.dat_preview_button = QPushButton("Vista previa")
+        self.dat_preview_button.clicked.connect(self.preview_dat)
+        dat_layout.addWidget(self.dat_line)
+        dat_layout.addWidget(self.dat_button)
+        dat_layout.addWidget(self.dat_preview_button)
+        dat_group.setLayout(dat_layout)
+        layout.addWidget(dat_group)
+
         # Tabla de vista previa
-        layout.addWidget(QLabel("\nVista previa de cambios:"))
-        self.preview_table = QTableWidget(0, 2)
-        self.preview_table.setHorizontalHeaderLabels(["Original", "Nuevo"])
+        preview_header = QHBoxLayout()
+        preview_header.addWidget(QLabel("\nVista previa de cambios:"))
+        self.live_status = QLabel("")
+        preview_header.addWidget(self.live_status)
+        self.preview_filter = QLineEdit()
+        self.preview_filter.setPlaceholderText("Filtrar...")
+        self.preview_filter.textChanged.connect(self.filter_preview)
+        preview_header.addWidget(self.preview_filter)
+        layout.addLayout(preview_header)
+        self.plan_model = PlanTableModel(self)
+        self.preview_table = QTableView()
+        self.preview_table.setModel(self.plan_model)
         self.preview_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
-        self.preview_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        # Filas de altura fija y sin cabecera vertical: la vista no tiene que medir nada fila a fila.
+        self.preview_table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.preview_table.verticalHeader().setVisible(False)
+        self.preview_table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.preview_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.preview_table.setSortingEnabled(True)
         layout.addWidget(self.preview_table)
 
+        # Progreso de la tarea en segundo plano
+        progress_layout = QHBoxLayout()
+        self.progress_bar = QProgressBar()
+        self.status_label = QLabel("")
+        self.cancel_button = QPushButton("Cancelar")
+        self.cancel_button.clicked.connect(self.cancel_task)
+        progress_layout.addWidget(self.progress_bar)
+        progress_layout.addWidget(self.status_label)
+        progress_layout.addWidget(self.cancel_button)
+        layout.addLayout(progress_layout)
+
         # Botón aplicar
         self.apply_button = QPushButton("✅ Aplicar cambios")
         self.apply_button.setEnabled(False)
@@ -115,6 +422,7 @@ class KambiosGUI(QWidget):
         layout.addWidget(self.apply_button)
 
         self.setLayout(layout)
+        self.set_busy(False)
 
     def select_folder(self):
         folder = QFileDialog.getExistingDirectory(
@@ -125,20 +433,232 @@ class KambiosGUI(QWidget):
         if folder:
             self.folder_path = folder
             self.folder_line.setText(folder)
-            self.update_file_list()
+            self.start_watching(folder)
             self.check_undo_file()
+            self.update_file_list()
+
+    # Tareas en segundo plano
+
+    def start_task(self, label, fn, on_done, on_chunk=None, on_error=None):
+        # Solo una tarea a la vez: mientras tanto, los botones que tocan la carpeta están desactivados.
+        if self.task is not None:
+            return False
+        task = Task(fn)
+        task.signals.progress.connect(self.on_task_progress)
+        if on_chunk:
+            task.signals.chunk.connect(on_chunk)
+        task.signals.finished.connect(lambda result: self.end_task(on_done, result))
+        task.signals.failed.connect(lambda error: self.end_task(on_error or self.on_task_error, error))
+        self.task = task
+        self.task_started = time.monotonic()
+        self.status_label.setText(label)
+        self.progress_bar.setRange(0, 0)  # "Ocupado" hasta que llegue el primer total
+        self.set_busy(True)
+        self.pool.start(task)
+        return True
+
+    def end_task(self, handler, value):
+        self.task = None
+        self.set_busy(False)
+        handler(value)
+
+    def cancel_task(self):
+        if self.task is not None:
+            self.task.cancel.set()
+            self.status_label.setText("Cancelando...")
+
+    def set_busy(self, busy):
+        self.progress_bar.setVisible(busy)
+        self.cancel_button.setVisible(busy)
+        if not busy:
+            self.status_label.setText("")
+        for button in (self.folder_button, self.num_preview_button, self.full_preview_button,
+                       self.part_preview_button, self.rules_preview_button, self.dat_preview_button):
+            button.setEnabled(not busy)
+        if busy:
+            self.apply_button.setEnabled(False)
+            self.undo_button.setEnabled(False)
+        else:
+            self.apply_button.setEnabled(bool(self.rename_plan))
+            self.undo_button.setEnabled(self.undo_available)
+
+    def on_task_progress(self, done, total):
+        elapsed = max(time.monotonic() - self.task_started, 1e-6)
+        rate = done / elapsed
+        if total:
+            self.progress_bar.setRange(0, total)
+            self.progress_bar.setValue(done)
+            eta = (total - done) / rate if rate else 0
+            self.status_label.setText(f"{done}/{total} · {rate:.0f}/s · quedan {eta:.0f} s")
+        else:
+            self.status_label.setText(f"{done} · {rate:.0f}/s")
+
+    def on_task_error(self, error):
+        if isinstance(error, core.Cancelled):
+            self.show_info("Cancelado", "Operación cancelada.")
+        else:
+            self.show_error(f"Error:\n{str(error)}")
 
     def update_file_list(self):
+        # Escanea una vez y guarda la foto: las vistas previas la reutilizan sin volver al disco.
+        # El listado va llegando por trozos, así que la lista se va llenando mientras tanto.
+        folder = self.folder_path
+        self.snapshot = None
+        self.matcher = None
+        if self.cache is not None:
+            self.cache.invalidate()
+        self.file_model.set_names([])
+        self.preview_label.setText("Archivos actuales: leyendo...")
+
+        def scan(task):
+            names = []
+            sent = 0
+            for entry in core.iter_scan(folder):
+                names.append(entry.name)
+                if len(names) - sent >= CHUNK_SIZE:
+                    task.check_cancel()
+                    task.emit_chunk(names[sent:])
+                    sent = len(names)
+                    task.report(sent)
+            task.emit_chunk(names[sent:])
+            return core.FolderSnapshot(folder, names)
+
+        def done(snapshot):
+            if self.cache is not None and self.cache.folder == folder:
+                # Lo que haya cambiado mientras se listaba se aplica encima; desde aquí, todo por eventos.
+                self.cache.reset(snapshot.names)
+                self.cache.update()
+                self.show_snapshot(self.cache.snapshot())
+            else:
+                self.show_snapshot(snapshot, reset_list=False)
+
+        def failed(error):
+            self.preview_label.setText("Archivos actuales:")
+            if not isinstance(error, core.Cancelled):
+                self.show_error(f"No se pudo leer la carpeta:\n{str(error)}")
+
+        self.start_task("Leyendo carpeta...", scan, done, on_chunk=self.file_model.append_names, on_error=failed)
+
+    def show_snapshot(self, snapshot, reset_list=True):
+        self.snapshot = snapshot
+        self.matcher = core.SubstringMatcher(snapshot.names)
+        if reset_list:
+            self.file_model.set_names(snapshot.names)
+        files = snapshot.names
+        self.preview_label.setText(f"Archivos actuales: {len(files)}" if files else "Archivos actuales: (carpeta vacía)")
+
+    # Vigilar la carpeta
+
+    def start_watching(self, folder):
+        self.stop_watching()
+        if watch.inotify_available():
+            try:
+                cache = watch.DirCache(folder)
+                cache.start()
+            except OSError:
+                cache = None  # Sin permisos o sin watches libres: se usa el plan B
+            if cache is not None:
+                self.cache = cache
+                self.notifier = QSocketNotifier(cache.fileno(), QSocketNotifier.Type.Read, self)
+                self.notifier.activated.connect(self.on_folder_events)
+                return
+        # Plan B: Qt solo dice "algo cambió", así que hay que volver a listar (agrupando los avisos).
+        self.fs_watcher = QFileSystemWatcher([folder], self)
+        self.fs_watcher.directoryChanged.connect(lambda path: self.watch_timer.start())
+
+    def stop_watching(self):
+        self.watch_timer.stop()
+        if self.notifier is not None:
+            self.notifier.setEnabled(False)
+            self.notifier.deleteLater()
+            self.notifier = None
+        if self.cache is not None:
+            self.cache.stop()
+            self.cache = None
+        if self.fs_watcher is not None:
+            self.fs_watcher.deleteLater()
+            self.fs_watcher = None
+
+    def on_folder_events(self):
+        # Los eventos se leen ya (si no, el aviso se repite sin parar); el repintado espera a que acabe la ráfaga.
+        if self.cache.update() and not self.watch_timer.isActive():
+            self.watch_timer.start()
+
+    def refresh_from_watch(self):
+        if self.cache is None:
+            # Plan B: volver a listar, pero no encima de otra tarea.
+            if self.task is not None:
+                self.watch_timer.start()
+                return
+            self.check_undo_file()
+            self.update_file_list()
+            return
+        if self.cache.needs_rescan:
+            # Se perdieron eventos (cola del núcleo llena) o la carpeta se movió: toca listar de nuevo.
+            if self.task is not None:
+                self.watch_timer.start()
+            else:
+                self.update_file_list()
+            return
+        if self.cache.names is None:
+            return  # Hay un listado en marcha; al acabar se aplica todo
+        self.show_snapshot(self.cache.snapshot())
+        self.update_undo_button()
+        if self.live_mode is not None and self.task is None:
+            self.live_preview()
+
+    def check_undo_file(self):
+        if self.cache is None or self.cache.names is None or self.cache.journal:
+            self.check_interrupted()
+        self.update_undo_button()
+
+    def update_undo_button(self):
+        if self.cache is not None and self.cache.names is not None:
+            self.cache.update()
+            self.undo_available = self.cache.has_undo() or self.cache.journal
+        else:
+            journal_path = os.path.join(self.folder_path, core.JOURNAL_FILE)
+            self.undo_available = core.has_undo(self.folder_path) or os.path.exists(journal_path)
+        if self.tree_check.isChecked() and self.folder_path:
+            self.undo_available = self.undo_available or tree.has_tree_undo(self.folder_path)
+        self.undo_button.setEnabled(self.undo_available and self.task is None)
+
+    def check_interrupted(self):
+        # Si la última operación se cortó a mitad, se ofrece revertirla o terminarla.
         try:
-            files = [f for f in os.listdir(self.folder_path) if os.path.isfile(os.path.join(self.folder_path, f))]
-            self.preview_text.setPlainText(", ".join(files) if files else "(carpeta vacía)")
+            pending = core.read_journal(self.folder_path)
+            if pending is None:
+                return
+            if pending.completed is None:
+                self.show_error("Hay una operación interrumpida, pero la carpeta ha cambiado desde entonces.\n"
+                                f"Revisa la carpeta y borra '{core.JOURNAL_FILE}' a mano cuando esté bien.")
+                return
+            if pending.committed:
+                core.recover_journal(self.folder_path, "forward")
+                return
+
+            box = QMessageBox(self)
+            box.setIcon(QMessageBox.Icon.Warning)
+            box.setWindowTitle("Operación interrumpida")
+            box.setText(f"La última operación se interrumpió: {pending.completed} de "
+                        f"{len(pending.steps)} renombres hechos.\n¿Qué quieres hacer?")
+            rollback = box.addButton("Revertir", QMessageBox.ButtonRole.DestructiveRole)
+            forward = box.addButton("Terminar", QMessageBox.ButtonRole.AcceptRole)
+            box.addButton("Más tarde", QMessageBox.ButtonRole.RejectRole)
+            box.exec()
+            clicked = box.clickedButton()
+            if clicked is rollback:
+                core.recover_journal(self.folder_path, "rollback")
+            elif clicked is forward:
+                core.recover_journal(self.folder_path, "forward")
+            else:
+                return
+            self.snapshot = None  # La carpeta ha cambiado: que se vuelva a leer
         except Exception as e:
-            self.show_error(f"No se pudo leer la carpeta:\n{str(e)}")
+            self.show_error(f"Error al recuperar la operación interrumpida:\n{str(e)}")
 
-    def check_undo_file(self):
-        undo_path = os.path.join(self.folder_path, UNDO_FILE)
-        self.undo_available = os.path.exists(undo_path)
-        self.undo_button.setEnabled(self.undo_available)
+    def filter_preview(self, text):
+        self.plan_model.set_filter(text)
 
     def show_error(self, message):
         QMessageBox.critical(self, "Error", message)
@@ -148,26 +668,200 @@ class KambiosGUI(QWidget):
 
     def clear_preview(self):
         self.rename_plan = []
-        self.preview_table.setRowCount(0)
+        self.tree_plan = None
+        self.live_status.setText("")
+        self.plan_model.set_plan([])
+        self.apply_button.setEnabled(False)
+
+    def on_tree_toggled(self, checked):
+        # Lo que hubiera en la tabla era para el otro modo.
+        self.clear_preview()
+        self.update_undo_button()
+
+    def run_preview(self, build, label="Generando vista previa...", after=None, tree_ok=True):
+        # El plan se construye (y se comprueba) en segundo plano, contra la foto de la carpeta.
+        # Las filas van llegando por trozos a la tabla; si al final hay problemas, se vacía.
+        # build(archivos, task) devuelve el plan; after() se llama cuando ya se ha enseñado.
+        # tree_ok=False: la acción no sabe trabajar con subcarpetas (lee los archivos de una sola carpeta).
+        if self.tree_check.isChecked():
+            if not tree_ok:
+                self.show_error("Esta acción no funciona con \"Incluir subcarpetas\".")
+                return
+            self.run_tree_preview(build, after)
+            return
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.folder != self.folder_path:
+            snapshot = core.scan_folder(self.folder_path)
+            self.snapshot = snapshot
+        self.clear_preview()
+
+        def work(task):
+            changes = build(snapshot.names, task)
+            for start in range(0, len(changes), CHUNK_SIZE):
+                task.check_cancel()
+                task.emit_chunk(changes[start:start + CHUNK_SIZE])
+                task.report(min(start + CHUNK_SIZE, len(changes)), len(changes))
+            duplicates = core.find_duplicates(changes)
+            conflicts = [] if duplicates else core.find_conflicts(changes, snapshot)
+            return changes, duplicates, conflicts
+
+        def failed(error):
+            self.clear_preview()
+            if not isinstance(error, core.Cancelled):
+                self.show_error(f"Error al generar vista previa:\n{str(error)}")
+
+        def done(result):
+            self.validate_and_show_preview(result)
+            if after is not None:
+                after()
+
+        self.start_task(label, work, done, on_chunk=self.plan_model.append_rows, on_error=failed)
+
+    def run_tree_preview(self, build, after=None):
+        # Igual que run_preview, pero recorriendo el árbol (varios scandir a la vez) y con un plan por carpeta.
+        root = self.folder_path
+        self.clear_preview()
+        found = {}
+
+        def work(task):
+            walked = tree.walk_tree(root, progress=task.report, cancel=task.cancel)
+            plan = tree.tree_plan(walked, lambda snapshot: build(snapshot.names, task))
+            changes = plan.flat()
+            for start in range(0, len(changes), CHUNK_SIZE):
+                task.check_cancel()
+                task.emit_chunk(changes[start:start + CHUNK_SIZE])
+            duplicates, conflicts = plan.problems(walked)
+            found["plan"] = plan
+            found["folders"] = len(walked.folders)
+            return changes, duplicates, conflicts
+
+        def failed(error):
+            self.clear_preview()
+            if not isinstance(error, core.Cancelled):
+                self.show_error(f"Error al generar vista previa:\n{str(error)}")
+
+        def done(result):
+            self.validate_and_show_preview(result)
+            if self.rename_plan:
+                self.tree_plan = found["plan"]
+                self.live_status.setText(f"{len(found['plan'].plans)} de {found['folders']} carpetas con cambios")
+            if after is not None:
+                after()
+
+        self.start_task("Recorriendo subcarpetas...", work, done, on_chunk=self.plan_model.append_rows,
+                        on_error=failed)
+
+    def schedule_live(self, mode):
+        self.live_mode = mode
+        self.live_timer.start()
+
+    def build_live_plan(self):
+        # El plan de la acción que se está escribiendo, o None si el campo está vacío.
+        files = self.snapshot.names
+        if self.live_mode == "number":
+            text = self.num_text.text().strip()
+            if not text:
+                return None
+            if meta.is_template(text) or self.num_sort.currentData():
+                return self.live_template_plan(files, text)
+            return self.number_plan(files, text)
+        if self.live_mode == "full":
+            text = self.full_text.text().strip()
+            if text and meta.is_template(text):
+                return self.live_grouped_plan(files, text)
+            return core.full_replace_plan(files, text) if text else None
+        if self.live_mode == "rules":
+            text = self.rules_text.toPlainText()
+            return rules.pipeline_plan(files, rules.parse_rules(text)) if text.strip() else None
+        text_remove = self.part_remove.text()
+        if not text_remove:
+            return None
+        # Solo los nombres que contienen el texto; si se está alargando, se busca entre los de antes.
+        candidates = self.matcher.matching(text_remove) if self.matcher else files
+        return core.part_replace_plan(candidates, text_remove, self.part_replace.text())
+
+    def number_plan(self, files, text):
+        # Numeración normal, o solo de los nuevos si está marcado "Solo nuevos".
+        if self.num_continue.isChecked():
+            return core.continue_number_plan(files, text, fill_gaps=self.num_fill_gaps.isChecked())
+        return core.number_plan(files, text)
+
+    def live_template_plan(self, files, text):
+        # En vivo solo si los metadatos ya están en memoria; leer 40k cabeceras va con el botón (en segundo plano).
+        template = meta.Template(text if meta.is_template(text) else "{n} - " + text + "{ext}")
+        sort = self.num_sort.currentData()
+        reader = self.meta_reader
+        fresh = reader is not None and self.meta_snapshot is self.snapshot
+        needs_meta = (template.fields | {sort}) & set(meta.STAT_FIELDS + meta.HEADER_FIELDS)
+        if needs_meta and not (fresh and reader.ready(files, needs_meta)):
+            raise meta.TemplateError("pulsa Vista previa para leer los metadatos")
+        return meta.template_plan(files, template, reader, sort=sort, restat=False)
+
+    def live_grouped_plan(self, files, text):
+        # Por títulos, en vivo: como las plantillas, los metadatos solo si ya están leídos.
+        template = meta.Template(text)
+        reader = self.meta_reader
+        fresh = reader is not None and self.meta_snapshot is self.snapshot
+        needs_meta = template.fields & set(meta.STAT_FIELDS + meta.HEADER_FIELDS)
+        if needs_meta:
+            # Solo se leen los de los vídeos.
+            videos = [group.primary for group in groups.group_by_stem(files)[0]]
+            if not (fresh and reader.ready(videos, needs_meta)):
+                raise meta.TemplateError("pulsa Vista previa para leer los metadatos")
+        return groups.grouped_replace_plan(files, template, reader, restat=False)[0]
+
+    def live_preview(self):
+        # Mientras se escribe no hay ventanas de error: los problemas se cuentan al lado de la tabla.
+        if self.snapshot is None or self.task is not None or self.live_mode is None:
+            return
+        if self.tree_check.isChecked():
+            # Con subcarpetas hay que recorrer el árbol: eso va con el botón, no con cada tecla.
+            self.live_status.setText("Pulsa Vista previa para incluir las subcarpetas")
+            return
+        self.rename_plan = []
         self.apply_button.setEnabled(False)
+        try:
+            changes = self.build_live_plan()
+        except (rules.RuleError, meta.TemplateError) as e:
+            self.live_status.setText(f"⚠️ {e}")
+            return
+        if changes is None:
+            self.plan_model.set_plan([])
+            self.live_status.setText("")
+            return
+        self.plan_model.set_plan(changes)
+        duplicates = core.find_duplicates(changes)
+        conflicts = [] if duplicates else core.find_conflicts(changes, self.snapshot)
+        if not changes:
+            self.live_status.setText("Sin cambios")
+        elif duplicates:
+            self.live_status.setText(f"⚠️ {len(duplicates)} nombres duplicados")
+        elif conflicts:
+            self.live_status.setText(f"⚠️ {len(conflicts)} conflictos con archivos de la carpeta")
+        else:
+            self.live_status.setText(f"{len(changes)} cambios")
+            self.rename_plan = changes
+            self.apply_button.setEnabled(True)
 
-    def validate_and_show_preview(self, changes):
+    def validate_and_show_preview(self, result):
+        changes, duplicates, conflicts = result
         if not changes:
             self.show_info("Sin cambios", "No se detectaron cambios que aplicar.")
             self.clear_preview()
             return
 
-        new_names = [new for _, new in changes]
-        if len(new_names) != len(set(new_names)):
+        if duplicates:
             self.show_error("¡Error! Los nombres nuevos generan duplicados.\nNo se pueden aplicar estos cambios.")
             self.clear_preview()
             return
 
+        if conflicts:
+            shown = "\n".join(f"{name}: {reason}" for name, reason in conflicts[:10])
+            self.show_error(f"¡Error! {len(conflicts)} conflictos con archivos de la carpeta:\n{shown}")
+            self.clear_preview()
+            return
+
         self.rename_plan = changes
-        self.preview_table.setRowCount(len(changes))
-        for row, (old, new) in enumerate(changes):
-            self.preview_table.setItem(row, 0, QTableWidgetItem(old))
-            self.preview_table.setItem(row, 1, QTableWidgetItem(new))
         self.apply_button.setEnabled(True)
 
     # Vista previa
@@ -180,18 +874,31 @@ class KambiosGUI(QWidget):
         if not text:
             self.show_error("Ingresa el texto después del número.")
             return
-
+        sort = self.num_sort.currentData()
+        if not meta.is_template(text) and not sort:
+            self.run_preview(lambda files, task: self.number_plan(files, text))
+            return
         try:
-            files = [f for f in os.listdir(self.folder_path) if os.path.isfile(os.path.join(self.folder_path, f))]
-            changes = []
-            for count, filename in enumerate(files):
-                _, ext = os.path.splitext(filename)
-                new_name = f"{count} - {text}{ext}"
-                if filename != new_name:
-                    changes.append((filename, new_name))
-            self.validate_and_show_preview(changes)
-        except Exception as e:
-            self.show_error(f"Error al generar vista previa:\n{str(e)}")
+            template = meta.Template(text if meta.is_template(text) else "{n} - " + text + "{ext}")
+        except meta.TemplateError as e:
+            self.show_error(f"Plantilla no válida:\n{str(e)}")
+            return
+        if self.meta_reader is None or self.meta_reader.folder != self.folder_path:
+            self.meta_reader = meta.MetadataReader(self.folder_path)
+        reader = self.meta_reader
+        snapshot = self.snapshot
+        # Si la carpeta no ha cambiado desde la última lectura, ni siquiera hace falta el stat.
+        restat = snapshot is None or snapshot is not self.meta_snapshot
+
+        def build(files, task):
+            changes = meta.template_plan(files, template, reader, sort=sort, restat=restat,
+                                         progress=task.report, cancel=task.cancel)
+            return changes
+
+        def after():
+            self.meta_snapshot = self.snapshot
+
+        self.run_preview(build, label="Leyendo metadatos...", after=after, tree_ok=False)
 
     def preview_full_replace(self):
         if not self.folder_path:
@@ -201,18 +908,31 @@ class KambiosGUI(QWidget):
         if not text:
             self.show_error("Ingresa el nuevo nombre base.")
             return
-
+        if not meta.is_template(text):
+            self.run_preview(lambda files, task: core.full_replace_plan(files, text))
+            return
+        # Con campos, un nombre por título: cada vídeo con sus subtítulos, .nfo y carátulas.
         try:
-            files = [f for f in os.listdir(self.folder_path) if os.path.isfile(os.path.join(self.folder_path, f))]
-            changes = []
-            for filename in files:
-                _, ext = os.path.splitext(filename)
-                new_name = f"{text}{ext}"
-                if filename != new_name:
-                    changes.append((filename, new_name))
-            self.validate_and_show_preview(changes)
-        except Exception as e:
-            self.show_error(f"Error al generar vista previa:\n{str(e)}")
+            template = meta.Template(text)
+        except meta.TemplateError as e:
+            self.show_error(f"Plantilla no válida:\n{str(e)}")
+            return
+        if self.meta_reader is None or self.meta_reader.folder != self.folder_path:
+            self.meta_reader = meta.MetadataReader(self.folder_path)
+        reader = self.meta_reader
+        found = {}
+
+        def build(files, task):
+            changes, found["loose"] = groups.grouped_replace_plan(files, template, reader,
+                                                                  progress=task.report, cancel=task.cancel)
+            return changes
+
+        def after():
+            self.meta_snapshot = self.snapshot
+            if found.get("loose"):
+                self.live_status.setText(f"{len(found['loose'])} archivos sin vídeo al que acompañar (no se tocan)")
+
+        self.run_preview(build, label="Agrupando por títulos...", after=after, tree_ok=False)
 
     def preview_part_replace(self):
         if not self.folder_path:
@@ -223,18 +943,93 @@ class KambiosGUI(QWidget):
         if not text_remove:
             self.show_error("Ingresa el texto que deseas quitar.")
             return
+        self.run_preview(lambda files, task: core.part_replace_plan(files, text_remove, text_replace))
 
+    def preview_rules(self):
+        if not self.folder_path:
+            self.show_error("Selecciona una carpeta primero.")
+            return
         try:
-            files = [f for f in os.listdir(self.folder_path) if os.path.isfile(os.path.join(self.folder_path, f))]
-            changes = []
-            for filename in files:
-                if text_remove in filename:
-                    new_name = filename.replace(text_remove, text_replace)
-                    if filename != new_name:
-                        changes.append((filename, new_name))
-            self.validate_and_show_preview(changes)
-        except Exception as e:
-            self.show_error(f"Error al generar vista previa:\n{str(e)}")
+            pipeline = rules.Pipeline(rules.parse_rules(self.rules_text.toPlainText()))
+        except rules.RuleError as e:
+            self.show_error(f"Regla no válida:\n{str(e)}")
+            return
+        if not pipeline.rules:
+            self.show_error("Escribe al menos una regla o elige un preset.")
+            return
+        self.run_preview(lambda files, task: rules.pipeline_plan(files, pipeline))
+
+    def select_dat(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Elegir DAT", "", "DAT (*.dat *.xml);;Todos (*)",
+                                              options=QFileDialog.Option.DontUseNativeDialog)
+        if path:
+            self.dat_line.setText(path)
+
+    def preview_dat(self):
+        if not self.folder_path:
+            self.show_error("Selecciona una carpeta primero.")
+            return
+        dat_path = self.dat_line.text().strip()
+        if not dat_path or not os.path.isfile(dat_path):
+            self.show_error("Elige un archivo DAT.")
+            return
+        folder = self.folder_path
+        found = {}
+
+        def build(files, task):
+            # Lo lento es leer los archivos: solo se calcula lo que no esté ya en la caché de hashes.
+            index = dat.load_dat(dat_path)
+            changes, found["report"] = dat.dat_plan(folder, files, index, progress=task.report, cancel=task.cancel)
+            return changes
+
+        def after():
+            report = found["report"]
+            text = f"{report.verified} ya correctos · {report.renamed} a renombrar · {len(report.unknown)} no están en el DAT"
+            if report.errors:
+                text += f" · {len(report.errors)} no se pudieron leer"
+            self.live_status.setText(text)
+
+        self.run_preview(build, label="Calculando hashes...", after=after, tree_ok=False)
+
+    # Presets de reglas (los mismos que usa la CLI)
+
+    def refresh_presets(self, select=None):
+        self.preset_combo.blockSignals(True)
+        self.preset_combo.clear()
+        self.preset_combo.addItem("(ninguno)")
+        self.preset_combo.addItems(rules.list_presets())
+        if select:
+            self.preset_combo.setCurrentText(select)
+        self.preset_combo.blockSignals(False)
+
+    def load_preset(self, index):
+        if index <= 0:
+            return
+        try:
+            self.rules_text.setPlainText(rules.format_rules(rules.load_preset(self.preset_combo.currentText())))
+        except (rules.RuleError, OSError, ValueError) as e:
+            self.show_error(f"No se pudo cargar el preset:\n{str(e)}")
+
+    def save_preset(self):
+        try:
+            preset_rules = rules.parse_rules(self.rules_text.toPlainText())
+        except rules.RuleError as e:
+            self.show_error(f"Regla no válida:\n{str(e)}")
+            return
+        if not preset_rules:
+            self.show_error("No hay reglas que guardar.")
+            return
+        current = self.preset_combo.currentText() if self.preset_combo.currentIndex() > 0 else ""
+        name, ok = QInputDialog.getText(self, "Guardar preset", "Nombre del preset:", text=current)
+        name = name.strip()
+        if not ok or not name:
+            return
+        try:
+            rules.save_preset(name, preset_rules)
+        except (rules.RuleError, OSError) as e:
+            self.show_error(f"No se pudo guardar el preset:\n{str(e)}")
+            return
+        self.refresh_presets(select=name)
 
     # Aplicar y deshacer
 
@@ -248,69 +1043,213 @@ class KambiosGUI(QWidget):
             f"¿Renombrar {len(self.rename_plan)} archivo(s)?\nEsta acción no se puede deshacer... O quizás sí 😎",
             QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
         )
-        if reply == QMessageBox.StandardButton.Yes:
-            try:
-                for old_name, new_name in self.rename_plan:
-                    src = os.path.join(self.folder_path, old_name)
-                    dst = os.path.join(self.folder_path, new_name)
-                    os.rename(src, dst)
-
-                undo_path = os.path.join(self.folder_path, UNDO_FILE)
-                undo_data = {
-                    "timestamp": time.time(),
-                    "renames": [[new_name, old_name] for old_name, new_name in self.rename_plan]
-                }
-                with open(undo_path, "w", encoding="utf-8") as f:
-                    json.dump(undo_data, f, indent=2, ensure_ascii=False)
-
-                self.show_info("Éxito", "Archivos renombrados. Puedes deshacer desde esta carpeta.")
-                self.update_file_list()
-                self.clear_preview()
-                self.check_undo_file()
+        if reply != QMessageBox.StandardButton.Yes:
+            return
 
-            except Exception as e:
-                self.show_error(f"Error al aplicar cambios:\n{str(e)}")
+        if self.tree_plan is not None:
+            self.apply_tree_renames()
+            return
 
-    def undo_last_rename(self):
-        undo_path = os.path.join(self.folder_path, UNDO_FILE)
-        if not os.path.exists(undo_path):
-            self.show_error("No hay operación previa para deshacer.")
+        folder = self.folder_path
+        plan = self.rename_plan
+
+        def work(task):
+            # El motor ordena cadenas y ciclos, vuelve a comprobar la carpeta justo antes de renombrar
+            # y apunta cada lote en un diario, por si esto se corta a mitad.
+            return core.apply_plan(folder, plan, "kambios_gui", progress=task.report, cancel=task.cancel)
+
+        def done(changes):
+            self.show_info("Éxito", "Archivos renombrados. Puedes deshacer desde esta carpeta.")
+            self.after_rename()
+
+        def failed(error):
+            self.after_rename()
+            if isinstance(error, core.Cancelled):
+                # Lo hecho hasta cancelar queda en el historial, como una operación normal.
+                self.show_info("Cancelado", f"Operación cancelada tras renombrar {len(error.done)} archivo(s).\n"
+                                            "Lo que se hizo se puede deshacer.")
+            elif isinstance(error, core.RenameError):
+                # Lo que sí se renombró ya está en el deshacer para poder volver atrás.
+                failed_files = "\n".join(f"{name}: {e.strerror or e}" for name, e in error.failures[:10])
+                self.show_error(f"Error al aplicar cambios ({len(error.done)} hechos, se pueden deshacer):\n"
+                                f"{failed_files or str(error)}")
+            else:
+                self.show_error(f"Error al aplicar cambios:\n{str(error)}")
+
+        self.start_task("Renombrando...", work, done, on_error=failed)
+
+    def apply_tree_renames(self):
+        # Cada carpeta con su diario, varias a la vez; el índice del árbol permite deshacerlo todo junto.
+        plan = self.tree_plan
+
+        def work(task):
+            return tree.apply_tree(plan, "kambios_gui", progress=task.report, cancel=task.cancel)
+
+        def done(result):
+            self.after_rename()
+            if result.errors:
+                shown = "\n".join(f"{reldir or '.'}: {error}" for reldir, error in result.errors[:10])
+                self.show_error(f"{result.count} archivo(s) renombrados, pero {len(result.errors)} carpeta(s) "
+                                f"fallaron:\n{shown}\n\nLo hecho se puede deshacer.")
+            else:
+                self.show_info("Éxito", f"{result.count} archivos renombrados en {len(result.done)} carpetas.\n"
+                                        "Puedes deshacerlo todo junto desde esta carpeta.")
+
+        def failed(error):
+            self.after_rename()
+            if isinstance(error, core.Cancelled):
+                count = error.result.count if error.result is not None else 0
+                self.show_info("Cancelado", f"Operación cancelada tras renombrar {count} archivo(s).\n"
+                                            "Lo que se hizo se puede deshacer.")
+            else:
+                self.show_error(f"Error al aplicar cambios:\n{str(error)}")
+
+        self.start_task("Renombrando subcarpetas...", work, done, on_error=failed)
+
+    def after_rename(self):
+        self.clear_preview()
+        self.check_undo_file()
+        if self.cache is not None and self.cache.names is not None and not self.cache.needs_rescan:
+            # La caché ya sabe qué se renombró (por los eventos): no hace falta volver a listar.
+            self.watch_timer.stop()
+            self.refresh_from_watch()
+        else:
+            self.update_file_list()
+
+    def closeEvent(self, event):
+        self.stop_watching()
+        super().closeEvent(event)
+
+    def undo_last_rename(self, skip_missing=False):
+        # Cada clic deshace una operación más del historial, de la más reciente a la más antigua.
+        # Primero, una operación interrumpida (si se dejó "para más tarde").
+        if core.read_journal(self.folder_path) is not None:
+            self.check_interrupted()
+            self.check_undo_file()
+            return
+        if self.tree_check.isChecked() and tree.has_tree_undo(self.folder_path):
+            self.undo_tree(skip_missing)
             return
 
         try:
-            with open(undo_path, "r", encoding="utf-8") as f:
-                undo_data = json.load(f)
-
-            renames = undo_data.get("renames", [])
-            if not renames:
-                raise ValueError("Archivo de deshacer vacío.")
+            history = core.list_history(self.folder_path)
+        except Exception as e:
+            self.show_error(f"Error al deshacer:\n{str(e)}")
+            return
+        if not history:
+            self.show_error("No hay operación previa para deshacer.")
+            return
+        last = history[0]
 
+        if not skip_missing:
             reply = QMessageBox.question(
                 self,
                 "¿Deshacer?",
-                f"¿Deshacer el último cambio? ({len(renames)} archivo(s))",
+                f"¿Deshacer el último cambio? ({last.count} archivo(s))\n"
+                f"Operaciones en el historial: {len(history)}",
                 QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
             )
             if reply != QMessageBox.StandardButton.Yes:
                 return
 
-            for current_name, original_name in renames:
-                src = os.path.join(self.folder_path, current_name)
-                dst = os.path.join(self.folder_path, original_name)
-                if os.path.exists(src):
-                    os.rename(src, dst)
-                else:
-                    self.show_error(f"Archivo faltante: {current_name}. La operación puede estar incompleta.")
-                    return
+        folder = self.folder_path
 
-            os.remove(undo_path)
-            self.show_info("Deshacer", "¡Cambios revertidos correctamente!")
-            self.update_file_list()
-            self.undo_button.setEnabled(False)
+        def work(task):
+            # Se valida todo contra una sola foto de la carpeta antes de tocar nada: nada de deshacer a medias.
+            problems = core.validate_undo(folder, last.id)
+            if problems and not skip_missing:
+                return problems
+            # El motor lee la operación del final al principio sin cargarla entera y lo apunta todo en el diario.
+            core.undo_operation(folder, last.id, "kambios_gui", skip_missing=skip_missing,
+                                progress=task.report, cancel=task.cancel)
+            return []
+
+        def done(problems):
+            if not problems:
+                self.show_info("Deshacer", "¡Cambios revertidos correctamente!")
+                self.after_rename()
+                return
+            shown = "\n".join(f"{name}: {reason}" for name, reason in problems[:10])
+            if any(reason != "no existe" for _, reason in problems):
+                self.show_error(f"No se puede deshacer ({len(problems)} problemas):\n{shown}")
+                return
+            reply = QMessageBox.question(
+                self,
+                "Faltan archivos",
+                f"Faltan {len(problems)} archivo(s):\n{shown}\n\n¿Deshacer el resto?",
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+            )
+            if reply == QMessageBox.StandardButton.Yes:
+                self.undo_last_rename(skip_missing=True)
+
+        def failed(error):
+            self.after_rename()
+            if isinstance(error, core.Cancelled):
+                # El motor vuelve a dejarlo todo como estaba: la operación sigue en el historial.
+                self.show_info("Cancelado", "Deshacer cancelado. La carpeta sigue como estaba.")
+            else:
+                self.show_error(f"Error al deshacer:\n{str(error)}")
+
+        self.start_task("Deshaciendo...", work, done, on_error=failed)
 
+    def undo_tree(self, skip_missing=False):
+        # Con "Incluir subcarpetas": deshace la última operación de árbol en todas sus carpetas a la vez.
+        try:
+            entries = tree.list_tree_history(self.folder_path)
         except Exception as e:
             self.show_error(f"Error al deshacer:\n{str(e)}")
+            return
+        last = entries[0]
+        if not skip_missing:
+            reply = QMessageBox.question(
+                self,
+                "¿Deshacer?",
+                f"¿Deshacer el último cambio con subcarpetas? ({last.count} archivo(s) en {len(last.folders)} carpetas)",
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+            )
+            if reply != QMessageBox.StandardButton.Yes:
+                return
+
+        root = self.folder_path
+
+        def work(task):
+            problems = tree.validate_tree_undo(root, last)
+            if problems and not skip_missing:
+                return problems, None
+            return [], tree.undo_tree(root, last.id, "kambios_gui", skip_missing=skip_missing,
+                                      progress=task.report, cancel=task.cancel)
+
+        def done(value):
+            problems, result = value
+            if result is not None:
+                self.after_rename()
+                if result.errors:
+                    shown = "\n".join(f"{reldir or '.'}: {error}" for reldir, error in result.errors[:10])
+                    self.show_error(f"No se pudieron deshacer {len(result.errors)} carpeta(s):\n{shown}")
+                else:
+                    self.show_info("Deshacer", "¡Cambios revertidos correctamente!")
+                return
+            shown = "\n".join(f"{name}: {reason}" for name, reason in problems[:10])
+            if any(reason != "no existe" for _, reason in problems):
+                self.show_error(f"No se puede deshacer ({len(problems)} problemas):\n{shown}")
+                return
+            reply = QMessageBox.question(
+                self,
+                "Faltan archivos",
+                f"Faltan {len(problems)} archivo(s):\n{shown}\n\n¿Deshacer el resto?",
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+            )
+            if reply == QMessageBox.StandardButton.Yes:
+                self.undo_tree(skip_missing=True)
+
+        def failed(error):
+            self.after_rename()
+            if isinstance(error, core.Cancelled):
+                self.show_info("Cancelado", "Deshacer cancelado. Lo que falta sigue en el historial.")
+            else:
+                self.show_error(f"Error al deshacer:\n{str(error)}")
 
+        self.start_task("Deshaciendo...", work, done, on_error=failed)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
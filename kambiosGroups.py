@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+KAMBIOS - reemplazar el nombre completo por títulos
+"Reemplazar nombre completo" le da a todo el mismo nombre base: perfecto para una carpeta con una sola
+película, pero en una temporada de 500 capítulos todos acabarían llamándose igual. Aquí cada vídeo forma
+un grupo con sus acompañantes (subtítulos, .nfo, carátulas), y cada grupo se renombra por su cuenta a
+partir de una plantilla como "Serie - S01E{n:02}" o "{name} (2020)".
+
+Emparejar no compara cada archivo con cada vídeo: los vídeos van a un diccionario por su nombre sin
+extensión normalizado, y cada acompañante prueba su propio nombre y, si no, el que queda al quitarle las
+etiquetas del final (".en", ".es.forced", "-poster"). Son unas pocas búsquedas por archivo, así que
+emparejar 500 capítulos o 50.000 cuesta lo mismo por archivo.
+
+    Capitulo 01.mkv            ->  Serie - S01E01.mkv
+    Capitulo 01.en.srt         ->  Serie - S01E01.en.srt
+    Capitulo 01.es.forced.srt  ->  Serie - S01E01.es.forced.srt
+    Capitulo 01-poster.jpg     ->  Serie - S01E01-poster.jpg
+"""
+
+import os
+import re
+import unicodedata
+
+import kambiosMeta as meta
+
+
+VIDEO_EXTS = {".mkv", ".mp4", ".avi", ".m4v", ".mov", ".wmv", ".mpg", ".mpeg", ".ts", ".m2ts", ".webm",
+              ".flv", ".ogv", ".divx", ".iso"}
+ART_SUFFIXES = {"poster", "fanart", "thumb", "banner", "landscape", "clearlogo", "clearart", "disc", "cover"}
+SUBTITLE_FLAGS = {"forced", "sdh", "cc", "hi", "default", "full"}
+LANGUAGE_TAG = re.compile(r"[a-z]{2,3}([-_][a-z]{2,4})?")   # en, spa, pt-br, zh_hans...
+MAX_TAGS = 3                                                # Etiquetas que se quitan como mucho (".es.forced.sdh")
+
+
+def normalize_stem(stem):
+    # Mismo nombre aunque cambien las mayúsculas o la forma de escribir los acentos (NFC/NFD, típico de macOS).
+    return unicodedata.normalize("NFC", stem).casefold()
+
+
+def _is_tag(token, separator):
+    token = token.casefold()
+    if separator == "." and (token in SUBTITLE_FLAGS or LANGUAGE_TAG.fullmatch(token)):
+        return True
+    return token in ART_SUFFIXES
+
+
+def _last_tag(stem):
+    # Dónde empieza la última etiqueta de stem (contando su separador), o None si no acaba en una.
+    cut = max(stem.rfind("."), stem.rfind("-"), stem.rfind("_"))
+    if cut > 0 and _is_tag(stem[cut + 1:], stem[cut]):
+        return cut
+    # "Capitulo 01.pt-br": la última etiqueta lleva un guion dentro.
+    cut = stem.rfind(".")
+    if cut > 0 and _is_tag(stem[cut + 1:], "."):
+        return cut
+    return None
+
+
+class Group:
+    """
+    Un vídeo y sus acompañantes. members: (archivo, sufijo), donde el sufijo es lo que va detrás del
+    nombre base (".mkv", ".en.srt", "-poster.jpg"); el vídeo es el primero.
+    """
+
+    def __init__(self, primary, stem):
+        self.primary = primary
+        self.stem = stem
+        self.members = [(primary, primary[len(stem):])]
+
+    def __len__(self):
+        return len(self.members)
+
+
+def group_by_stem(files, primary_exts=VIDEO_EXTS):
+    """
+    Agrupa files por títulos: un grupo por cada archivo con extensión de primary_exts, con todo lo que
+    se llama igual (quitando etiquetas de idioma o de carátula). Devuelve (grupos, sueltos): los grupos
+    ordenados por nombre, y los archivos que no son de ningún grupo, en el orden en que venían.
+    """
+    files = list(files)
+    splitext = os.path.splitext
+    index = {}
+    others = []
+    # Los vídeos primero, en orden: si dos se llaman igual (peli.mkv y peli.mp4), el segundo va con el primero.
+    for filename in sorted(files, key=str.lower):
+        stem, ext = splitext(filename)
+        if ext.lower() not in primary_exts:
+            others.append(filename)
+            continue
+        key = normalize_stem(stem)
+        if key in index:
+            index[key].members.append((filename, filename[len(stem):]))
+        else:
+            index[key] = Group(filename, stem)
+
+    loose = []
+    for filename in others:
+        stem = splitext(filename)[0]
+        group = index.get(normalize_stem(stem))
+        cut = len(stem)
+        for _ in range(MAX_TAGS):
+            if group is not None:
+                break
+            tag = _last_tag(stem[:cut])
+            if tag is None:
+                break
+            cut = tag
+            group = index.get(normalize_stem(stem[:cut]))
+        if group is None:
+            loose.append(filename)
+        else:
+            group.members.append((filename, filename[cut:]))
+
+    loose_set = set(loose)
+    return list(index.values()), [name for name in files if name in loose_set]
+
+
+def grouped_replace_plan(files, template, reader=None, start=1, restat=True, progress=None, cancel=None):
+    """
+    Plan de "reemplazar nombre completo" por títulos. template da el nombre base de cada grupo, sin
+    extensión: {n} cuenta los grupos por orden de nombre (desde start, 1 por defecto, como los capítulos),
+    {name} es el nombre del vídeo sin extensión, y {size}, {date}... los del vídeo (necesitan reader;
+    restat como en meta.template_plan).
+    Un texto sin campos le da a todos los grupos el mismo nombre, como el reemplazo de siempre.
+    Devuelve (cambios, sueltos); los sueltos no se tocan.
+    """
+    if not isinstance(template, meta.Template):
+        template = meta.Template(template)
+    if "ext" in template.fields:
+        raise meta.TemplateError("aquí la plantilla es el nombre base: la extensión (y el .en.srt) la pone cada archivo")
+    groups, loose = group_by_stem(files)
+
+    needed = set(template.fields)
+    info = {}
+    if needed & (set(meta.STAT_FIELDS) | set(meta.HEADER_FIELDS)):
+        if reader is None:
+            raise meta.TemplateError("esta plantilla necesita leer metadatos de los archivos")
+        info = reader.read([group.primary for group in groups], needed, restat=restat, progress=progress,
+                           cancel=cancel)
+
+    changes = []
+    for i, group in enumerate(groups, start):
+        if info:
+            values = dict(info[group.primary])
+            if values.get("date") is None:
+                values["date"] = values.get("mtime")
+        else:
+            values = {}
+        values["n"] = i
+        values["name"] = group.stem
+        base = template.render(values)
+        if not base:
+            continue
+        for filename, suffix in group.members:
+            new_name = base + suffix
+            if new_name != filename:
+                changes.append((filename, new_name))
+    return changes, loose
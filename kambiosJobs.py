@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+KAMBIOS - trabajos por lotes en muchas carpetas
+Un archivo de trabajo dice qué carpetas y qué reglas, y se ejecuta todo de una vez repartiendo las
+carpetas entre varios procesos (una por proceso a la vez). Cada carpeta es una operación normal: su
+diario, su historial y su deshacer (undo CARPETA), así que lo que falle en una no afecta a las demás.
+Al final sale un informe con lo que pasó en todas: cambios, conflictos, fallos y tiempos.
+
+El archivo es un JSON. Las claves de fuera valen para todos los trabajos; cada trabajo puede cambiarlas.
+"folder" admite comodines (una entrada por cada carpeta que cumpla) y las rutas relativas son desde el
+archivo de trabajo:
+
+    {
+        "format": "kambios_job", "version": 1,
+        "preset": "limpiar-roms", "ext": ["zip", "7z"],
+        "jobs": [
+            {"folder": "roms/*"},
+            {"folder": "fotos/2024-*", "template": "{date:%Y%m%d}_{n:04}{ext}", "sort": "date"},
+            {"folder": "series/Serie", "full": "Serie - S01E{n:02}"}
+        ]
+    }
+
+Modos (uno por trabajo): number (con continue y fill_gaps), full, part (con with), rules (lista de reglas
+o ruta a un archivo de reglas), preset y template (con sort, desc y start). Filtros: glob y ext.
+"""
+
+import os
+import json
+import time
+import signal
+import glob as globbing
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import kambiosCore as core
+import kambiosRules as rules
+import kambiosMeta as meta
+import kambiosGroups as groups
+import kambiosMetrics as metrics
+
+
+JOB_FORMAT = "kambios_job"
+JOB_VERSION = 1
+MODES = ("number", "full", "part", "rules", "preset", "template")
+OPTIONS = {"continue", "fill_gaps", "with", "sort", "desc", "start", "glob", "ext"}
+REPORT_ROWS = 10   # Conflictos y fallos que se guardan por carpeta (el total se cuenta igual)
+
+
+class JobError(ValueError):
+    pass
+
+
+# --- Leer el archivo de trabajo ---
+
+def _resolve_job(job, base, number):
+    # Comprueba un trabajo y lo deja listo para mandarlo a otro proceso (solo tipos simples).
+    where = f"trabajo {number}"
+    unknown = set(job) - set(MODES) - OPTIONS - {"folder"}
+    if unknown:
+        raise JobError(f"{where}: claves desconocidas: {', '.join(sorted(unknown))}")
+    modes = [mode for mode in MODES if job.get(mode) is not None]
+    if len(modes) != 1:
+        raise JobError(f"{where}: hace falta un modo (y solo uno) de {', '.join(MODES)}")
+    job = dict(job)
+    mode = job["mode"] = modes[0]
+    if mode == "rules" and isinstance(job["rules"], str):
+        job["rules"] = rules.load_rules_file(os.path.join(base, job["rules"]))
+    elif mode == "rules":
+        job["rules"] = rules.parse_rules("\n".join(job["rules"]))
+    elif mode == "preset":
+        job["rules"] = rules.load_preset(job.pop("preset"))
+        mode = job["mode"] = "rules"
+    if mode == "rules":
+        rules.Pipeline(job["rules"])
+    elif mode == "template" or (mode == "full" and meta.is_template(job["full"])):
+        meta.Template(job[mode])
+    if job.get("sort") is not None and job["sort"] not in meta.SORT_KEYS:
+        raise JobError(f"{where}: no se puede ordenar por '{job['sort']}' (válidos: {', '.join(meta.SORT_KEYS)})")
+    return job
+
+
+def load_jobs(path):
+    """
+    Lee un archivo de trabajo y devuelve la lista de trabajos, uno por carpeta, ya comprobados: las reglas
+    y presets cargados y las plantillas analizadas, para que un error salga antes de tocar nada.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError as e:
+            raise JobError(f"el archivo de trabajo no es JSON válido: {e}")
+    if not isinstance(data, dict) or data.get("format", JOB_FORMAT) != JOB_FORMAT:
+        raise JobError("no es un archivo de trabajo de Kambios")
+    version = data.get("version", JOB_VERSION)
+    if not isinstance(version, int) or isinstance(version, bool):
+        raise JobError(f"'version' tiene que ser un número entero, no {json.dumps(version, ensure_ascii=False)}")
+    if version > JOB_VERSION:
+        raise JobError(f"archivo de trabajo de una versión más nueva ({version})")
+    if not isinstance(data.get("jobs"), list) or not data["jobs"]:
+        raise JobError("el archivo de trabajo no tiene 'jobs'")
+
+    base = os.path.dirname(os.path.abspath(path))
+    defaults = {key: value for key, value in data.items() if key not in ("format", "version", "jobs")}
+    jobs = []
+    seen = set()
+    for number, entry in enumerate(data["jobs"], 1):
+        if isinstance(entry, str):
+            entry = {"folder": entry}
+        if not isinstance(entry, dict) or not entry.get("folder"):
+            raise JobError(f"trabajo {number}: falta 'folder'")
+        job = dict(defaults)
+        if any(entry.get(mode) is not None for mode in MODES):
+            # El modo del trabajo sustituye al de fuera, no se suma.
+            for mode in MODES:
+                job.pop(mode, None)
+        job.update(entry)
+        job = _resolve_job(job, base, number)
+        pattern = os.path.join(base, os.path.expanduser(job["folder"]))
+        folders = sorted(path for path in globbing.glob(pattern) if os.path.isdir(path))
+        if not folders:
+            raise JobError(f"trabajo {number}: ninguna carpeta cumple '{job['folder']}'")
+        for folder in folders:
+            folder = os.path.normpath(folder)
+            if folder in seen:
+                raise JobError(f"trabajo {number}: la carpeta '{folder}' ya está en otro trabajo")
+            seen.add(folder)
+            jobs.append(dict(job, folder=folder))
+    return jobs
+
+
+# --- Una carpeta (en su proceso) ---
+
+def job_plan(job, snapshot):
+    """
+    Los cambios de un trabajo para la foto de su carpeta. Las plantillas leen metadatos en un solo hilo:
+    el reparto ya lo hace el pool, una carpeta por proceso.
+    """
+    mode = job["mode"]
+    files = snapshot.names
+    if mode == "number" and (job.get("continue") or job.get("fill_gaps")):
+        return core.continue_number_plan(files, job["number"], fill_gaps=bool(job.get("fill_gaps")))
+    if mode == "number":
+        return core.number_plan(files, job["number"])
+    if mode == "full" and meta.is_template(job["full"]):
+        reader = meta.MetadataReader(snapshot.folder, workers=1)
+        start = job.get("start")
+        return groups.grouped_replace_plan(files, job["full"], reader, start=1 if start is None else start)[0]
+    if mode == "full":
+        return core.full_replace_plan(files, job["full"])
+    if mode == "part":
+        return core.part_replace_plan(files, job["part"], job.get("with", ""))
+    if mode == "rules":
+        return rules.pipeline_plan(files, rules.Pipeline(job["rules"]))
+    return meta.template_plan(files, job["template"], meta.MetadataReader(snapshot.folder, workers=1),
+                              sort=job.get("sort"), descending=bool(job.get("desc")), start=job.get("start") or 0)
+
+
+def _shown(pairs):
+    return [[name, str(reason)] for name, reason in pairs[:REPORT_ROWS]]
+
+
+def run_job(job, dry_run=False, source="kambios_job"):
+    """
+    Hace un trabajo (planear, revisar y, si no es dry_run, aplicar) y devuelve su resultado como un dict
+    que se puede pasar entre procesos y guardar en JSON. Nunca lanza: los errores van en el resultado.
+    """
+    result = {"folder": job["folder"], "mode": job["mode"], "status": "ok", "files": 0, "changes": 0,
+              "renamed": 0, "duplicates": 0, "conflicts": 0, "failures": 0, "problems": [], "error": None,
+              "op_id": None, "seconds": 0.0, "phases": {}}
+    recorder = metrics.Recorder(job["mode"])
+    start = time.perf_counter()
+    try:
+        if core.read_journal(job["folder"]) is not None:
+            raise JobError("hay una operación interrumpida en la carpeta (usa 'recover' antes)")
+        with recorder.phase("scan"):
+            ext = job.get("ext")
+            snapshot = core.scan_folder(job["folder"], pattern=job.get("glob"),
+                                        extensions=[ext] if isinstance(ext, str) else ext)
+        result["files"] = len(snapshot.names)
+        with recorder.phase("plan", len(snapshot.names)):
+            changes = job_plan(job, snapshot)
+        result["changes"] = len(changes)
+        with recorder.phase("check", len(changes)):
+            duplicates = core.find_duplicates(changes)
+            conflicts = [] if duplicates else core.find_conflicts(changes, snapshot)
+        if duplicates:
+            result.update(status="duplicates", duplicates=len(duplicates),
+                          problems=[[name, "duplicado"] for name in duplicates[:REPORT_ROWS]])
+        elif conflicts:
+            result.update(status="conflicts", conflicts=len(conflicts), problems=_shown(conflicts))
+        elif changes and not dry_run:
+            with recorder.phase("apply", len(changes)):
+                try:
+                    done = core.apply_plan(job["folder"], changes, source, existing=snapshot)
+                except core.RenameError as e:
+                    failures = e.failures or [(None, e.error)]
+                    result.update(status="failed", renamed=len(e.done), failures=len(failures),
+                                  problems=_shown(failures), error=str(e))
+                    done = None
+                except core.PlanConflictError as e:
+                    # La carpeta cambió entre la foto y el renombre.
+                    result.update(status="conflicts", conflicts=len(e.conflicts), problems=_shown(e.conflicts))
+                    done = None
+            if done is not None:
+                result["renamed"] = len(done)
+            if result["renamed"]:
+                history = core.list_history(job["folder"])   # La más reciente primero: la de ahora
+                result["op_id"] = history[0].id if history else None
+    except Exception as e:   # Una carpeta rota (permisos, plantilla que no encaja...) no para a las demás
+        result.update(status="error", error=str(e) if isinstance(e, (OSError, ValueError)) else repr(e))
+    result["seconds"] = round(time.perf_counter() - start, 6)
+    result["phases"] = {record["phase"]: record["seconds"] for record in recorder.phases}
+    return result
+
+
+# --- Todas las carpetas ---
+
+def _ignore_sigint():
+    # Ctrl+C llega a todos los procesos del terminal: los del pool lo ignoran para acabar su carpeta.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class JobReport:
+    """
+    El informe de una pasada: un resultado por carpeta (en el orden del archivo) y los totales.
+    """
+
+    def __init__(self, path, dry_run, workers):
+        self.path = path
+        self.dry_run = dry_run
+        self.workers = workers
+        self.timestamp = time.time()
+        self.seconds = 0.0
+        self.results = []
+
+    def totals(self):
+        count = lambda key: sum(result[key] for result in self.results)
+        statuses = {}
+        for result in self.results:
+            statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+        slowest = max(self.results, key=lambda result: result["seconds"], default=None)
+        return {
+            "folders": len(self.results),
+            "status": statuses,
+            "files": count("files"),
+            "changes": count("changes"),
+            "renamed": count("renamed"),
+            "duplicates": count("duplicates"),
+            "conflicts": count("conflicts"),
+            "failures": count("failures"),
+            "errors": statuses.get("error", 0),
+            "seconds": round(self.seconds, 3),
+            "folder_seconds": round(sum(result["seconds"] for result in self.results), 3),
+            "slowest": slowest and [slowest["folder"], slowest["seconds"]],
+        }
+
+    @property
+    def ok(self):
+        return all(result["status"] == "ok" for result in self.results)
+
+    def to_dict(self):
+        return {"format": "kambios_job_report", "version": 1, "job": self.path, "timestamp": self.timestamp,
+                "dry_run": self.dry_run, "workers": self.workers, "totals": self.totals(),
+                "results": self.results}
+
+    def save(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+
+def run_jobs(jobs, workers=None, dry_run=False, path=None, on_result=None):
+    """
+    Ejecuta los trabajos repartiéndolos entre workers procesos (por defecto, uno por CPU) y devuelve un
+    JobReport. on_result(resultado) se llama según va acabando cada carpeta, en el orden en que acaban.
+    Con Ctrl+C no se empiezan más carpetas; las que están a medias terminan (cada una tiene su diario).
+    """
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+    report = JobReport(path, dry_run, workers)
+    results = {}
+    start = time.perf_counter()
+    with metrics.phase("jobs", len(jobs)):
+        if workers == 1:
+            for index, job in enumerate(jobs):
+                results[index] = run_job(job, dry_run)
+                if on_result:
+                    on_result(results[index])
+        else:
+            # "spawn", como en kambiosDAT: no heredar hilos ni locks a medio coger.
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_ignore_sigint) as pool:
+                futures = {pool.submit(run_job, job, dry_run): index for index, job in enumerate(jobs)}
+                try:
+                    for future in as_completed(futures):
+                        results[futures[future]] = future.result()
+                        if on_result:
+                            on_result(results[futures[future]])
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+    report.seconds = time.perf_counter() - start
+    report.results = [results[index] for index in sorted(results)]
+    return report
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+KAMBIOS - plantillas con metadatos
+Nombres a partir de una plantilla como "{date:%Y%m%d}_{n:04}{ext}", ordenando por fecha, tamaño, etc.
+Solo se sacan los datos que la plantilla (o el orden) usan de verdad: para "{n} - viaje{ext}" no se abre
+ningún archivo. Lo que hay que leer de las cabeceras (EXIF, duración de vídeos) se lee en un pool de hilos
+y se guarda en una caché (sqlite) por carpeta, nombre, inodo, tamaño y mtime, así que volver a previsualizar
+40k fotos tras cambiar la plantilla no vuelve a abrir ninguna.
+
+Campos:
+    {n}         contador, en el orden elegido (desde start, 0 por defecto como al numerar)
+    {name}      nombre sin extensión          {ext}   extensión con el punto
+    {size}      tamaño en bytes               {mtime} fecha de modificación
+    {date}      fecha de la foto (EXIF) o del vídeo (MP4/MOV); si no hay, la de modificación
+    {duration}  duración en segundos (MP4/MOV/M4A/WAV); vacío si no se sabe
+Las fechas usan formato de strftime ({date:%Y-%m-%d}); los números, el de Python ({n:04}, {duration:.0f}).
+"""
+
+import os
+import json
+import wave
+import sqlite3
+import string
+import struct
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import kambiosCore as core
+
+
+FIELDS = ("n", "name", "ext", "size", "mtime", "date", "duration")
+SORT_KEYS = ("name", "size", "mtime", "date", "duration")
+STAT_FIELDS = ("size", "mtime")        # Salen del stat, no hace falta abrir el archivo
+HEADER_FIELDS = ("date", "duration")   # Hay que leer la cabecera
+HEADER_BYTES = 256 * 1024              # El EXIF va al principio; más allá no se busca
+META_WORKERS = 8                       # Hilos leyendo cabeceras (en un NAS, la latencia manda)
+META_CHUNK = 512                       # Archivos por tarea del pool (una tarea por archivo cuesta más que el stat)
+
+
+class TemplateError(ValueError):
+    pass
+
+
+# --- Plantillas ---
+
+class Template:
+    """
+    Una plantilla ya analizada: sabe qué campos usa para no sacar nada de más.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = []    # (texto_literal, campo o None, formato)
+        try:
+            for literal, field, spec, conversion in string.Formatter().parse(text):
+                if field is not None and field not in FIELDS:
+                    raise TemplateError(f"campo desconocido '{{{field}}}' (válidos: {', '.join(FIELDS)})")
+                if conversion:
+                    raise TemplateError(f"conversiones como '!{conversion}' no están soportadas")
+                self.parts.append((literal, field, spec or ""))
+        except ValueError as e:
+            if isinstance(e, TemplateError):
+                raise
+            raise TemplateError(f"plantilla mal formada: {e}")
+        self.fields = {field for _, field, _ in self.parts if field}
+
+    def render(self, values):
+        # Lo normal (todos los datos presentes) lo resuelve str.format en C; datetime entiende los %Y de strftime.
+        # Si falta alguno, str.format pondría "None": eso va por el camino lento, que lo deja vacío.
+        for field in self.fields:
+            if values.get(field) is None:
+                return self._render_slow(values)
+        try:
+            name = self.text.format_map(values)
+        except (ValueError, TypeError):
+            return self._render_slow(values)
+        return name.replace("/", "-").replace(os.sep, "-")
+
+    def _render_slow(self, values):
+        out = []
+        for literal, field, spec in self.parts:
+            out.append(literal)
+            if field is None:
+                continue
+            value = values.get(field)
+            if value is None:
+                continue   # Un dato que no hay (un vídeo sin duración) se queda vacío
+            try:
+                out.append(value.strftime(spec) if isinstance(value, datetime) and spec else format(value, spec))
+            except ValueError as e:
+                raise TemplateError(f"formato '{spec}' no vale para {{{field}}}: {e}")
+        # Una barra en el resultado (por ejemplo %D) crearía una ruta, no un nombre.
+        return "".join(out).replace("/", "-").replace(os.sep, "-")
+
+
+def is_template(text):
+    return "{" in text and "}" in text
+
+
+# --- Leer cabeceras ---
+
+def _exif_date(f):
+    # Fecha de la foto desde el EXIF de un JPEG o de un RAW/TIFF (DateTimeOriginal, o DateTime si no hay).
+    head = f.read(HEADER_BYTES)
+    if head[:2] == b"\xff\xd8":
+        pos = 2
+        while pos + 4 <= len(head) and head[pos] == 0xFF:
+            marker = head[pos + 1]
+            size = struct.unpack(">H", head[pos + 2:pos + 4])[0]
+            if marker == 0xE1 and head[pos + 4:pos + 10] == b"Exif\0\0":
+                return _tiff_date(head[pos + 10:pos + 2 + size])
+            if marker == 0xDA:   # Empiezan los datos de la imagen: ya no hay EXIF
+                return None
+            pos += 2 + size
+        return None
+    if head[:4] in (b"II*\0", b"MM\0*"):
+        return _tiff_date(head)
+    return None
+
+
+def _tiff_date(tiff):
+    endian = "<" if tiff[:2] == b"II" else ">"
+
+    def entries(offset):
+        if offset + 2 > len(tiff):
+            return {}
+        count = struct.unpack(endian + "H", tiff[offset:offset + 2])[0]
+        found = {}
+        for i in range(count):
+            start = offset + 2 + i * 12
+            if start + 12 > len(tiff):
+                break
+            tag, kind, n, value = struct.unpack(endian + "HHII", tiff[start:start + 12])
+            found[tag] = (kind, n, value, start + 8)
+        return found
+
+    def ascii_value(entry):
+        kind, n, value, inline = entry
+        data = tiff[inline:inline + n] if n <= 4 else tiff[value:value + n]
+        return data.split(b"\0", 1)[0].decode("ascii", "replace")
+
+    try:
+        ifd0 = entries(struct.unpack(endian + "I", tiff[4:8])[0])
+        candidates = []
+        if 0x8769 in ifd0:
+            exif = entries(ifd0[0x8769][2])
+            candidates += [exif[t] for t in (0x9003, 0x9004) if t in exif]
+        if 0x0132 in ifd0:
+            candidates.append(ifd0[0x0132])
+        for entry in candidates:
+            try:
+                return datetime.strptime(ascii_value(entry).strip(), "%Y:%m:%d %H:%M:%S")
+            except ValueError:
+                continue
+    except struct.error:
+        pass
+    return None
+
+
+_MP4_EPOCH = datetime(1904, 1, 1)
+
+
+def _mp4_header(f):
+    # (fecha de creación, duración) del átomo mvhd de un MP4/MOV. El moov puede ir al final: se salta por tamaños.
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    pos = 0
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return None, None
+        if kind == b"moov":
+            inner = f.read(min(size - header, HEADER_BYTES))
+            i = 0
+            while i + 8 <= len(inner):
+                box_size, box_kind = struct.unpack(">I4s", inner[i:i + 8])
+                if box_kind == b"mvhd":
+                    body = inner[i + 8:i + box_size]
+                    if body[:1] == b"\1":
+                        created, _, scale, duration = struct.unpack(">QQIQ", body[4:32])
+                    else:
+                        created, _, scale, duration = struct.unpack(">IIII", body[4:20])
+                    date = _MP4_EPOCH + timedelta(seconds=created) if created else None
+                    return date, (duration / scale if scale else None)
+                if box_size < 8:
+                    break
+                i += box_size
+            return None, None
+        pos += size
+    return None, None
+
+
+MP4_EXTENSIONS = (".mp4", ".m4v", ".m4a", ".mov", ".3gp")
+
+
+def read_header_fields(path):
+    """
+    {"date": datetime o None, "duration": segundos o None} leyendo solo la cabecera del archivo.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    date = duration = None
+    try:
+        if ext in MP4_EXTENSIONS:
+            with open(path, "rb") as f:
+                date, duration = _mp4_header(f)
+        elif ext == ".wav":
+            with wave.open(path, "rb") as w:
+                duration = w.getnframes() / float(w.getframerate() or 1)
+        else:
+            with open(path, "rb") as f:
+                date = _exif_date(f)
+    except (OSError, EOFError, struct.error, wave.Error, ValueError, OverflowError):
+        pass
+    return {"date": date, "duration": duration}
+
+
+# --- Caché de metadatos ---
+
+def default_cache_path():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "kambios", "meta.sqlite")
+
+
+def _encode(fields):
+    return json.dumps({k: v.isoformat() if isinstance(v, datetime) else v for k, v in fields.items()})
+
+
+def _decode(text):
+    fields = json.loads(text)
+    if fields.get("date"):
+        fields["date"] = datetime.fromisoformat(fields["date"])
+    return fields
+
+
+class MetadataReader:
+    """
+    Metadatos de los archivos de una carpeta. Guarda en memoria lo último que leyó (para que volver a
+    previsualizar sea inmediato) y en disco lo de las cabeceras, con la clave (inodo, tamaño, mtime):
+    si el archivo no ha cambiado, no se vuelve a abrir aunque se haya renombrado.
+    """
+
+    def __init__(self, folder, cache_path=None, workers=META_WORKERS):
+        self.folder = folder
+        self.cache_path = cache_path or default_cache_path()
+        self.workers = workers
+        self.known = {}        # nombre -> (clave del stat, {campo: valor})
+        self._loaded = False
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        db = sqlite3.connect(self.cache_path)
+        db.execute("CREATE TABLE IF NOT EXISTS meta (folder TEXT, ino INTEGER, size INTEGER, mtime INTEGER, "
+                   "fields TEXT, PRIMARY KEY (folder, ino, size, mtime))")
+        return db
+
+    def ready(self, names, needed):
+        """
+        True si todo lo necesario ya está en memoria (para la vista previa en vivo, que no debe esperar).
+        """
+        needed = set(needed) & set(HEADER_FIELDS)
+        known = self.known
+        for name in names:
+            entry = known.get(name)
+            if entry is None or not needed <= entry[1].keys():
+                return False
+        return True
+
+    def read(self, names, needed, restat=True, progress=None, cancel=None):
+        """
+        {nombre: {campo: valor}} con los campos pedidos (más size y mtime, que salen gratis del stat).
+        Con restat=False se fía de lo que ya tiene en memoria (la GUI lo usa si la carpeta no ha cambiado).
+        """
+        needed = set(needed)
+        want_header = needed & set(HEADER_FIELDS)
+        want_stat = bool(needed & (set(STAT_FIELDS) | set(HEADER_FIELDS)))
+        if not want_stat:
+            return {}
+        total = len(names)
+        if restat or not self.ready(names, want_header):
+            self._stat_all(names, cancel)
+        missing = [name for name in names if not want_header <= self.known[name][1].keys()]
+        if missing:
+            self._fill_from_cache(missing, want_header)
+            missing = [name for name in missing if not want_header <= self.known[name][1].keys()]
+        if missing:
+            self._read_headers(missing, want_header, total, progress, cancel)
+        elif progress:
+            progress(total, total)
+        return {name: self.known[name][1] for name in names}
+
+    def _stat_all(self, names, cancel):
+        folder = self.folder
+        known = self.known
+
+        def stat(chunk):
+            keys = []
+            for name in chunk:
+                st = os.stat(os.path.join(folder, name))
+                keys.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            return chunk, keys
+
+        # El stat también va en paralelo (en un recurso de red cada uno es un viaje), por trozos.
+        chunks = [names[i:i + META_CHUNK] for i in range(0, len(names), META_CHUNK)]
+        with ThreadPoolExecutor(self.workers) as pool:
+            for chunk, keys in pool.map(stat, chunks):
+                for name, key in zip(chunk, keys):
+                    old = known.get(name)
+                    if old is None or old[0] != key:
+                        known[name] = (key, {"size": key[1], "mtime": datetime.fromtimestamp(key[2] / 1e9)})
+                if cancel is not None and cancel.is_set():
+                    raise core.Cancelled()
+
+    def _fill_from_cache(self, names, want):
+        # Una sola consulta por carpeta (40k consultas sueltas serían segundos).
+        db = self._connect()
+        try:
+            rows = db.execute("SELECT ino, size, mtime, fields FROM meta WHERE folder=?", (self.folder,))
+            cached = {(ino, size, mtime): fields for ino, size, mtime, fields in rows}
+        finally:
+            db.close()
+        for name in names:
+            key, fields = self.known[name]
+            row = cached.get(key)
+            if row is not None:
+                fields.update(_decode(row))
+
+    def _read_headers(self, names, want, total, progress, cancel):
+        folder = self.folder
+        done = total - len(names)
+
+        def read(chunk):
+            if cancel is not None and cancel.is_set():
+                return []
+            return [(name, read_header_fields(os.path.join(folder, name))) for name in chunk]
+
+        # Trozos pequeños: abrir un archivo sí cuesta, y así el progreso avanza seguido.
+        chunks = [names[i:i + 64] for i in range(0, len(names), 64)]
+        fresh = []
+        with ThreadPoolExecutor(self.workers) as pool:
+            for results in pool.map(read, chunks):
+                for name, fields in results:
+                    key, known = self.known[name]
+                    known.update(fields)
+                    fresh.append((self.folder,) + key + (_encode(fields),))
+                done += len(results)
+                if progress:
+                    progress(done, total)
+        if fresh:
+            # Todo de una vez, en una transacción: lo leído no se pierde aunque luego se cancele.
+            db = self._connect()
+            try:
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?, ?)", fresh)
+            finally:
+                db.close()
+        if cancel is not None and cancel.is_set():
+            raise core.Cancelled()
+
+
+# --- El plan ---
+
+def template_plan(files, template, reader=None, sort=None, descending=False, start=0,
+                  restat=True, progress=None, cancel=None):
+    """
+    Plan para una plantilla. sort ordena antes de numerar (por nombre, tamaño, fecha...); sin sort,
+    el orden del listado, como al numerar. Sin reader solo valen {n}, {name} y {ext}.
+    """
+    if not isinstance(template, Template):
+        template = Template(template)
+    if sort is not None and sort not in SORT_KEYS:
+        raise TemplateError(f"no se puede ordenar por '{sort}' (válidos: {', '.join(SORT_KEYS)})")
+    needed = set(template.fields)
+    if sort:
+        needed.add(sort)
+    meta = {}
+    if needed & (set(STAT_FIELDS) | set(HEADER_FIELDS)):
+        if reader is None:
+            raise TemplateError("esta plantilla necesita leer metadatos de los archivos")
+        meta = reader.read(files, needed, restat=restat, progress=progress, cancel=cancel)
+
+    files = list(files)
+    if sort == "name":
+        files.sort(key=str.lower, reverse=descending)
+    elif sort:
+        def value_of(name):
+            value = meta[name].get(sort)
+            if sort == "date" and value is None:
+                value = meta[name]["mtime"]
+            return value
+
+        # Los que no tienen el dato van al final también con descending, y entre ellos, por nombre.
+        with_value = [(value_of(name), name) for name in files]
+        missing = sorted((name for value, name in with_value if value is None), key=str.lower)
+        with_value = [(value, name.lower(), name) for value, name in with_value if value is not None]
+        with_value.sort(reverse=descending)
+        files = [name for _, _, name in with_value] + missing
+
+    changes = []
+    splitext = os.path.splitext
+    for i, filename in enumerate(files, start):
+        if meta:
+            values = dict(meta[filename])
+            if values.get("date") is None:
+                values["date"] = values.get("mtime")
+        else:
+            values = {}
+        values["n"] = i
+        values["name"], values["ext"] = splitext(filename)
+        new_name = template.render(values)
+        if new_name and filename != new_name:
+            changes.append((filename, new_name))
+    return changes
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+KAMBIOS - métricas por fase y modo perfil
+Cuando algo va lento, hay que saber si el tiempo se va en listar, en hacer el plan, en buscar conflictos,
+en renombrar o en guardar el historial. El motor marca esas fases con phase("nombre"), y mientras hay un
+Recorder activo cada fase apunta su tiempo, los archivos que trató, las llamadas al sistema y el pico de
+memoria. Sin Recorder, phase() y count() no hacen nada (lo normal).
+
+La CLI y la GUI lo activan con recording(): una línea JSON por operación (--metrics o KAMBIOS_METRICS),
+y si se pide (--profile o KAMBIOS_PROFILE), cProfile y tracemalloc dejan sus informes en una carpeta.
+No depende de nada del resto de Kambios.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource  # No existe en Windows
+except ImportError:
+    resource = None
+
+
+METRICS_ENV = "KAMBIOS_METRICS"   # Archivo donde añadir las líneas JSON ("-" = stderr)
+PROFILE_ENV = "KAMBIOS_PROFILE"   # Carpeta donde dejar los informes de cProfile/tracemalloc
+PROFILE_TOP = 40                  # Funciones y líneas que salen en el informe de texto
+
+_recorder = None        # El Recorder activo (solo uno a la vez)
+_hooked = False
+
+
+# --- Medidas del proceso ---
+
+def read_proc_io():
+    # Lecturas y escrituras (llamadas, no bytes) que apunta el kernel. Solo Linux.
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(":") for line in f)}
+    except OSError:
+        return None
+
+
+def reset_peak_rss():
+    # En Linux, escribir 5 en clear_refs pone el pico (VmHWM) al RSS de ahora: así cada fase mide el suyo.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # Sin /proc: el pico de todo el proceso (en macOS viene en bytes, en Linux en KB).
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _audit(event, args):
+    # Cuenta las llamadas al sistema que Python avisa (os.rename, os.scandir, open...). renameat2 va por
+    # ctypes y fsync no tiene evento: esas las cuenta el motor con count().
+    # Las lecturas de /proc/self son las de las propias medidas: no cuentan.
+    recorder = _recorder
+    if recorder is None or not (event == "open" or event.startswith("os.")):
+        return
+    if event == "open" and isinstance(args[0], str) and args[0].startswith("/proc/self/"):
+        return
+    recorder.count(event)
+
+
+# --- Fases ---
+
+class _NoPhase:
+    # Lo que devuelve phase() sin Recorder: se puede usar igual y no apunta nada.
+    files = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_PHASE = _NoPhase()
+
+
+class Phase:
+    """
+    Una fase en marcha (with recorder.phase(...) as p). Si al empezar no se sabe cuántos archivos va a
+    tratar, se puede poner después en p.files.
+    Las fases se pueden anidar: la de dentro se apunta como "fuera/dentro" (por ejemplo "apply/rename").
+    """
+
+    def __init__(self, recorder, name, files=None):
+        self.recorder = recorder
+        self.name = name
+        self.files = files
+
+    def __enter__(self):
+        stack = self.recorder._stack()
+        self.path = "/".join(stack + [self.name])
+        if not stack and self.recorder.reset_peak:
+            reset_peak_rss()
+        stack.append(self.name)
+        self._io = read_proc_io()
+        self._calls = self.recorder.snapshot()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        calls = self.recorder.snapshot()
+        io = read_proc_io()
+        self.recorder._stack().pop()
+        counts = {event: n - self._calls.get(event, 0) for event, n in calls.items()
+                  if n != self._calls.get(event, 0)}
+        if io and self._io:
+            counts["read"] = io["syscr"] - self._io["syscr"]
+            counts["write"] = io["syscw"] - self._io["syscw"]
+        peak = peak_rss_mb()
+        self.recorder.add({
+            "phase": self.path,
+            "seconds": round(seconds, 6),
+            "files": self.files,
+            "per_second": round(self.files / seconds) if self.files and seconds else None,
+            "peak_rss_mb": round(peak, 1) if peak is not None else None,
+            "syscalls": sum(counts.values()),
+            "calls": counts,
+            "ok": exc_type is None,
+        })
+        return False
+
+
+class Recorder:
+    """
+    Apunta las fases de una operación. reset_peak: cada fase de primer nivel mide su propio pico de memoria
+    (si no, el pico es el de todo el proceso hasta ese momento).
+    Las fases de cada hilo van por separado; los contadores son de todo el proceso.
+    """
+
+    def __init__(self, operation, reset_peak=False):
+        self.operation = operation
+        self.reset_peak = reset_peak
+        self.phases = []
+        self.ok = True
+        self.timestamp = time.time()
+        self._start = time.perf_counter()
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def phase(self, name, files=None):
+        return Phase(self, name, files)
+
+    def count(self, event, n=1):
+        with self._lock:
+            self._calls[event] = self._calls.get(event, 0) + n
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._calls)
+
+    def add(self, record):
+        with self._lock:
+            self.phases.append(record)
+
+    def report(self):
+        # Las fases salen en el orden en que terminaron (las de dentro antes que la de fuera).
+        return {
+            "operation": self.operation,
+            "timestamp": self.timestamp,
+            "seconds": round(time.perf_counter() - self._start, 6),
+            "ok": self.ok,
+            "phases": list(self.phases),
+        }
+
+
+def phase(name, files=None):
+    """
+    Marca una fase del Recorder activo. Sin Recorder, no hace nada (y casi no cuesta).
+    """
+    recorder = _recorder
+    if recorder is None:
+        return _NO_PHASE
+    return recorder.phase(name, files)
+
+
+def count(event, n=1):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.count(event, n)
+
+
+def start(operation, reset_peak=False):
+    """
+    Activa un Recorder para operation y lo devuelve (None si ya había uno: sus fases van al que está).
+    """
+    global _recorder, _hooked
+    if _recorder is not None:
+        return None
+    if not _hooked:
+        sys.addaudithook(_audit)  # Los audit hooks no se pueden quitar: sin Recorder, _audit no hace nada
+        _hooked = True
+    _recorder = Recorder(operation, reset_peak)
+    return _recorder
+
+
+def stop(recorder):
+    global _recorder
+    if recorder is not None and _recorder is recorder:
+        _recorder = None
+
+
+# --- Salida ---
+
+def emit(report, sink):
+    # Una línea JSON por operación, añadida al final (sink "-" = stderr).
+    line = json.dumps(report, ensure_ascii=False) + "\n"
+    if sink == "-":
+        sys.stderr.write(line)
+        return
+    with open(sink, "a", encoding="utf-8") as f:
+        f.write(line)
+
+
+class Profiler:
+    """
+    cProfile y tracemalloc alrededor de una operación. cProfile solo ve el hilo que lo arranca (en la GUI,
+    el de la tarea); tracemalloc, la memoria de todos.
+    save() deja en folder un .prof (para pstats o snakeviz) y un .txt con lo más caro y lo que más memoria usó.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.profile = cProfile.Profile()
+        self._started_tracing = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self._started_tracing = True
+        self.profile.enable()
+
+    def save(self, folder):
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self._started_tracing:
+            tracemalloc.stop()
+
+        os.makedirs(folder, exist_ok=True)
+        base = os.path.join(folder, f"kambios-{self.operation}-{time.strftime('%Y%m%d-%H%M%S')}")
+        self.profile.dump_stats(base + ".prof")
+        text = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=text)
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(f"=== {self.operation}: tiempo (cProfile, por tiempo acumulado) ===\n")
+            f.write(text.getvalue())
+            f.write(f"\n=== Memoria (tracemalloc): ahora {current / 1048576:.1f} MB, pico {peak / 1048576:.1f} MB ===\n")
+            for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+                f.write(f"{stat}\n")
+        return base
+
+
+@contextmanager
+def recording(operation, sink=None, profile_dir=None):
+    """
+    Mide una operación entera. sink y profile_dir, si no se dan, salen de KAMBIOS_METRICS y KAMBIOS_PROFILE;
+    si no hay ninguno, no hace nada. Da el Recorder (o None) para poder marcar ok = False si la operación
+    no acabó bien sin lanzar excepción.
+    """
+    sink = sink or os.environ.get(METRICS_ENV) or None
+    profile_dir = profile_dir or os.environ.get(PROFILE_ENV) or None
+    recorder = start(operation) if sink else None
+    profiler = Profiler(operation) if profile_dir else None
+    if profiler:
+        profiler.start()
+    try:
+        yield recorder
+    except BaseException:
+        if recorder:
+            recorder.ok = False
+        raise
+    finally:
+        stop(recorder)
+        if recorder:
+            try:
+                emit(recorder.report(), sink)
+            except OSError as e:
+                print(f"⚠️  No se pudieron guardar las métricas: {e}", file=sys.stderr)
+        if profiler:
+            try:
+                base = profiler.save(profile_dir)
+                print(f"📊 Perfil guardado en {base}.prof y {base}.txt", file=sys.stderr)
+            except OSError as e:
+                print(f"⚠️  No se pudo guardar el perfil: {e}", file=sys.stderr)
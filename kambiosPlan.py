@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+KAMBIOS - planes enormes con memoria acotada
+Con millones de archivos, una lista de tuplas (viejo, nuevo) más los sets para buscar duplicados se comen
+gigas antes de renombrar nada. Aquí está lo necesario para no tener el plan entero en memoria:
+
+- PlanStore: un plan guardado en compacto (los nombres en un solo bloque de bytes y un array de posiciones),
+  que pasa a un archivo temporal si crece más de la cuenta.
+- PlanChecker: duplicados y conflictos en streaming. Mientras quepa, con sets en memoria; si no, reparte los
+  nombres por hash en archivos temporales y comprueba cada trozo por separado.
+- apply_large: aplica un plan que se lee dos veces (un archivo JSONL, por ejemplo). Lo que no depende de
+  nada se renombra según se lee; las cadenas y ciclos (nombres que son origen y destino a la vez) se
+  apartan a un PlanStore y van al final: ordenados en memoria si caben, y si no, en dos pasadas por
+  temporales. El diario y el historial ya se escriben en streaming (ver kambiosCore).
+"""
+
+import os
+import mmap
+import zlib
+import tempfile
+from array import array
+from collections import deque
+
+import kambiosCore as core
+import kambiosMetrics as metrics
+
+
+PLAN_MEMORY_BUDGET = 1_000_000       # Nombres en sets en memoria antes de pasar a disco
+STORE_BUDGET = 64 * 1024 * 1024      # Bytes de un PlanStore en memoria antes de pasar a un archivo temporal
+SPILL_BUCKETS = 256                  # Trozos en los que se reparten los nombres al pasar a disco
+FILTER_BITS = 8                      # Bits por nombre de un NameFilter
+FILTER_HASHES = 4                    # Bits que marca cada nombre (con 8 por nombre, ~2% de falsos positivos)
+
+
+def _encode(name):
+    # surrogateescape: los nombres que no son UTF-8 válido (bytes sueltos) van y vuelven tal cual.
+    return name.encode("utf-8", "surrogateescape")
+
+
+def _decode(data):
+    return data.decode("utf-8", "surrogateescape")
+
+
+# --- Plan compacto ---
+
+class PlanStore:
+    """
+    Lista de cambios (viejo, nuevo) en compacto: cada cambio son sus bytes más 8 de posición, en vez de una
+    tupla y dos str (unos 150 bytes más). Se puede recorrer, indexar y medir como una lista.
+    Pasados budget bytes (por defecto STORE_BUDGET), el bloque de nombres pasa a un archivo temporal y solo
+    las posiciones quedan en memoria.
+    """
+
+    def __init__(self, changes=(), budget=None):
+        self.budget = STORE_BUDGET if budget is None else budget
+        self._offsets = array("Q")
+        self._buffer = bytearray()
+        self._file = None
+        self._map = None
+        self._size = 0
+        self.extend(changes)
+
+    def append(self, old, new):
+        data = _encode(old) + b"\0" + _encode(new) + b"\0"
+        self._offsets.append(self._size)
+        self._size += len(data)
+        if self._file is not None:
+            self._file.write(data)
+            self._unmap()
+            return
+        self._buffer += data
+        if len(self._buffer) > self.budget:
+            self._file = tempfile.TemporaryFile(prefix="kambios_plan_")
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+
+    def extend(self, changes):
+        for old, new in changes:
+            self.append(old, new)
+
+    def truncate(self, count):
+        # Se queda con los count primeros (lo que sí se llegó a hacer, por ejemplo).
+        if count >= len(self._offsets):
+            return
+        self._size = self._offsets[count]
+        del self._offsets[count:]
+        if self._file is None:
+            del self._buffer[self._size:]
+        else:
+            self._unmap()
+            self._file.flush()
+            self._file.truncate(self._size)
+            self._file.seek(self._size)
+
+    def _unmap(self):
+        # Lo escrito después del mmap no se ve en él: se vuelve a mapear al leer.
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _data(self):
+        if self._file is None:
+            return self._buffer
+        if self._map is None:
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._offsets)
+        start = self._offsets[index]
+        end = self._offsets[index + 1] if index + 1 < len(self._offsets) else self._size
+        old, new, _ = bytes(self._data()[start:end]).split(b"\0")
+        return _decode(old), _decode(new)
+
+    def __iter__(self):
+        for index in range(len(self._offsets)):
+            yield self[index]
+
+    def close(self):
+        self._unmap()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+# --- Duplicados y conflictos con memoria acotada ---
+
+class NameFilter:
+    """
+    Un set de nombres aproximado (filtro de Bloom): unos pocos bits por nombre en vez de un str entero.
+    "in" nunca falla con un nombre que se añadió; con uno que no, a veces dice que sí (ver FILTER_BITS).
+    Solo vale en el mismo proceso: usa hash(), que cambia de una ejecución a otra.
+    """
+
+    def __init__(self, count, bits_per_name=FILTER_BITS):
+        self.size = max(64, count * bits_per_name)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, name):
+        h = hash(name) & 0xFFFFFFFFFFFFFFFF
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [(h1 + i * h2) % self.size for i in range(FILTER_HASHES)]
+
+    def add(self, name):
+        for bit in self._positions(name):
+            self._bits[bit >> 3] |= 1 << (bit & 7)
+
+    def update(self, names):
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name):
+        return all(self._bits[bit >> 3] & (1 << (bit & 7)) for bit in self._positions(name))
+
+
+class PlanCheck:
+    """
+    Resultado de PlanChecker. summary() tiene la misma forma que core.summarize_plan.
+    dependent: nombres que son destino de un cambio y origen de otro (cadenas y ciclos; solo con la carpeta).
+    Si el plan pasó a disco es un NameFilter: puede incluir algún nombre de más, nunca de menos.
+    """
+
+    def __init__(self, count, first, last, duplicates, conflicts, dependent):
+        self.count = count
+        self.first = first
+        self.last = last
+        self.duplicates = duplicates
+        self.conflicts = conflicts
+        self.dependent = dependent
+
+    def summary(self):
+        return {"count": self.count, "first": self.first, "last": self.last, "duplicates": self.duplicates}
+
+
+def _check_names(targets, dups, sources, existing):
+    # Lo mismo que core.find_conflicts, pero con los nombres ya repartidos (en memoria o un trozo del disco).
+    conflicts = []
+    dependent = set()
+    if existing is not None:
+        conflicts += [(name, "no existe") for name in sources if name not in existing]
+        conflicts += [(name, "duplicado") for name in dups]
+        conflicts += [(name, "ya existe") for name in targets if name in existing and name not in sources]
+        conflicts += [(name, "nombre no válido") for name in targets if not core.is_plain_name(name)]
+        dependent = targets & sources
+    return conflicts, dependent
+
+
+class PlanChecker:
+    """
+    Revisa un plan según pasa (con add o feed): total, primeros y últimos cambios y duplicados; y si se
+    le da la carpeta (add_existing), también los conflictos, igual que core.find_conflicts.
+    Mientras los nombres quepan en budget (por defecto PLAN_MEMORY_BUDGET), todo va en sets; pasado eso,
+    cada nombre se apunta en uno de SPILL_BUCKETS archivos temporales según su hash, y finish() comprueba
+    los trozos de uno en uno.
+    """
+
+    def __init__(self, head=5, budget=None, with_folder=False):
+        self.head = head
+        self.budget = PLAN_MEMORY_BUDGET if budget is None else budget
+        self.with_folder = with_folder
+        self.count = 0
+        self.first = []
+        self.last = deque(maxlen=head)
+        self._targets = set()
+        self._dups = set()
+        self._sources = set() if with_folder else None
+        self._existing = set() if with_folder else None
+        self._buckets = None
+        self._dir = None
+
+    def add(self, old, new):
+        if self.count < self.head:
+            self.first.append((old, new))
+        else:
+            self.last.append((old, new))
+        self.count += 1
+        if self._buckets is not None:
+            self._spill(b"T", new)
+            if self.with_folder:
+                self._spill(b"S", old)
+            return
+        if new in self._targets:
+            self._dups.add(new)
+        self._targets.add(new)
+        if self.with_folder:
+            self._sources.add(old)
+        self._check_budget()
+
+    def feed(self, changes):
+        # Deja pasar los cambios apuntándolos por el camino (para escribir el plan y revisarlo a la vez).
+        for old, new in changes:
+            self.add(old, new)
+            yield old, new
+
+    def add_existing(self, names):
+        for name in names:
+            if self._buckets is not None:
+                self._spill(b"E", name)
+                continue
+            self._existing.add(name)
+            self._check_budget()
+
+    def _check_budget(self):
+        size = len(self._targets) + (len(self._sources) + len(self._existing) if self.with_folder else 0)
+        if size <= self.budget:
+            return
+        # A disco: lo que ya había en los sets se reparte igual que lo que venga después.
+        self._dir = tempfile.TemporaryDirectory(prefix="kambios_check_")
+        self._buckets = [open(os.path.join(self._dir.name, f"{i:03d}"), "wb") for i in range(SPILL_BUCKETS)]
+        for name in self._targets:
+            self._spill(b"T", name)
+        for name in self._dups:
+            self._spill(b"T", name)
+        if self.with_folder:
+            for name in self._sources:
+                self._spill(b"S", name)
+            for name in self._existing:
+                self._spill(b"E", name)
+        self._targets = self._dups = self._sources = self._existing = None
+
+    def _spill(self, tag, name):
+        data = _encode(name)
+        # Un nombre no puede llevar \0, así que sirve de separador.
+        self._buckets[zlib.crc32(data) % SPILL_BUCKETS].write(tag + data + b"\0")
+
+    @property
+    def spilled(self):
+        return self._buckets is not None
+
+    def finish(self):
+        if self._buckets is None:
+            conflicts, dependent = _check_names(self._targets, self._dups, self._sources, self._existing)
+            duplicates = sorted(self._dups)
+        else:
+            duplicates, conflicts = [], []
+            dependent = NameFilter(self.count)
+            for bucket in self._buckets:
+                bucket.close()
+            for bucket in self._buckets:
+                targets, dups, sources = set(), set(), set()
+                existing = set() if self.with_folder else None
+                with open(bucket.name, "rb") as f:
+                    records = f.read().split(b"\0")
+                for record in records[:-1]:
+                    tag, name = record[:1], _decode(record[1:])
+                    if tag == b"T":
+                        if name in targets:
+                            dups.add(name)
+                        targets.add(name)
+                    elif tag == b"S":
+                        sources.add(name)
+                    else:
+                        existing.add(name)
+                os.remove(bucket.name)
+                more_conflicts, more_dependent = _check_names(targets, dups, sources, existing)
+                duplicates += dups
+                conflicts += more_conflicts
+                dependent.update(more_dependent)
+            self._dir.cleanup()
+            self._buckets = None
+            duplicates.sort()
+            conflicts.sort()
+        return PlanCheck(self.count, self.first, list(self.last), duplicates, conflicts,
+                         dependent if self.with_folder else None)
+
+
+def check_plan(changes, head=5, budget=None):
+    """
+    Como core.summarize_plan (misma forma de resultado), pero sin pasarse de budget nombres en memoria.
+    """
+    checker = PlanChecker(head, budget)
+    for old, new in changes:
+        checker.add(old, new)
+    return checker.finish().summary()
+
+
+# --- Aplicar un plan enorme ---
+
+def _parked_names(reserved):
+    # Temporales para _parked_steps, siempre los mismos y en el mismo orden (se recorren dos veces).
+    index = 0
+    while True:
+        name = f"{core.TEMP_PREFIX}{os.getpid()}_{index}"
+        index += 1
+        if name not in reserved:
+            yield name
+
+
+def _parked_steps(chained, reserved):
+    """
+    Pasos para las cadenas y ciclos sin ordenarlos: cada origen se aparta a un temporal y, cuando ya están
+    todos fuera, cada temporal va a su destino. El doble de renombres, pero nada en memoria por cambio.
+    reserved: nombres con el prefijo de los temporales que ya hay en la carpeta o en el plan.
+    """
+    for (old, _), temp in zip(chained, _parked_names(reserved)):
+        yield old, temp
+    for (_, new), temp in zip(chained, _parked_names(reserved)):
+        yield temp, new
+
+
+def _parked_changes(chained, count, reserved):
+    # Cambios netos de los count primeros pasos de _parked_steps (lo que se llegó a hacer si se corta).
+    moved = count - len(chained)
+    for i, ((old, new), temp) in enumerate(zip(chained, _parked_names(reserved))):
+        if i >= count:
+            break
+        yield (old, new) if i < moved else (old, temp)
+
+
+def apply_large(folder, open_changes, source, budget=None, progress=None, cancel=None):
+    """
+    Aplica un plan sin cargarlo entero. open_changes() tiene que devolver el plan desde el principio cada
+    vez (se recorre dos veces): la primera para revisarlo contra la carpeta, la segunda para renombrar.
+    Lo que no es origen ni destino de otro cambio se renombra según se lee, apuntándolo en el diario por lotes.
+    Las cadenas y ciclos se apartan a un PlanStore y van al final: si son menos de budget (por defecto
+    PLAN_MEMORY_BUDGET), ordenados en memoria (core.order_renames); si no, cada uno pasa por un temporal
+    (_parked_steps), y una cancelación en esa parte espera a que todos lleguen a su destino.
+    Devuelve los cambios hechos en un PlanStore, que cierra quien llama (with apply_large(...) as done).
+    Errores y cancelaciones como core.apply_plan; su done también es un PlanStore que hay que cerrar.
+    Como aquí no se guardan inodos, si se corta a mitad la recuperación compara nombres (como en Windows).
+    """
+    if budget is None:
+        budget = PLAN_MEMORY_BUDGET
+    reserved = set()  # Temporales que ya existen: pocos o ninguno
+
+    def folder_names():
+        for entry in core.iter_scan(folder):
+            if entry.name.startswith(core.TEMP_PREFIX):
+                reserved.add(entry.name)
+            yield entry.name
+
+    with metrics.phase("check") as phase:
+        checker = PlanChecker(budget=budget, with_folder=True)
+        for old, new in open_changes():
+            if old != new:
+                checker.add(old, new)
+                reserved.update(name for name in (old, new) if name.startswith(core.TEMP_PREFIX))
+        checker.add_existing(folder_names())
+        check = checker.finish()
+        phase.files = check.count
+    if check.conflicts:
+        raise core.PlanConflictError(check.conflicts)
+
+    dependent = check.dependent
+    chained = PlanStore()
+    done = PlanStore()
+
+    def independent():
+        for old, new in open_changes():
+            if old == new:
+                continue
+            if old in dependent or new in dependent:
+                chained.append(old, new)
+                continue
+            done.append(old, new)
+            yield old, new
+
+    with core.RenameJournal(folder, source) as journal, chained:
+        try:
+            with metrics.phase("rename", check.count):
+                core.run_steps(folder, independent(), journal, progress, cancel, check.count)
+                streamed = journal.steps_done
+                if len(chained) <= budget:
+                    steps = core.order_renames(chained)
+                    try:
+                        core.run_steps(folder, steps, journal, progress, cancel, check.count)
+                    finally:
+                        done.extend(core.net_changes(steps[:journal.steps_done - streamed]))
+                else:
+                    try:
+                        core.run_steps(folder, _parked_steps(chained, reserved), journal, progress, cancel,
+                                       check.count + len(chained))
+                    finally:
+                        done.extend(_parked_changes(chained, journal.steps_done - streamed, reserved))
+        except core.PlanConflictError:
+            journal.discard()
+            done.close()
+            raise
+        except (core.RenameError, core.Cancelled) as e:
+            if journal.steps_done < len(done):
+                done.truncate(journal.steps_done)  # Se cortó en la parte en streaming: lo leído pero no hecho fuera
+            if len(done):
+                journal.commit(len(done))
+            else:
+                journal.discard()
+            if isinstance(e, core.Cancelled):
+                error = core.Cancelled()
+                error.done = done  # El PlanStore tal cual: Cancelled(done) lo copiaría a una lista
+                raise error
+            raise core.RenameError(e.error, done) from e.error
+        except BaseException:
+            journal.abort()
+            done.close()
+            raise
+        journal.commit(len(done))
+    return done
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+KAMBIOS - reglas encadenadas
+Varias transformaciones (reemplazos literales, regex, mayúsculas, espacios) que se compilan una vez y se
+aplican a cada nombre en una sola pasada. Limpiar un romset con 40 etiquetas es un plan y un deshacer,
+no 40. No depende de PyQt6: lo usan la CLI y la GUI igual.
+
+Las reglas se escriben una por línea (así se editan en la GUI y se guardan en los presets):
+
+    lit (USA) =>              quita "(USA)" (lo de la derecha puede estar vacío)
+    lit "  " => " "           entre comillas si importan los espacios de los extremos
+    re \\(Rev (\\d+)\\) => v\\1  regex con grupos (sintaxis de re.sub)
+    rei \\[!\\] =>              regex sin distinguir mayúsculas
+    case title                lower, upper o title
+    squeeze                   junta espacios repetidos y quita los de los extremos
+    # comentario
+
+Se aplican al nombre sin la extensión, que se conserva tal cual (como al numerar).
+Los literales seguidos se agrupan en un autómata Aho-Corasick y se buscan todos a la vez: en cada
+posición gana el más largo, y lo que se pone no se vuelve a mirar dentro del mismo grupo.
+"""
+
+import os
+import re
+import json
+
+
+RULE_TYPES = ("lit", "re", "rei", "case", "squeeze")
+CASE_MODES = ("lower", "upper", "title")
+
+
+class RuleError(ValueError):
+    """
+    Una regla mal escrita. .line es el número de línea (desde 1) si vino de un texto; .rule, su posición
+    en la lista (desde 1) si vino ya como dict (un preset en JSON, por ejemplo).
+    """
+
+    def __init__(self, message, line=None, rule=None):
+        if line:
+            message = f"Línea {line}: {message}"
+        elif rule:
+            message = f"Regla {rule}: {message}"
+        super().__init__(message)
+        self.line = line
+        self.rule = rule
+
+
+# --- Aho-Corasick: muchos literales en una pasada ---
+
+class AhoCorasick:
+    """
+    Autómata para buscar muchos textos a la vez en tiempo lineal (más las coincidencias).
+    Los estados son enteros; las transiciones, un dict por estado con solo los caracteres que existen.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        goto = [{}]
+        out = [()]    # Patrones (índices) que terminan en cada estado, incluidos los de los sufijos
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                nxt = goto[state].get(char)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][char] = nxt
+                    goto.append({})
+                    out.append(())
+                state = nxt
+            out[state] = out[state] + (index,)
+
+        # Enlaces de fallo por anchura: el sufijo más largo que también es un prefijo de algún patrón.
+        # De paso se resuelven las transiciones (las propias más las del estado de fallo), así al buscar
+        # no hay que ir saltando de fallo en fallo. Las de la raíz no se copian: se miran aparte.
+        fail = [0] * len(goto)
+        delta = [goto[0]] + [None] * (len(goto) - 1)
+        queue = list(goto[0].values())
+        for state in queue:
+            delta[state] = dict(delta[fail[state]], **goto[state]) if fail[state] else goto[state]
+            for char, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and char not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(char, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+        self._delta = delta
+        self._out = out
+        self._lengths = [len(p) for p in self.patterns]
+        # Desde la raíz se salta directo al siguiente carácter que puede empezar algo (búsqueda en C).
+        first = "".join(goto[0])
+        self._skip = re.compile("[" + re.escape(first) + "]") if first else None
+
+    def finditer(self, text):
+        """
+        Todas las coincidencias como (inicio, fin, índice_patrón), en orden de fin.
+        """
+        delta, out, lengths, skip = self._delta, self._out, self._lengths, self._skip
+        if skip is None:
+            return
+        root = delta[0]
+        state = 0
+        i = 0
+        n = len(text)
+        while i < n:
+            if not state:
+                m = skip.search(text, i)
+                if m is None:
+                    return
+                i = m.start()
+            char = text[i]
+            nxt = delta[state].get(char)
+            state = root.get(char, 0) if nxt is None else nxt
+            if out[state]:
+                for index in out[state]:
+                    yield i + 1 - lengths[index], i + 1, index
+            i += 1
+
+    def replace(self, text, replacements):
+        """
+        Cambia cada coincidencia por replacements[índice]: de izquierda a derecha, la más larga en cada
+        posición y sin solaparse (como haría str.replace con cada patrón, pero todos en una pasada).
+        """
+        matches = list(self.finditer(text))
+        if not matches:
+            return text
+        matches.sort(key=lambda m: (m[0], m[0] - m[1]))
+        parts = []
+        pos = 0
+        for start, end, index in matches:
+            if start < pos:
+                continue
+            parts.append(text[pos:start])
+            parts.append(replacements[index])
+            pos = end
+        parts.append(text[pos:])
+        return "".join(parts)
+
+
+# --- Reglas ---
+
+def _parse_operand(text, line):
+    text = text.strip()
+    if text.startswith('"'):
+        try:
+            value = json.loads(text)
+        except json.JSONDecodeError:
+            raise RuleError(f"comillas mal cerradas: {text}", line)
+        if not isinstance(value, str):
+            raise RuleError(f"se esperaba un texto: {text}", line)
+        return value
+    return text
+
+
+def _format_operand(value):
+    # Entre comillas solo si hace falta para que se lea igual de vuelta.
+    if value != value.strip() or value.startswith('"') or "=>" in value:
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def parse_rule(line, number=None):
+    """
+    Una línea de texto -> regla (dict), o None si es un comentario o está vacía.
+    """
+    stripped = line.strip()
+    if not stripped or stripped.startswith("#"):
+        return None
+    kind, _, rest = stripped.partition(" ")
+    if kind not in RULE_TYPES:
+        raise RuleError(f"regla desconocida '{kind}' (válidas: {', '.join(RULE_TYPES)})", number)
+    if kind == "squeeze":
+        return {"type": "squeeze"}
+    if kind == "case":
+        mode = rest.strip()
+        if mode not in CASE_MODES:
+            raise RuleError(f"'case' necesita {', '.join(CASE_MODES)}", number)
+        return {"type": "case", "mode": mode}
+    if "=>" not in rest:
+        raise RuleError(f"falta '=>' en '{stripped}'", number)
+    find, _, replace = rest.partition("=>")
+    find = _parse_operand(find, number)
+    if not find:
+        raise RuleError("no hay nada que buscar", number)
+    rule = {"type": "lit" if kind == "lit" else "re", "find": find, "with": _parse_operand(replace, number)}
+    if kind == "rei":
+        rule["ignore_case"] = True
+    return rule
+
+
+def check_rule(rule, index=None):
+    """
+    Lo mismo que comprueba parse_rule, para una regla que ya viene como dict (de un JSON).
+    index es su posición en la lista (desde 1), para el mensaje de error.
+    """
+    if not isinstance(rule, dict):
+        raise RuleError(f"se esperaba un objeto, no {json.dumps(rule, ensure_ascii=False)}", rule=index)
+    kind = rule.get("type")
+    if kind == "squeeze":
+        return
+    if kind == "case":
+        if rule.get("mode") not in CASE_MODES:
+            raise RuleError(f"'case' necesita {', '.join(CASE_MODES)}", rule=index)
+        return
+    if kind not in ("lit", "re"):
+        raise RuleError(f"regla desconocida '{kind}' (válidas: lit, re, case, squeeze)", rule=index)
+    if not isinstance(rule.get("find"), str) or not rule["find"]:
+        raise RuleError("no hay nada que buscar", rule=index)
+    if not isinstance(rule.get("with"), str):
+        raise RuleError("falta el texto que poner ('with')", rule=index)
+
+
+def parse_rules(text):
+    rules = []
+    for number, line in enumerate(text.splitlines(), 1):
+        rule = parse_rule(line, number)
+        if rule is not None:
+            rules.append(rule)
+    return rules
+
+
+def format_rule(rule):
+    kind = rule["type"]
+    if kind == "squeeze":
+        return "squeeze"
+    if kind == "case":
+        return f"case {rule['mode']}"
+    if kind == "re" and rule.get("ignore_case"):
+        kind = "rei"
+    return f"{kind} {_format_operand(rule['find'])} => {_format_operand(rule['with'])}".rstrip()
+
+
+def format_rules(rules):
+    return "\n".join(format_rule(rule) for rule in rules)
+
+
+# --- Cadena compilada ---
+
+_SPACES = re.compile(r"\s+")
+
+
+class Pipeline:
+    """
+    Las reglas ya compiladas en etapas: cada grupo de literales seguidos es un Aho-Corasick,
+    cada regex un re.compile, y los cambios de mayúsculas o espacios, métodos de str.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.stages = []
+        literals = []
+        for number, rule in enumerate(self.rules, 1):
+            if rule.get("type") == "lit":
+                literals.append(rule)
+                continue
+            self._flush_literals(literals)
+            literals = []
+            self.stages.append(self._compile(rule, number))
+        self._flush_literals(literals)
+
+    def _flush_literals(self, literals):
+        if not literals:
+            return
+        # Si el mismo texto sale dos veces, manda la primera regla (la que habría actuado antes).
+        replacements = {}
+        for rule in literals:
+            replacements.setdefault(rule["find"], rule["with"])
+        automaton = AhoCorasick(replacements)
+        values = list(replacements.values())
+        if len(replacements) == 1:
+            # Con un solo literal, str.replace (en C) es lo más rápido.
+            find, value = next(iter(replacements.items()))
+            self.stages.append(lambda name: name.replace(find, value))
+        else:
+            self.stages.append(lambda name: automaton.replace(name, values))
+
+    def _compile(self, rule, number):
+        kind = rule.get("type")
+        if kind == "re":
+            try:
+                pattern = re.compile(rule["find"], re.IGNORECASE if rule.get("ignore_case") else 0)
+                pattern.sub(rule["with"], "")  # Comprueba ya las referencias a grupos (\1, \g<x>)
+            except re.error as e:
+                raise RuleError(f"regex no válida '{rule['find']}': {e}", rule=number)
+            replacement = rule["with"]
+            return lambda name: pattern.sub(replacement, name)
+        if kind == "case":
+            if rule.get("mode") not in CASE_MODES:
+                raise RuleError(f"modo de 'case' no válido: {rule.get('mode')}", rule=number)
+            return getattr(str, rule["mode"])
+        if kind == "squeeze":
+            return lambda name: _SPACES.sub(" ", name).strip()
+        raise RuleError(f"regla desconocida: {rule}", rule=number)
+
+    def __call__(self, stem):
+        for stage in self.stages:
+            stem = stage(stem)
+        return stem
+
+
+def iter_pipeline_plan(files, rules):
+    """
+    Plan con todas las reglas aplicadas a cada nombre (sin la extensión) en una sola pasada, en streaming.
+    Acepta la lista de reglas o un Pipeline ya compilado. Si un nombre se quedara vacío, no se toca.
+    """
+    pipeline = rules if isinstance(rules, Pipeline) else Pipeline(rules)
+    for filename in files:
+        stem, ext = os.path.splitext(filename)
+        new_stem = pipeline(stem)
+        if not new_stem:
+            continue
+        new_name = new_stem + ext
+        if new_name != filename:
+            yield filename, new_name
+
+
+def pipeline_plan(files, rules):
+    return list(iter_pipeline_plan(files, rules))
+
+
+# --- Presets: cadenas guardadas con nombre, compartidas por la CLI y la GUI ---
+
+def presets_dir():
+    base = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(base, "kambios", "presets")
+
+
+def _preset_path(name):
+    if not name or os.sep in name or (os.altsep and os.altsep in name) or name.startswith("."):
+        raise RuleError(f"nombre de preset no válido: '{name}'")
+    return os.path.join(presets_dir(), name + ".json")
+
+
+def list_presets():
+    try:
+        names = os.listdir(presets_dir())
+    except FileNotFoundError:
+        return []
+    return sorted(n[:-5] for n in names if n.endswith(".json") and not n.startswith("."))
+
+
+def load_preset(name):
+    path = _preset_path(name)
+    try:
+        return load_rules_file(path)
+    except FileNotFoundError:
+        raise RuleError(f"no existe el preset '{name}'")
+
+
+def save_preset(name, rules):
+    for index, rule in enumerate(rules, 1):
+        check_rule(rule, index)
+    Pipeline(rules)  # No guardar algo que luego no compila
+    path = _preset_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"format": "kambios_rules", "version": 1, "rules": rules}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+    return path
+
+
+def delete_preset(name):
+    os.remove(_preset_path(name))
+
+
+def load_rules_file(path):
+    """
+    Reglas desde un archivo: un preset en JSON o un texto con una regla por línea.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if text.lstrip().startswith("{"):
+        data = json.loads(text)
+        rules = data.get("rules", [])
+        if not isinstance(rules, list):
+            raise RuleError("'rules' tiene que ser una lista")
+        for index, rule in enumerate(rules, 1):
+            check_rule(rule, index)
+    else:
+        rules = parse_rules(text)
+    Pipeline(rules)
+    return rules
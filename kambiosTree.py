@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+KAMBIOS - modo árbol (subcarpetas)
+Recorre una carpeta y sus subcarpetas con varios scandir a la vez (en un recurso de red, listar en paralelo
+es la diferencia entre minutos y horas), hace un plan independiente por carpeta (duplicados y conflictos
+se miran dentro de cada una) y los aplica en paralelo, una carpeta por hilo.
+
+Cada carpeta lleva su propio diario y su propio segmento de historial, así que lo que ya sabe hacer el
+motor (recuperar una operación cortada, deshacer) sigue valiendo carpeta a carpeta. Para deshacer todo el
+árbol de una vez, en la carpeta raíz se guarda además un índice (TREE_DIR) con qué operación se hizo en
+cada subcarpeta. El índice se abre antes de empezar y se completa según termina cada carpeta, así que si
+el proceso muere a mitad, recover_tree sabe qué carpetas quedaron por arreglar.
+"""
+
+import os
+import json
+import time
+import fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import kambiosCore as core
+
+
+TREE_DIR = os.path.join(core.HISTORY_DIR, "trees")
+WALK_WORKERS = 16     # scandir a la vez (en local da igual; en NFS/SMB es lo que más se nota)
+APPLY_WORKERS = 8     # Carpetas renombrándose a la vez
+TREE_KEEP = core.HISTORY_KEEP
+
+
+# --- Recorrer el árbol ---
+
+class TreeSnapshot:
+    """
+    Foto de un árbol: una FolderSnapshot por carpeta, con la ruta relativa a la raíz ("" es la raíz).
+    """
+
+    def __init__(self, root, folders, errors=()):
+        self.root = root
+        self.folders = folders   # [(ruta_relativa, FolderSnapshot)], ordenadas por ruta
+        self.errors = list(errors)  # (ruta, motivo) de las carpetas que no se pudieron leer
+
+    def __len__(self):
+        return sum(len(snapshot) for _, snapshot in self.folders)
+
+    def __iter__(self):
+        return iter(self.folders)
+
+
+def _excluded(name, relpath, exclude):
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relpath, pattern) for pattern in exclude)
+
+
+def _scan_one(root, reldir, include, extensions, exclude):
+    # Una carpeta: sus archivos (ya filtrados) y sus subcarpetas. Los enlaces a carpetas no se siguen (bucles).
+    folder = os.path.join(root, reldir) if reldir else root
+    names = []
+    subdirs = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            name = entry.name
+            relpath = os.path.join(reldir, name) if reldir else name
+            if name in core.INTERNAL_FILES or name == core.HISTORY_DIR:
+                continue
+            if exclude and _excluded(name, relpath, exclude):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(relpath)
+            elif entry.is_file() and core.name_matches(name, include, extensions):
+                names.append(name)
+    return reldir, core.FolderSnapshot(folder, names), subdirs
+
+
+def walk_tree(root, include=None, extensions=None, exclude=(), max_depth=None, workers=WALK_WORKERS,
+              progress=None, cancel=None):
+    """
+    Lista la raíz y sus subcarpetas con un pool de hilos: cada carpeta es una tarea, y sus subcarpetas se
+    van encolando según aparecen. include es un glob para los archivos (como --glob), exclude una lista de
+    globs que quitan archivos o carpetas (por nombre o por ruta relativa), y max_depth limita la profundidad
+    (0 = solo la raíz). progress(carpetas_leídas, 0) y cancel como en el resto del motor.
+    """
+    extensions = core.normalize_extensions(extensions)
+    exclude = tuple(exclude or ())
+    folders = []
+    errors = []
+    with ThreadPoolExecutor(workers) as pool:
+        pending = {pool.submit(_scan_one, root, "", include, extensions, exclude): 0}
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                depth = pending.pop(future)
+                try:
+                    reldir, snapshot, subdirs = future.result()
+                except OSError as e:
+                    # Una carpeta sin permisos no para todo el recorrido; se avisa al final.
+                    errors.append((getattr(e, "filename", None) or "?", str(e)))
+                    continue
+                folders.append((reldir, snapshot))
+                if max_depth is None or depth < max_depth:
+                    for sub in subdirs:
+                        pending[pool.submit(_scan_one, root, sub, include, extensions, exclude)] = depth + 1
+            if progress:
+                progress(len(folders), 0)
+            if cancel is not None and cancel.is_set():
+                for future in pending:
+                    future.cancel()
+                raise core.Cancelled()
+    folders.sort(key=lambda item: item[0])
+    return TreeSnapshot(root, folders, errors)
+
+
+# --- Planes por carpeta ---
+
+class TreePlan:
+    """
+    Los planes de cada carpeta: [(ruta_relativa, cambios)], solo las carpetas con algo que hacer.
+    Para enseñarlo todo junto, flat() da los cambios con la ruta relativa delante.
+    """
+
+    def __init__(self, root, plans):
+        self.root = root
+        self.plans = plans
+
+    def __len__(self):
+        return sum(len(changes) for _, changes in self.plans)
+
+    def flat(self):
+        return [(os.path.join(reldir, old), os.path.join(reldir, new)) if reldir else (old, new)
+                for reldir, changes in self.plans for old, new in changes]
+
+    def problems(self, tree=None):
+        """
+        (duplicados, conflictos) de todas las carpetas, con la ruta relativa. Se comprueba carpeta a carpeta:
+        el mismo nombre en dos subcarpetas distintas no es ningún problema.
+        """
+        snapshots = dict(tree.folders) if tree is not None else {}
+        duplicates = []
+        conflicts = []
+        for reldir, changes in self.plans:
+            prefix = (lambda name: os.path.join(reldir, name)) if reldir else (lambda name: name)
+            dups = core.find_duplicates(changes)
+            duplicates += [prefix(name) for name in dups]
+            if not dups and reldir in snapshots:
+                conflicts += [(prefix(name), reason) for name, reason in core.find_conflicts(changes, snapshots[reldir])]
+        return duplicates, conflicts
+
+
+def tree_plan(tree, build):
+    """
+    Aplica un constructor de planes a cada carpeta: build(foto) -> cambios. La foto trae la carpeta
+    (snapshot.folder) por si el plan necesita leer algo de los archivos, como las plantillas.
+    """
+    plans = []
+    for reldir, snapshot in tree.folders:
+        changes = list(build(snapshot))
+        if changes:
+            plans.append((reldir, changes))
+    return TreePlan(tree.root, plans)
+
+
+def split_flat(changes):
+    """
+    Al revés que TreePlan.flat: de cambios con ruta relativa a un plan por carpeta (para leer planes JSONL).
+    """
+    by_dir = {}
+    for old, new in changes:
+        reldir, old_name = os.path.split(old)
+        new_dir, new_name = os.path.split(new)
+        if new_dir != reldir:
+            raise ValueError(f"El modo árbol no mueve archivos entre carpetas: {old} → {new}")
+        by_dir.setdefault(reldir, []).append((old_name, new_name))
+    return sorted(by_dir.items())
+
+
+# --- Aplicar y deshacer ---
+
+class TreeResult:
+    """
+    Qué pasó al aplicar (o deshacer) un árbol: cuántos cambios por carpeta y qué carpetas fallaron.
+    """
+
+    def __init__(self):
+        self.done = {}       # ruta_relativa -> número de cambios hechos
+        self.errors = []     # (ruta_relativa, excepción)
+        self.tree_id = None  # Número del índice en TREE_DIR (al aplicar)
+
+    @property
+    def count(self):
+        return sum(self.done.values())
+
+
+def _folder(root, reldir):
+    return os.path.join(root, reldir) if reldir else root
+
+
+def _apply_folder(root, reldir, changes, source, progress, cancel):
+    # Igual que core.apply_plan, pero quedándose con el número de operación para el índice del árbol.
+    # Devuelve (cambios hechos, operación, fecha, error): si falla a mitad, lo hecho ya está en el historial.
+    folder = _folder(root, reldir)
+    with core.RenameJournal(folder, source) as journal:
+        try:
+            done = core.execute_plan(folder, changes, journal=journal, progress=progress, cancel=cancel)
+        except core.PlanConflictError:
+            journal.discard()
+            raise
+        except (core.RenameError, core.Cancelled) as e:
+            if not e.done:
+                journal.discard()
+                raise
+            journal.commit(len(e.done))
+            return len(e.done), journal.op_id, journal.timestamp, e
+        except BaseException:
+            journal.abort()
+            raise
+        journal.commit(len(done))
+    return len(done), journal.op_id, journal.timestamp, None
+
+
+def apply_tree(plan, source, workers=APPLY_WORKERS, progress=None, cancel=None):
+    """
+    Aplica los planes de todas las carpetas en paralelo. Una carpeta que falla no para a las demás:
+    lo que se hizo en cada una queda en su historial y en el índice del árbol, para deshacerlo todo junto.
+    El índice se abre antes de tocar ninguna carpeta y cada una se apunta al terminar: si el proceso muere a
+    mitad, recover_tree termina o revierte las que quedaron a medias. Devuelve un TreeResult.
+    """
+    result = TreeResult()
+    total = len(plan)
+    counted = [0]
+    lock = threading.Lock()
+    index = TreeIndex(plan.root, source, [reldir for reldir, _ in plan.plans])
+
+    def run(reldir, changes):
+        last = [0]
+
+        def folder_progress(done, _total=0):
+            with lock:
+                counted[0] += done - last[0]
+                last[0] = done
+                if progress:
+                    progress(counted[0], total)
+
+        try:
+            count, op_id, timestamp, error = _apply_folder(plan.root, reldir, changes, source,
+                                                           folder_progress, cancel)
+        except (OSError, ValueError, core.Cancelled) as e:
+            count, op_id, timestamp, error = 0, None, None, e
+        with lock:
+            if error is not None and not isinstance(error, core.Cancelled):
+                result.errors.append((reldir, error))
+            if count:
+                result.done[reldir] = count
+            index.folder(reldir, op_id, count, timestamp)
+
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            for future in [pool.submit(run, reldir, changes) for reldir, changes in plan.plans]:
+                future.result()
+    finally:
+        index.close()
+    result.tree_id = index.finish()
+    if cancel is not None and cancel.is_set():
+        # Lo hecho hasta cancelar ya está en el índice para deshacerlo.
+        raise core.Cancelled(result=result)
+    return result
+
+
+# --- Índice del árbol ---
+# Cada operación de árbol es un JSONL en TREE_DIR/NNNNNNNN.jsonl, escrito como el diario de una carpeta:
+#   {"op": "begin", "source", "timestamp", "folders": [rutas relativas que se van a tocar]}
+#   {"op": "folder", "folder", "id", "count", "timestamp"}  una por carpeta al terminar (id None si no hizo nada)
+#   {"op": "end"}
+# Sin "end", la operación se cortó: las carpetas sin su línea pueden tener un diario a medias (recover_tree).
+
+def _tree_path(root, tree_id):
+    return os.path.join(root, TREE_DIR, f"{tree_id:08d}.jsonl")
+
+
+def _tree_ids(root):
+    try:
+        names = os.listdir(os.path.join(root, TREE_DIR))
+    except FileNotFoundError:
+        return []
+    return sorted(int(n[:-6]) for n in names if n.endswith(".jsonl") and n[:-6].isdigit())
+
+
+def _tree_records(source, timestamp, planned, folders):
+    yield {"op": "begin", "source": source, "timestamp": timestamp, "folders": planned}
+    for reldir, op_id, count, folder_time in folders:
+        yield {"op": "folder", "folder": reldir, "id": op_id, "count": count, "timestamp": folder_time}
+
+
+class TreeIndex:
+    """
+    El índice de una operación de árbol mientras se aplica. Se crea con la lista de carpetas (la intención,
+    en disco antes de empezar); folder() apunta cada una al terminar y finish() lo cierra. Si no se hizo
+    nada en ninguna carpeta, finish() lo borra y devuelve None.
+    """
+
+    def __init__(self, root, source, planned):
+        self.root = root
+        self.count = 0
+        folder = os.path.join(root, TREE_DIR)
+        os.makedirs(folder, exist_ok=True)
+        ids = _tree_ids(root)
+        for old in ids[:max(0, len(ids) + 1 - TREE_KEEP)]:
+            if _read_tree_entry(root, old).complete:  # Una a medias se queda hasta que se recupere
+                os.remove(_tree_path(root, old))
+        self.tree_id = ids[-1] + 1 if ids else 1
+        self.path = _tree_path(root, self.tree_id)
+        self._f = open(self.path, "x", encoding="utf-8")
+        for record in _tree_records(source, time.time(), planned, []):
+            self._write(record)
+
+    def _write(self, record):
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def folder(self, reldir, op_id, count, timestamp):
+        self.count += count
+        self._write({"op": "folder", "folder": reldir, "id": op_id, "count": count, "timestamp": timestamp})
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+
+    def finish(self):
+        if not self.count:
+            self.close()
+            os.remove(self.path)
+            return None
+        if self._f is None:
+            self._f = open(self.path, "a", encoding="utf-8")
+        self._write({"op": "end"})
+        self.close()
+        return self.tree_id
+
+
+def _save_tree_entry(path, source, timestamp, folders):
+    # Reescribe un índice entero (ya terminado) de golpe, por ejemplo con lo que queda por deshacer.
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        for record in _tree_records(source, timestamp, [op[0] for op in folders], folders):
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.write(json.dumps({"op": "end"}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+class TreeEntry:
+    def __init__(self, tree_id, path, source, timestamp, folders, pending=(), complete=True):
+        self.id = tree_id
+        self.path = path
+        self.source = source
+        self.timestamp = timestamp
+        # [(ruta_relativa, número de operación, cambios, fecha)]. La fecha es la del segmento del historial:
+        # si alguien deshizo esa operación a mano y el número se reutilizó, no coincide y no se toca.
+        self.folders = folders
+        self.pending = list(pending)  # Carpetas que no llegaron a apuntarse (solo si complete es False)
+        self.complete = complete
+
+    @property
+    def count(self):
+        return sum(op[2] for op in self.folders)
+
+
+def _read_tree_entry(root, tree_id):
+    path = _tree_path(root, tree_id)
+    source = timestamp = None
+    planned = []
+    folders = []
+    finished = set()
+    complete = False
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break  # Última línea a medio escribir
+            op = record.get("op")
+            if op == "begin":
+                source, timestamp, planned = record.get("source"), record.get("timestamp"), record["folders"]
+            elif op == "folder":
+                finished.add(record["folder"])
+                if record.get("count"):
+                    folders.append((record["folder"], record["id"], record["count"], record["timestamp"]))
+            elif op == "end":
+                complete = True
+    pending = [] if complete else [reldir for reldir in planned if reldir not in finished]
+    return TreeEntry(tree_id, path, source, timestamp, sorted(folders), pending, complete)
+
+
+def has_tree_undo(root):
+    return bool(_tree_ids(root))
+
+
+def list_tree_history(root):
+    """
+    Operaciones de árbol que se pueden deshacer, de la más reciente a la más antigua (también las que se
+    cortaron a mitad: complete es False).
+    """
+    return [_read_tree_entry(root, tree_id) for tree_id in reversed(_tree_ids(root))]
+
+
+def recover_tree(root, mode):
+    """
+    Arregla las operaciones de árbol que se cortaron a mitad: cada carpeta que no llegó a apuntarse se
+    recupera con core.recover_journal(mode) y, si su operación acabó en el historial, entra en el índice.
+    Lo que sí se terminó sigue en el índice para deshacerlo con undo_tree. Devuelve un TreeResult con los
+    renombres hechos por carpeta; las carpetas que no se pudieron recuperar van en errors (y el índice
+    sigue a medias hasta arreglarlas).
+    """
+    result = TreeResult()
+    for entry in list_tree_history(root):
+        if entry.complete:
+            continue
+        folders = list(entry.folders)
+        stuck = False
+        for reldir in entry.pending:
+            folder = _folder(root, reldir)
+            try:
+                pending = core.read_journal(folder)
+                if pending is None:
+                    continue  # No llegó a empezar
+                result.done[reldir] = core.recover_journal(folder, mode)
+            except (OSError, ValueError) as e:
+                result.errors.append((reldir, e))
+                stuck = True
+                continue
+            if pending.undo_of is None and (mode == "forward" or pending.committed):
+                last = core.list_history(folder)[0]
+                folders.append((reldir, last.id, last.count, last.timestamp))
+        if stuck:
+            continue
+        if folders:
+            _save_tree_entry(entry.path, entry.source, entry.timestamp, sorted(folders))
+        else:
+            os.remove(entry.path)
+    return result
+
+
+def validate_tree_undo(root, entry):
+    """
+    Problemas para deshacer una operación de árbol, con la ruta relativa. Se valida todo antes de tocar nada.
+    """
+    problems = []
+    if not entry.complete:
+        problems.append((".", "operación de árbol interrumpida: arréglala antes con recover --tree"))
+    for reldir, op_id, _, timestamp in entry.folders:
+        folder = _folder(root, reldir)
+        history = core.read_history_entry(folder, op_id)
+        if history is None or history.timestamp != timestamp:
+            problems.append((reldir or ".", "ya no está en el historial de la carpeta"))
+            continue
+        for name, reason in core.validate_undo(folder, op_id):
+            problems.append((os.path.join(reldir, name) if reldir else name, reason))
+    return problems
+
+
+def undo_tree(root, tree_id=None, source=None, skip_missing=False, workers=APPLY_WORKERS,
+              progress=None, cancel=None):
+    """
+    Deshace una operación de árbol (por defecto, la última), una carpeta por hilo. Si algo impide deshacer
+    alguna carpeta, se lanza PlanConflictError sin tocar ninguna (salvo con skip_missing, que salta los
+    archivos que falten). Lo que se deshizo sale del índice; si alguna carpeta falla, se queda para reintentar.
+    """
+    entries = list_tree_history(root)
+    entry = next((e for e in entries if tree_id is None or e.id == tree_id), None)
+    if entry is None:
+        raise ValueError("No hay operación de árbol para deshacer." if tree_id is None
+                         else f"No existe la operación de árbol {tree_id}.")
+    problems = validate_tree_undo(root, entry)
+    blocking = [p for p in problems if not skip_missing or p[1] != "no existe"]
+    if blocking:
+        raise core.PlanConflictError(problems)
+
+    result = TreeResult()
+    lock = threading.Lock()
+    counted = [0]
+    remaining = []
+
+    def run(reldir, op_id, count, timestamp):
+        op = [reldir, op_id, count, timestamp]
+        try:
+            core.undo_operation(_folder(root, reldir), op_id, source, skip_missing=skip_missing, cancel=cancel)
+        except core.Cancelled:
+            with lock:
+                remaining.append(op)
+            return
+        except (OSError, ValueError) as e:
+            with lock:
+                result.errors.append((reldir, e))
+                remaining.append(op)
+            return
+        with lock:
+            result.done[reldir] = count
+            counted[0] += count
+            if progress:
+                progress(counted[0], entry.count)
+
+    with ThreadPoolExecutor(workers) as pool:
+        for future in [pool.submit(run, *op) for op in entry.folders]:
+            future.result()
+
+    if remaining:
+        _save_tree_entry(entry.path, entry.source, entry.timestamp, sorted(remaining))
+    else:
+        os.remove(entry.path)
+    if cancel is not None and cancel.is_set():
+        raise core.Cancelled(result=result)
+    return result
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+KAMBIOS - vigilar carpetas
+Una caché del contenido de una carpeta que se mantiene al día con los eventos de inotify (Linux),
+sin volver a listar la carpeta cada vez que algo cambia. No depende de PyQt6: la GUI solo tiene que
+avisar cuando el descriptor tiene datos (QSocketNotifier) y agrupar los avisos.
+"""
+
+import os
+import sys
+import stat
+import time
+import select
+import fnmatch
+import ctypes
+import ctypes.util
+import struct
+
+import kambiosCore as core
+import kambiosMetrics as metrics
+
+
+# Constantes de <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len (+ nombre relleno con ceros)
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None and sys.platform.startswith("linux"):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            _libc = libc
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc or None
+
+
+def inotify_available():
+    return _load_libc() is not None
+
+
+class Inotify:
+    """
+    Descriptor de inotify en modo no bloqueante. fileno() sirve para select/QSocketNotifier,
+    y read_events() devuelve todo lo pendiente de una vez como (wd, mask, cookie, nombre).
+    """
+
+    def __init__(self):
+        libc = _load_libc()
+        if libc is None:
+            raise OSError("inotify no está disponible en este sistema")
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            if not data:
+                return events
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, size = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size
+                name = os.fsdecode(data[pos:pos + size].rstrip(b"\0"))
+                pos += size
+                events.append((wd, mask, cookie, name))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class DirCache:
+    """
+    Lo que hay en una carpeta (archivos, diario, historial) según el último listado más los eventos
+    que han llegado desde entonces. Los nombres van en un dict (ordenado por llegada), así que altas,
+    bajas y renombres son O(1) y aplicar un evento dos veces no cambia nada.
+
+    Uso: start() abre el vigilante *antes* de listar, reset(nombres) con el resultado del listado y luego
+    update() cada vez que el descriptor tenga datos. Los eventos que lleguen mientras se lista se guardan
+    y se aplican encima del listado; como altas y bajas son idempotentes, el resultado cuadra igual.
+    Si el núcleo pierde eventos (cola llena) o la carpeta desaparece, needs_rescan se pone a True.
+    """
+
+    def __init__(self, folder, mask=WATCH_MASK):
+        self.folder = folder
+        self.mask = mask           # Eventos de la carpeta que se piden (los de siempre, o más para IngestWatcher)
+        self.names = None          # {nombre: None}; None hasta el primer reset()
+        self.history = set()       # Segmentos en HISTORY_DIR
+        self.journal = False       # ¿Hay un diario a medias?
+        self.legacy_undo = False   # ¿Hay un .kambios_undo.json antiguo?
+        self.needs_rescan = False
+        self.version = 0           # Sube con cada cambio (para saber si hay que repintar)
+        self._pending = []         # Eventos que llegaron antes del primer reset()
+        self._snapshot = None
+        self._inotify = None
+        self._folder_wd = None
+        self._history_wd = None
+
+    # Vigilancia
+
+    def start(self):
+        self._inotify = Inotify()
+        self._folder_wd = self._inotify.add_watch(self.folder, self.mask)
+        self._watch_history()
+
+    def stop(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def fileno(self):
+        return self._inotify.fileno() if self._inotify is not None else -1
+
+    @property
+    def folder_wd(self):
+        return self._folder_wd
+
+    def _watch_history(self):
+        try:
+            self._history_wd = self._inotify.add_watch(os.path.join(self.folder, core.HISTORY_DIR))
+        except FileNotFoundError:
+            self._history_wd = None
+            return
+        # Lo que ya había antes de vigilar (un listado pequeño: como mucho HISTORY_KEEP archivos).
+        self.history.update(core._segment_name(op_id) for op_id in core._history_ids(self.folder))
+
+    # Estado
+
+    def reset(self, names):
+        self.names = dict.fromkeys(names)
+        self.journal = os.path.exists(os.path.join(self.folder, core.JOURNAL_FILE))
+        self.legacy_undo = os.path.exists(os.path.join(self.folder, core.UNDO_FILE))
+        self.history = set(core._segment_name(op_id) for op_id in core._history_ids(self.folder))
+        self.needs_rescan = False
+        pending, self._pending = self._pending, []
+        self.apply_events(pending)
+        self._touch()
+
+    def invalidate(self):
+        # Se va a volver a listar: hasta el próximo reset() los eventos se guardan en vez de aplicarse.
+        self.names = None
+        self._pending = []
+        self.needs_rescan = False
+
+    def update(self):
+        """
+        Lee y aplica todo lo pendiente. Devuelve True si algo cambió.
+        """
+        return self.poll()[0]
+
+    def poll(self):
+        """
+        Como update(), pero también devuelve los eventos leídos (ya aplicados): (cambió, eventos).
+        """
+        if self._inotify is None:
+            return False, []
+        events = self._inotify.read_events()
+        if self.names is None:
+            self._pending.extend(events)
+            return False, events
+        return self.apply_events(events), events
+
+    def snapshot(self):
+        # La misma foto mientras no cambie nada, para no copiar 50k nombres en cada vista previa.
+        if self._snapshot is None:
+            self._snapshot = core.FolderSnapshot(self.folder, list(self.names))
+        return self._snapshot
+
+    def has_undo(self):
+        return self.legacy_undo or bool(self.history)
+
+    def _touch(self):
+        self.version += 1
+        self._snapshot = None
+
+    def apply_events(self, events):
+        changed = False
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW or (wd == self._folder_wd and mask & (IN_DELETE_SELF | IN_MOVE_SELF)):
+                self.needs_rescan = True
+                changed = True
+                continue
+            added = bool(mask & (IN_CREATE | IN_MOVED_TO))
+            removed = bool(mask & (IN_DELETE | IN_MOVED_FROM))
+            if not (added or removed):
+                continue
+            if wd == self._folder_wd:
+                changed |= self._folder_event(name, added, bool(mask & IN_ISDIR))
+            elif wd == self._history_wd and wd is not None:
+                stem, ext = os.path.splitext(name)
+                if ext == ".jsonl" and stem.isdigit():
+                    if added:
+                        self.history.add(name)
+                    else:
+                        self.history.discard(name)
+                    changed = True
+        if changed:
+            self._touch()
+        return changed
+
+    def _folder_event(self, name, added, is_dir):
+        if name == core.JOURNAL_FILE:
+            self.journal = added
+            return True
+        if name == core.UNDO_FILE:
+            self.legacy_undo = added
+            return True
+        if is_dir:
+            if name == core.HISTORY_DIR:
+                if added and self._inotify is not None:
+                    self._watch_history()
+                elif not added:
+                    self._history_wd = None
+                    self.history.clear()
+                return True
+            return False
+        if added:
+            if name in self.names:
+                return False
+            self.names[name] = None
+        else:
+            if name not in self.names:
+                return False
+            del self.names[name]
+        return True
+
+
+# --- Modo vigilar: renombrar lo que va llegando ---
+# A las carpetas de entrada (escáner, descargas) llegan archivos todo el día. En vez de volver a pasar la CLI
+# por la carpeta entera, IngestWatcher escucha inotify y solo mira los archivos nuevos: espera a que terminen
+# de escribirse, los junta en lotes pequeños y cada lote es una operación normal, con su diario y su entrada
+# en el historial de deshacer. Lo que cuesta cada evento va con los archivos nuevos, no con la carpeta.
+
+INGEST_MASK = WATCH_MASK | IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE
+SETTLE_SECONDS = 2.0   # Sin eventos durante este rato, un archivo se da por terminado
+INGEST_BATCH = 100     # Archivos por lote como mucho (cada lote es una operación del historial)
+# Lo que usan navegadores y programas de descargas mientras bajan; al acabar lo renombran al nombre final.
+PARTIAL_PATTERNS = ("*.part", "*.partial", "*.crdownload", "*.download", "*.opdownload", "*.tmp", "*.!qB")
+
+
+class _Pending:
+    # Un archivo nuevo que todavía no se ha dado por terminado.
+    __slots__ = ("last", "closed", "sig")
+
+    def __init__(self, now, closed):
+        self.last = now        # Último evento (time.monotonic)
+        self.closed = closed   # Se cerró tras escribirse (o llegó movido, ya entero)
+        self.sig = None        # (tamaño, fecha) en la última comprobación
+
+
+class _LiveFolder:
+    """
+    Lo que execute_plan necesita de la carpeta ("¿existe X?" e inodos) sin copiar un millón de nombres:
+    los nombres se consultan en la caché y los inodos son solo los de los archivos del lote.
+    """
+
+    def __init__(self, names, inodes):
+        self.names = names
+        self.inodes = inodes
+
+    def __contains__(self, name):
+        return name in self.names
+
+
+class IngestWatcher:
+    """
+    Vigila folder y renombra los archivos que van llegando con plan(nombres) -> cambios (solo se le pasan
+    los nuevos). pattern/extensions filtran cuáles se tocan; los ocultos, los de Kambios y las descargas a
+    medias (PARTIAL_PATTERNS) nunca.
+    Un archivo está listo cuando lleva settle segundos sin eventos y, o se cerró tras escribirse (o llegó
+    movido), o su tamaño y su fecha no cambiaron desde la espera anterior.
+    on_batch(hechos, problemas) se llama tras cada lote; problemas es [(nombre, motivo)]: lo que no se pudo
+    renombrar (el nombre nuevo ya existe, por ejemplo) se queda como está.
+    Uso: start(), y luego run() (o handle_events()/ready()/apply_ready() desde un bucle propio); al final, stop().
+    """
+
+    def __init__(self, folder, plan, settle=SETTLE_SECONDS, batch_size=INGEST_BATCH, pattern=None,
+                 extensions=None, source="kambios_watch", on_batch=None, metrics_sink=None, profile_dir=None):
+        self.folder = folder
+        self.plan = plan
+        self.settle = settle
+        self.batch_size = batch_size
+        self.pattern = pattern
+        self.extensions = core.normalize_extensions(extensions)
+        self.source = source
+        self.on_batch = on_batch
+        self.metrics_sink = metrics_sink
+        self.profile_dir = profile_dir
+        self.cache = None
+        self.pending = {}     # {nombre: _Pending}, en orden de llegada
+        self._ours = set()    # Nombres que acabamos de poner nosotros: sus eventos no son archivos nuevos
+
+    def start(self):
+        """
+        Empieza a vigilar y devuelve los nombres que ya había (lo único que se lista entero, una vez).
+        """
+        # Primero el vigilante y luego el listado, como en la GUI: lo que llegue entre medias no se pierde.
+        self.cache = DirCache(self.folder, INGEST_MASK)
+        self.cache.start()
+        names = [entry.name for entry in core.iter_scan(self.folder)]
+        self.cache.reset(names)
+        return names
+
+    def stop(self):
+        if self.cache is not None:
+            self.cache.stop()
+
+    def fileno(self):
+        return self.cache.fileno()
+
+    def wanted(self, name):
+        if name.startswith(".") or name in core.INTERNAL_FILES:
+            return False  # Ocultos, temporales de Kambios (.kambios_tmp_*), diario...
+        if any(fnmatch.fnmatch(name, pattern) for pattern in PARTIAL_PATTERNS):
+            return False
+        return core.name_matches(name, self.pattern, self.extensions)
+
+    def handle_events(self, now=None):
+        # Lee lo que haya llegado y lo apunta en pending. Cada evento es O(1).
+        now = time.monotonic() if now is None else now
+        _, events = self.cache.poll()
+        if self.cache.needs_rescan:
+            self._rescan(now)
+            return
+        for wd, mask, cookie, name in events:
+            if wd != self.cache.folder_wd or mask & IN_ISDIR or not name:
+                continue
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self.pending.pop(name, None)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                if name in self._ours:
+                    self._ours.discard(name)  # Un renombre nuestro
+                elif self.wanted(name):
+                    self.pending[name] = _Pending(now, closed=bool(mask & IN_MOVED_TO))
+            elif name in self.pending:
+                entry = self.pending[name]
+                entry.last = now
+                if mask & IN_CLOSE_WRITE:
+                    entry.closed = True
+                elif mask & IN_MODIFY:
+                    entry.closed = False  # Se ha vuelto a abrir para escribir
+
+    def _rescan(self, now):
+        # El núcleo perdió eventos (cola llena): se vuelve a listar, y lo que no estaba en la caché es nuevo.
+        # Es lo único que cuesta lo que la carpeta, y solo pasa si llegan muchísimos eventos de golpe.
+        known = self.cache.names or {}
+        self.cache.invalidate()
+        names = [entry.name for entry in core.iter_scan(self.folder)]
+        self.cache.reset(names)
+        self._ours.clear()
+        for name in names:
+            if name not in known and name not in self.pending and self.wanted(name):
+                self.pending[name] = _Pending(now, closed=False)
+        for name in [name for name in self.pending if name not in self.cache.names]:
+            del self.pending[name]
+
+    def timeout(self, now=None):
+        # Cuánto se puede esperar hasta que algún archivo pueda estar listo (None: hasta el próximo evento).
+        if not self.pending:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, min(entry.last for entry in self.pending.values()) + self.settle - now)
+
+    def ready(self, now=None):
+        """
+        Saca de pending los archivos terminados y los devuelve con su inodo: [(nombre, inodo)].
+        """
+        now = time.monotonic() if now is None else now
+        ready = []
+        for name, entry in list(self.pending.items()):
+            if now - entry.last < self.settle:
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                del self.pending[name]
+                continue
+            if stat.S_ISDIR(st.st_mode) or (stat.S_ISLNK(st.st_mode) and not os.path.isfile(path)):
+                del self.pending[name]
+                continue
+            sig = (st.st_size, st.st_mtime_ns)
+            if entry.closed or entry.sig == sig:
+                del self.pending[name]
+                ready.append((name, st.st_ino))
+            else:
+                # Sin cierre a la vista (un programa que escribe y no cierra): otra espera, y si no cambió, listo.
+                entry.sig = sig
+                entry.last = now
+        return ready
+
+    def apply_ready(self, ready):
+        """
+        Renombra los archivos listos en lotes de batch_size. Cada lote es una operación con diario y su
+        entrada en el historial (se deshace con undo, como cualquier otra). Devuelve cuántos se renombraron.
+        """
+        total = 0
+        for start in range(0, len(ready), self.batch_size):
+            total += self._apply_batch(ready[start:start + self.batch_size])
+        return total
+
+    def _apply_batch(self, batch):
+        with metrics.recording("watch", self.metrics_sink, self.profile_dir) as recorder:
+            names = [name for name, _ in batch]
+            with metrics.phase("plan", len(names)):
+                changes = [(old, new) for old, new in self.plan(names) if old != new]
+            live = _LiveFolder(self.cache.names, dict(batch))
+            problems = core.find_conflicts(changes, live)
+            if problems:
+                # Lo que choca se deja como está; el resto del lote sigue.
+                bad = {name for name, _ in problems}
+                changes = [(old, new) for old, new in changes if old not in bad and new not in bad]
+            done = []
+            if changes:
+                self._ours.update(new for _, new in changes)
+                try:
+                    done = core.apply_plan(self.folder, changes, self.source, existing=live)
+                except core.PlanConflictError as e:
+                    problems += e.conflicts
+                except core.RenameError as e:
+                    done = e.done
+                    problems += e.failures or [(getattr(e.error, "filename", None) or "?", e.error)]
+                # Los eventos de estos renombres llegarán luego; la caché se pone al día ya para el lote siguiente.
+                for old, new in done:
+                    self.cache.names.pop(old, None)
+                    self.cache.names[new] = None
+                self._ours.difference_update(set(new for _, new in changes) - set(new for _, new in done))
+            if recorder and problems:
+                recorder.ok = False
+        if self.on_batch is not None:
+            self.on_batch(done, problems)
+        return len(done)
+
+    def run(self, stop=None):
+        """
+        Bucle principal: espera eventos y renombra lo que se va terminando, hasta que stop (un threading.Event)
+        se active o llegue Ctrl+C.
+        """
+        while stop is None or not stop.is_set():
+            timeout = self.timeout()
+            # Como mucho un segundo dormido, para ver stop a tiempo.
+            readable, _, _ = select.select([self], [], [], 1.0 if timeout is None else min(timeout, 1.0))
+            if readable:
+                self.handle_events()
+            ready = self.ready()
+            if ready:
+                self.apply_ready(ready)
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# Los módulos van sueltos en la raíz del repositorio (sin paquete): se importan desde ahí.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def folder_state(folder):
+    # {nombre: contenido} de los archivos de la carpeta (sin los de Kambios).
+    return {entry.name: open(entry.path, encoding="utf-8").read()
+            for entry in os.scandir(folder) if entry.is_file() and not entry.name.startswith(".kambios")}
+
+
+@pytest.fixture
+def make_folder(tmp_path):
+    """
+    make_folder("a", "b", ...) crea una carpeta con esos archivos, cada uno con su nombre dentro:
+    así, después de renombrar, se ve qué archivo acabó dónde.
+    """
+    def make(*names):
+        for name in names:
+            (tmp_path / name).write_text(name, encoding="utf-8")
+        return str(tmp_path)
+    return make
+
+
+@pytest.fixture
+def state():
+    return folder_state
@@ -0,0 +1,43 @@
+import io
+import sys
+
+import pytest
+
+import kambiosCore as core
+import kambiosCLI as kcli
+import kambiosPlan as plans
+
+
+def plan_text(folder, changes):
+    f = io.StringIO()
+    core.write_plan(f, folder, changes)
+    return f.getvalue()
+
+
+@pytest.mark.parametrize("large", [False, True])
+def test_apply_plan_from_stdin(make_folder, state, monkeypatch, large):
+    folder = make_folder("a", "b", "c")
+    if large:
+        # Con un presupuesto mínimo, el plan va por apply_large, que vuelve a abrir el archivo.
+        monkeypatch.setattr(plans, "PLAN_MEMORY_BUDGET", 1)
+    stdin = io.StringIO(plan_text(folder, [("a", "b"), ("b", "c"), ("c", "a")]))
+    monkeypatch.setattr(sys, "stdin", stdin)
+    assert kcli.cli(["apply", "-", "--yes"]) == 0
+    assert state(folder) == {"b": "a", "c": "b", "a": "c"}
+    assert not stdin.closed
+
+
+def test_show_does_not_close_stdin(make_folder, monkeypatch):
+    folder = make_folder("a")
+    stdin = io.StringIO(plan_text(folder, [("a", "b")]))
+    monkeypatch.setattr(sys, "stdin", stdin)
+    assert kcli.cli(["show", "-"]) == 0
+    assert not stdin.closed
+
+
+def test_apply_from_stdin_without_yes_is_a_no(make_folder, state, monkeypatch):
+    # La entrada estándar ya se ha leído entera: la pregunta se encuentra el final y cuenta como "no".
+    folder = make_folder("a")
+    monkeypatch.setattr(sys, "stdin", io.StringIO(plan_text(folder, [("a", "b")])))
+    assert kcli.cli(["apply", "-"]) == 1
+    assert state(folder) == {"a": "a"}
@@ -0,0 +1,44 @@
+import kambiosDAT as dat
+
+
+def make_index(*games):
+    index = dat.DatIndex("test")
+    for i, (game, rom) in enumerate(games):
+        index.add(game, rom, 10, f"{i:08x}", None)
+    return index
+
+
+def loose(i):
+    # Lo que devuelve hash_folder para un archivo suelto (no .zip) con ese CRC.
+    return [(None, 10, f"{i:08x}", None)]
+
+
+def test_rom_name_keeps_only_the_file():
+    index = make_index(("Juego", "Disc 1\\pista.bin"), ("Otro", "Disc 2/pista 2.bin"))
+    assert dat.canonical_name("a.bin", loose(0), index) == "pista.bin"
+    assert dat.canonical_name("b.bin", loose(1), index) == "pista 2.bin"
+
+
+def test_separators_and_nul_are_replaced():
+    index = make_index(("AC/DC (Europe)", "acdc.bin"), ("Mal\0nombre", "mal.bin"))
+    zipped = [("acdc.bin", 10, "00000000", None)]
+    assert dat.canonical_name("x.zip", zipped, index) == "AC_DC (Europe).zip"
+    assert dat.canonical_name("y.zip", [("mal.bin", 10, "00000001", None)], index) == "Mal_nombre.zip"
+    index = make_index(("Juego", "pi\0sta.bin"))
+    assert dat.canonical_name("a.bin", loose(0), index) == "pi_sta.bin"
+
+
+def test_names_that_are_not_files_are_skipped():
+    index = make_index(("Juego", "Disc 1/.."), ("Otro", "Disc 2/"))
+    assert dat.canonical_name("a.bin", loose(0), index) is None
+    assert dat.canonical_name("b.bin", loose(1), index) is None
+
+
+def test_dat_plan_never_leaves_the_folder(tmp_path):
+    (tmp_path / "rom.bin").write_bytes(b"x" * 10)
+    _, _, crc, sha1 = dat.hash_file(str(tmp_path / "rom.bin"))[0]
+    index = dat.DatIndex("test")
+    index.add("Juego", "../../fuera.bin", 10, crc, sha1)
+    with dat.HashCache(str(tmp_path / "cache.db")) as cache:
+        changes, report = dat.dat_plan(str(tmp_path), ["rom.bin"], index, cache=cache, workers=1)
+    assert changes == [("rom.bin", "fuera.bin")]
@@ -0,0 +1,71 @@
+import pytest
+
+import kambiosGroups as groups
+import kambiosMeta as meta
+
+
+def members(found):
+    return {group.primary: sorted(group.members) for group in found}
+
+
+def test_companions_join_their_video():
+    files = ["Show.S01E01.mkv", "Show.S01E01.en.srt", "Show.S01E01.es.forced.srt", "Show.S01E01.pt-br.srt",
+             "Show.S01E01-poster.jpg", "Show.S01E01.nfo", "Show.S01E02.mkv", "Show.S01E02.EN.srt"]
+    found, loose = groups.group_by_stem(files)
+    assert loose == []
+    assert members(found) == {
+        "Show.S01E01.mkv": [("Show.S01E01-poster.jpg", "-poster.jpg"), ("Show.S01E01.en.srt", ".en.srt"),
+                            ("Show.S01E01.es.forced.srt", ".es.forced.srt"), ("Show.S01E01.mkv", ".mkv"),
+                            ("Show.S01E01.nfo", ".nfo"), ("Show.S01E01.pt-br.srt", ".pt-br.srt")],
+        "Show.S01E02.mkv": [("Show.S01E02.EN.srt", ".EN.srt"), ("Show.S01E02.mkv", ".mkv")],
+    }
+
+
+def test_case_and_accents_do_not_matter():
+    # "é" compuesta en el vídeo y descompuesta (NFD, como en macOS) en el subtítulo.
+    found, loose = groups.group_by_stem(["Caf\u00e9.mkv", "CAFE\u0301.en.srt"])
+    assert loose == []
+    assert len(found[0]) == 2
+
+
+@pytest.mark.parametrize("name", [
+    "Otra cosa.srt",               # No se llama como ningún vídeo
+    "Show.S01E01-en.srt",          # Un idioma va con punto, no con guion
+    "Show.S01E01.extra.srt",       # "extra" no es una etiqueta
+    "Show.S01.srt",                # Quitar lo que no es etiqueta no vale
+    "Show.S01E01.a.b.c.d.en.srt",  # Demasiadas etiquetas
+])
+def test_files_that_stay_unmatched(name):
+    found, loose = groups.group_by_stem(["Show.S01E01.mkv", name])
+    assert loose == [name]
+    assert len(found[0]) == 1
+
+
+def test_two_videos_with_the_same_name_are_one_group():
+    found, loose = groups.group_by_stem(["peli.mkv", "peli.mp4", "peli.srt"])
+    assert [len(group) for group in found] == [3]
+
+
+def test_grouped_plan_keeps_each_suffix():
+    files = ["Capitulo 02.mkv", "Capitulo 01.mkv", "Capitulo 01.en.srt", "Capitulo 01.es.forced.srt",
+             "Capitulo 01-poster.jpg", "Capitulo 02.EN.srt", "notas.txt"]
+    changes, loose = groups.grouped_replace_plan(files, "Serie - S01E{n:02}")
+    assert sorted(changes) == sorted([
+        ("Capitulo 01.mkv", "Serie - S01E01.mkv"),
+        ("Capitulo 01.en.srt", "Serie - S01E01.en.srt"),
+        ("Capitulo 01.es.forced.srt", "Serie - S01E01.es.forced.srt"),
+        ("Capitulo 01-poster.jpg", "Serie - S01E01-poster.jpg"),
+        ("Capitulo 02.mkv", "Serie - S01E02.mkv"),
+        ("Capitulo 02.EN.srt", "Serie - S01E02.EN.srt"),
+    ])
+    assert loose == ["notas.txt"]
+
+
+def test_grouped_plan_with_name_and_start():
+    changes, _ = groups.grouped_replace_plan(["a.mkv", "a.srt", "b.mkv"], "{n} {name}", start=5)
+    assert changes == [("a.mkv", "5 a.mkv"), ("a.srt", "5 a.srt"), ("b.mkv", "6 b.mkv")]
+
+
+def test_grouped_plan_rejects_ext():
+    with pytest.raises(meta.TemplateError):
+        groups.grouped_replace_plan(["a.mkv"], "{name}{ext}")
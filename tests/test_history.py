@@ -0,0 +1,59 @@
+import functools
+
+import pytest
+
+import kambiosCore as core
+
+
+def test_undo_one_level_at_a_time(make_folder, state):
+    folder = make_folder("a", "b")
+    states = [state(folder)]
+    for plan in ([("a", "x")], [("b", "a")], [("x", "b"), ("a", "x")]):
+        core.apply_plan(folder, plan, "test")
+        states.append(state(folder))
+    assert [entry.id for entry in core.list_history(folder)] == [3, 2, 1]
+    assert [entry.count for entry in core.list_history(folder)] == [2, 1, 1]
+    for expected in reversed(states[:-1]):
+        core.undo_operation(folder)
+        assert state(folder) == expected
+    assert not core.has_undo(folder)
+
+
+def test_undo_an_older_operation(make_folder, state):
+    folder = make_folder("a", "b")
+    core.apply_plan(folder, [("a", "x")], "test")
+    core.apply_plan(folder, [("b", "y")], "test")
+    core.undo_operation(folder, 1)
+    assert state(folder) == {"a": "a", "y": "b"}
+    assert [entry.id for entry in core.list_history(folder)] == [2]
+
+
+def test_undo_replays_many_batches_in_reverse(make_folder, state, monkeypatch):
+    # Un segmento con muchos lotes, leído del final al principio en bloques pequeños.
+    monkeypatch.setattr(core.RenameJournal.__init__, "__defaults__", (None, 7, 200))
+    names = [f"f{i:03d}" for i in range(200)]
+    folder = make_folder(*names)
+    before = state(folder)
+    core.apply_plan(folder, [(name, names[(i + 1) % len(names)]) for i, name in enumerate(names)], "test")
+    monkeypatch.setattr(core, "_reverse_lines", functools.partial(core._reverse_lines, block_size=64))
+    core.undo_operation(folder)
+    assert state(folder) == before
+
+
+def test_prune_keeps_the_newest(make_folder):
+    folder = make_folder("a")
+    name = "a"
+    for i in range(5):
+        core.apply_plan(folder, [(name, f"a{i}")], "test")
+        name = f"a{i}"
+    assert core.prune_history(folder, keep=2) == 3
+    assert [entry.id for entry in core.list_history(folder)] == [5, 4]
+
+
+def test_missing_operation_is_an_error(make_folder):
+    folder = make_folder("a")
+    with pytest.raises(ValueError):
+        core.undo_operation(folder)
+    core.apply_plan(folder, [("a", "b")], "test")
+    with pytest.raises(ValueError):
+        core.undo_operation(folder, 7)
@@ -0,0 +1,162 @@
+import json
+import os
+
+import pytest
+
+import kambiosCore as core
+import kambiosJobs as jobs
+import kambiosRules as rules
+
+
+@pytest.fixture
+def job_file(tmp_path):
+    # job_file({...}) guarda el archivo de trabajo junto a las carpetas y devuelve su ruta.
+    def write(data):
+        path = tmp_path / "trabajo.json"
+        path.write_text(json.dumps(data), encoding="utf-8")
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def folders(tmp_path):
+    # folders(ruta=[nombres], ...) crea carpetas dentro de tmp_path con esos archivos.
+    def make(**layout):
+        for reldir, names in layout.items():
+            folder = tmp_path / reldir
+            folder.mkdir(parents=True, exist_ok=True)
+            for name in names:
+                (folder / name).write_text(name, encoding="utf-8")
+        return str(tmp_path)
+    return make
+
+
+@pytest.mark.parametrize("version", ["1", "2", 1.5, None, True, [1]])
+def test_version_must_be_an_integer(job_file, version):
+    with pytest.raises(jobs.JobError) as info:
+        jobs.load_jobs(job_file({"version": version, "jobs": ["."]}))
+    assert "número entero" in str(info.value)
+
+
+def test_newer_version_is_refused(job_file):
+    with pytest.raises(jobs.JobError, match="más nueva"):
+        jobs.load_jobs(job_file({"version": jobs.JOB_VERSION + 1, "jobs": ["."]}))
+
+
+def test_defaults_and_job_keys_merge(job_file, folders, tmp_path):
+    folders(**{"roms/a": ["x.zip"], "roms/b": ["y.zip"], "fotos": ["p.jpg"]})
+    loaded = jobs.load_jobs(job_file({
+        "version": 1, "part": "x", "with": "z", "ext": ["zip"],
+        "jobs": [{"folder": "roms/*"}, {"folder": "fotos", "number": "Foto", "ext": "jpg"}],
+    }))
+    assert [(os.path.relpath(job["folder"], tmp_path), job["mode"]) for job in loaded] == \
+        [("roms/a", "part"), ("roms/b", "part"), ("fotos", "number")]
+    assert loaded[0]["with"] == "z" and loaded[0]["ext"] == ["zip"]
+    # El modo del trabajo sustituye al de fuera; las demás claves se mezclan.
+    assert "part" not in loaded[2] and loaded[2]["ext"] == "jpg" and loaded[2]["with"] == "z"
+
+
+def test_preset_is_loaded_once_for_every_folder(job_file, folders, monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "config"))
+    chain = rules.parse_rules("lit (USA) =>\nsqueeze")
+    rules.save_preset("limpiar", chain)
+    folders(**{"a": [], "b": []})
+    loaded = jobs.load_jobs(job_file({"preset": "limpiar", "jobs": ["a", "b"]}))
+    assert [job["mode"] for job in loaded] == ["rules", "rules"]
+    assert all(job["rules"] == chain for job in loaded)
+
+
+@pytest.mark.parametrize("entry, message", [
+    ({"folder": "a", "number": "x", "full": "y"}, "hace falta un modo"),
+    ({"folder": "a"}, "hace falta un modo"),
+    ({"folder": "a", "number": "x", "color": "rojo"}, "claves desconocidas: color"),
+    ({"folder": "nada/*", "number": "x"}, "ninguna carpeta"),
+    ({"folder": "a", "template": "{n}{ext}", "sort": "color"}, "no se puede ordenar"),
+    ({"folder": "a", "rules": ["lit  => x"]}, "no hay nada que buscar"),
+])
+def test_bad_jobs_fail_before_touching_anything(job_file, folders, entry, message):
+    folders(a=[])
+    with pytest.raises(ValueError, match=message):
+        jobs.load_jobs(job_file({"jobs": [entry]}))
+
+
+def test_same_folder_twice_is_an_error(job_file, folders):
+    folders(a=[])
+    with pytest.raises(jobs.JobError, match="ya está en otro trabajo"):
+        jobs.load_jobs(job_file({"number": "x", "jobs": ["a", "./a"]}))
+
+
+MODES = [
+    ({"number": "Doc"}, ["b.txt", "a.txt"], {"0 - Doc.txt", "1 - Doc.txt"}),
+    ({"number": "Doc", "continue": True}, ["0 - Doc.txt", "a.txt"], {"0 - Doc.txt", "1 - Doc.txt"}),
+    ({"number": "Doc", "fill_gaps": True}, ["1 - Doc.txt", "a.txt"], {"0 - Doc.txt", "1 - Doc.txt"}),
+    ({"full": "Peli"}, ["x.mkv", "y.srt"], {"Peli.mkv", "Peli.srt"}),
+    ({"full": "Serie - E{n:02}"}, ["c2.mkv", "c1.mkv", "c1.en.srt"], {"Serie - E01.mkv", "Serie - E01.en.srt",
+                                                                       "Serie - E02.mkv"}),
+    ({"part": "_", "with": " "}, ["a_b.txt"], {"a b.txt"}),
+    ({"rules": ["lit (USA) =>", "squeeze"]}, ["Juego (USA).zip"], {"Juego.zip"}),
+    ({"template": "{n:02}_{name}{ext}", "sort": "name", "desc": True, "start": 1}, ["a.txt", "b.txt"],
+     {"01_b.txt", "02_a.txt"}),
+]
+
+
+@pytest.mark.parametrize("mode, names, expected", MODES)
+def test_each_mode_renames_its_folder(job_file, folders, state, tmp_path, mode, names, expected):
+    folders(a=names)
+    job, = jobs.load_jobs(job_file({"jobs": [dict(mode, folder="a")]}))
+    result = jobs.run_job(job)
+    assert result["status"] == "ok", result
+    assert set(state(str(tmp_path / "a"))) == expected
+    assert result["renamed"] == result["changes"] and result["op_id"] == 1
+    core.undo_operation(str(tmp_path / "a"))
+    assert set(state(str(tmp_path / "a"))) == set(names)
+
+
+def test_rules_from_a_file_next_to_the_job(job_file, folders, state, tmp_path):
+    folders(a=["Juego (USA).zip"])
+    (tmp_path / "reglas.txt").write_text("lit (USA) =>\nsqueeze\n", encoding="utf-8")
+    job, = jobs.load_jobs(job_file({"rules": "reglas.txt", "jobs": ["a"]}))
+    jobs.run_job(job)
+    assert state(str(tmp_path / "a")) == {"Juego.zip": "Juego (USA).zip"}
+
+
+def test_dry_run_touches_nothing(job_file, folders, state, tmp_path):
+    folders(a=["x.txt"])
+    job, = jobs.load_jobs(job_file({"number": "Doc", "jobs": ["a"]}))
+    result = jobs.run_job(job, dry_run=True)
+    assert result["changes"] == 1 and result["renamed"] == 0
+    assert state(str(tmp_path / "a")) == {"x.txt": "x.txt"}
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_combined_report(job_file, folders, tmp_path, workers):
+    folders(**{"ok": ["a.txt", "b.txt"], "choca": ["a.txt", "Doc.txt"], "dup": ["a.txt", "b.txt"],
+               "nada": ["Doc.txt"]})
+    loaded = jobs.load_jobs(job_file({"jobs": [
+        {"folder": "ok", "number": "Doc"},
+        {"folder": "choca", "full": "Doc"},
+        {"folder": "dup", "full": "Doc"},
+        {"folder": "nada", "full": "Doc"},
+    ]}))
+    seen = []
+    report = jobs.run_jobs(loaded, workers=workers, on_result=seen.append)
+    assert sorted(result["folder"] for result in seen) == sorted(job["folder"] for job in loaded)
+    assert [result["status"] for result in report.results] == ["ok", "conflicts", "duplicates", "ok"]
+    assert report.results[1]["problems"] == [["Doc.txt", "ya existe"]]
+    totals = report.totals()
+    assert totals["folders"] == 4 and totals["renamed"] == 2 and totals["changes"] == 5
+    assert totals["status"] == {"ok": 2, "conflicts": 1, "duplicates": 1}
+    assert not report.ok
+    path = str(tmp_path / "informe.json")
+    report.save(path)
+    with open(path, encoding="utf-8") as f:
+        saved = json.load(f)
+    assert saved["format"] == "kambios_job_report" and saved["totals"] == json.loads(json.dumps(totals))
+
+
+def test_interrupted_folder_is_an_error_in_the_report(job_file, folders, tmp_path):
+    folders(a=["x.txt"])
+    job, = jobs.load_jobs(job_file({"number": "Doc", "jobs": ["a"]}))
+    open(os.path.join(job["folder"], core.JOURNAL_FILE), "w").close()
+    result = jobs.run_job(job)
+    assert result["status"] == "error" and "recover" in result["error"]
@@ -0,0 +1,151 @@
+import os
+
+import pytest
+
+import kambiosCore as core
+
+
+NAMES = [f"f{i}" for i in range(8)]
+# Una cadena, un ciclo de tres y dos sueltos: 8 pasos contando el temporal del ciclo.
+CHANGES = [("f0", "g0"), ("f1", "f0"), ("f2", "f3"), ("f3", "f4"), ("f4", "f2"), ("f5", "g5"), ("f6", "g6")]
+
+
+def final_state():
+    files = {name: name for name in NAMES}
+    moved = {old: files.pop(old) for old, _ in CHANGES}
+    files.update((new, moved[old]) for old, new in CHANGES)
+    return files
+
+
+class Crash(BaseException):
+    pass
+
+
+@pytest.fixture
+def small_batches(monkeypatch):
+    # Lotes de 3 pasos: así un corte puede caer entre lotes o a mitad de uno.
+    monkeypatch.setattr(core.RenameJournal.__init__, "__defaults__", (None, 3, 200))
+
+
+def crash_at(monkeypatch, cut, error=Crash):
+    # El renombre número cut (desde 0) lanza error, como si el proceso muriera justo ahí.
+    real = core.DirRenamer.rename
+    count = [0]
+
+    def rename(self, src, dst):
+        count[0] += 1
+        if count[0] - 1 == cut:
+            raise error()
+        return real(self, src, dst)
+    monkeypatch.setattr(core.DirRenamer, "rename", rename)
+    return lambda: monkeypatch.setattr(core.DirRenamer, "rename", real)
+
+
+def hard_crash(monkeypatch):
+    # Un proceso que muere no llega a limpiar: el diario se queda como estaba.
+    monkeypatch.setattr(core.RenameJournal, "abort", core.RenameJournal.close)
+
+
+@pytest.mark.parametrize("mode", ["rollback", "forward"])
+@pytest.mark.parametrize("cut", range(8))
+def test_recover_after_crash(make_folder, state, monkeypatch, small_batches, cut, mode):
+    folder = make_folder(*NAMES)
+    before = state(folder)
+    hard_crash(monkeypatch)
+    restore = crash_at(monkeypatch, cut)
+    with pytest.raises(Crash):
+        core.apply_plan(folder, CHANGES, "test")
+    restore()
+
+    pending = core.read_journal(folder)
+    assert pending is not None and not pending.committed
+    assert pending.completed == cut
+    core.recover_journal(folder, mode)
+    assert core.read_journal(folder) is None
+    if mode == "rollback":
+        assert state(folder) == before
+        assert not core.has_undo(folder)
+    else:
+        assert state(folder) == final_state()
+        core.undo_operation(folder)
+        assert state(folder) == before
+
+
+def test_recover_after_crash_without_inodes(make_folder, state, monkeypatch, small_batches):
+    # Sin inodos (Windows, apply_large) la recuperación compara nombres: el ciclo a medias también cuadra.
+    folder = make_folder(*NAMES)
+    hard_crash(monkeypatch)
+    monkeypatch.setattr(core, "with_inodes", lambda steps, inodes: steps)
+    crash_at(monkeypatch, 6)
+    with pytest.raises(Crash):
+        core.apply_plan(folder, CHANGES, "test")
+    monkeypatch.undo()
+    assert core.read_journal(folder).completed == 6
+    core.recover_journal(folder, "forward")
+    assert state(folder) == final_state()
+
+
+def test_crash_while_committing_finishes_into_history(make_folder, state, monkeypatch):
+    folder = make_folder(*NAMES)
+    hard_crash(monkeypatch)
+    real = core._finish_journal
+
+    def finish(*args, **kwargs):
+        raise Crash()
+    monkeypatch.setattr(core, "_finish_journal", finish)
+    with pytest.raises(Crash):
+        core.apply_plan(folder, CHANGES, "test")
+    monkeypatch.setattr(core, "_finish_journal", real)
+    assert core.read_journal(folder).committed
+    core.recover_journal(folder, "rollback")  # Ya estaba hecho: solo falta pasarlo al historial
+    assert state(folder) == final_state()
+    assert len(core.list_history(folder)) == 1
+
+
+@pytest.mark.parametrize("cut", [0, 4, 7])
+def test_interrupt_rolls_back_and_removes_journal(make_folder, state, monkeypatch, small_batches, cut):
+    folder = make_folder(*NAMES)
+    before = state(folder)
+    crash_at(monkeypatch, cut, KeyboardInterrupt)
+    with pytest.raises(KeyboardInterrupt):
+        core.apply_plan(folder, CHANGES, "test")
+    assert core.read_journal(folder) is None
+    assert state(folder) == before
+    assert not core.has_undo(folder)
+
+
+def test_unexpected_error_keeps_what_was_done(make_folder, state, monkeypatch, small_batches):
+    folder = make_folder(*NAMES)
+    crash_at(monkeypatch, 4, TypeError)
+    with pytest.raises(core.RenameError) as info:
+        core.apply_plan(folder, CHANGES, "test")
+    assert isinstance(info.value.error, TypeError)
+    assert core.read_journal(folder) is None
+    monkeypatch.undo()
+    current = state(folder)
+    for old, new in info.value.done:
+        assert current[new] == old
+    core.undo_operation(folder)
+    assert state(folder) == {name: name for name in NAMES}
+
+
+def test_undo_interrupted_keeps_history(make_folder, state, monkeypatch, small_batches):
+    folder = make_folder(*NAMES)
+    core.apply_plan(folder, CHANGES, "test")
+    after = state(folder)
+    crash_at(monkeypatch, 3, KeyboardInterrupt)
+    with pytest.raises(KeyboardInterrupt):
+        core.undo_operation(folder)
+    monkeypatch.undo()
+    assert core.read_journal(folder) is None
+    assert state(folder) == after
+    assert len(core.list_history(folder)) == 1
+
+
+def test_journal_file_is_not_renamed(make_folder):
+    folder = make_folder("a")
+    assert core.JOURNAL_FILE not in core.scan_folder(folder).names
+    with core.RenameJournal(folder, "test") as journal:
+        assert os.path.exists(journal.path)
+        assert core.JOURNAL_FILE not in core.scan_folder(folder).names
+        journal.discard()
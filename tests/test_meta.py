@@ -0,0 +1,60 @@
+from datetime import datetime
+
+import pytest
+
+import kambiosMeta as meta
+
+
+class FakeReader:
+    # Un MetadataReader de mentira: devuelve lo que se le da, sin abrir ningún archivo.
+    def __init__(self, fields):
+        self.fields = fields
+
+    def read(self, names, needed, **kwargs):
+        return {name: dict(self.fields[name]) for name in names}
+
+
+def test_render_with_every_field():
+    template = meta.Template("{date:%Y-%m-%d} {n:03}{ext}")
+    assert template.render({"date": datetime(2024, 5, 1), "n": 7, "ext": ".jpg"}) == "2024-05-01 007.jpg"
+
+
+@pytest.mark.parametrize("values", [{"name": "a", "ext": ".mp4", "duration": None}, {"name": "a", "ext": ".mp4"}])
+def test_missing_field_renders_empty(values):
+    assert meta.Template("{name}_{duration}{ext}").render(values) == "a_.mp4"
+
+
+def test_render_keeps_escaped_braces_without_a_field():
+    assert meta.Template("{{{name}}}{ext}").render({"name": "a", "ext": ".txt", "size": None}) == "{a}.txt"
+
+
+def test_render_never_makes_a_path():
+    template = meta.Template("{date:%D}{ext}")
+    assert template.render({"date": datetime(2024, 5, 1), "ext": ".jpg"}) == "05-01-24.jpg"
+    assert template.render({"date": None, "ext": ".jpg"}) == ".jpg"
+
+
+def test_template_plan_with_missing_fields():
+    reader = FakeReader({
+        "a.mp4": {"size": 10, "mtime": 1.0, "duration": None},
+        "b.mp4": {"size": 20, "mtime": 2.0, "duration": 90},
+    })
+    changes = meta.template_plan(["a.mp4", "b.mp4"], "{name}_{duration}{ext}", reader=reader)
+    assert changes == [("a.mp4", "a_.mp4"), ("b.mp4", "b_90.mp4")]
+
+
+def test_template_plan_sorts_missing_values_last():
+    reader = FakeReader({
+        "a.mp4": {"size": 10, "mtime": 1.0, "duration": None},
+        "b.mp4": {"size": 20, "mtime": 2.0, "duration": 30},
+        "c.mp4": {"size": 30, "mtime": 3.0, "duration": 90},
+    })
+    for descending, order in ((False, ["b", "c", "a"]), (True, ["c", "b", "a"])):
+        changes = meta.template_plan(["a.mp4", "b.mp4", "c.mp4"], "{n} {name}{ext}", reader=reader,
+                                     sort="duration", descending=descending, start=1)
+        assert changes == [(f"{name}.mp4", f"{i} {name}.mp4") for i, name in enumerate(order, 1)]
+
+
+def test_unknown_field_is_an_error():
+    with pytest.raises(meta.TemplateError):
+        meta.Template("{nombre}{ext}")
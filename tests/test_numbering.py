@@ -0,0 +1,53 @@
+import pytest
+
+import kambiosCore as core
+
+
+def test_numbered_files_are_kept_and_numbering_goes_on():
+    files = ["0 - Scan.pdf", "1 - Scan.pdf", "nuevo.pdf", "2 - Scan.jpg", "otro.pdf"]
+    assert core.continue_number_plan(files, "Scan") == [("nuevo.pdf", "3 - Scan.pdf"), ("otro.pdf", "4 - Scan.pdf")]
+
+
+def test_numbering_continues_past_the_highest_number():
+    files = ["3 - Scan.pdf", "10 - Scan.pdf", "a.pdf", "b.pdf"]
+    assert core.continue_number_plan(files, "Scan") == [("a.pdf", "11 - Scan.pdf"), ("b.pdf", "12 - Scan.pdf")]
+
+
+def test_fill_gaps_uses_the_free_numbers_first():
+    files = ["0 - Scan.pdf", "2 - Scan.pdf", "5 - Scan.pdf", "a.pdf", "b.pdf", "c.pdf", "d.pdf"]
+    changes = core.continue_number_plan(files, "Scan", fill_gaps=True)
+    assert [new for _, new in changes] == ["1 - Scan.pdf", "3 - Scan.pdf", "4 - Scan.pdf", "6 - Scan.pdf"]
+
+
+def test_padded_numbers_count_as_taken():
+    files = ["000 - Scan.pdf", "001 - Scan.pdf", "0007 - Scan.pdf", "a.pdf"]
+    assert core.continue_number_plan(files, "Scan") == [("a.pdf", "8 - Scan.pdf")]
+    changes = core.continue_number_plan(files + ["b.pdf"], "Scan", fill_gaps=True)
+    assert [new for _, new in changes] == ["2 - Scan.pdf", "3 - Scan.pdf"]
+
+
+@pytest.mark.parametrize("name", ["1 - Scan extra.pdf", "1-Scan.pdf", "x1 - Scan.pdf", "1 - scan.pdf", "- Scan.pdf"])
+def test_only_exact_pattern_counts_as_numbered(name):
+    assert core.continue_number_plan([name], "Scan") == [(name, "0 - Scan.pdf")]
+
+
+def test_text_with_regex_characters():
+    files = ["4 - Foto (1+1).jpg", "nueva.jpg"]
+    assert core.continue_number_plan(files, "Foto (1+1)") == [("nueva.jpg", "5 - Foto (1+1).jpg")]
+
+
+def test_numbering_across_batches():
+    # El modo vigilar: primero lo que ya había, luego lo que va llegando lote a lote.
+    numbering = core.Numbering("Scan", fill_gaps=True)
+    numbering.add_existing(["0 - Scan.pdf", "3 - Scan.pdf", "suelto.pdf"])
+    assert numbering.plan(["a.pdf"]) == [("a.pdf", "1 - Scan.pdf")]
+    assert numbering.plan(["2 - Scan.pdf", "b.pdf"]) == [("b.pdf", "4 - Scan.pdf")]
+    assert numbering.plan(["c.pdf"]) == [("c.pdf", "5 - Scan.pdf")]
+
+
+def test_continue_numbering_applies_without_conflicts(make_folder, state):
+    folder = make_folder("0 - Scan.pdf", "2 - Scan.pdf", "a.pdf", "b.pdf")
+    changes = core.continue_number_plan(sorted(core.scan_folder(folder).names), "Scan", fill_gaps=True)
+    core.apply_plan(folder, changes, "test")
+    assert state(folder) == {"0 - Scan.pdf": "0 - Scan.pdf", "1 - Scan.pdf": "a.pdf",
+                             "2 - Scan.pdf": "2 - Scan.pdf", "3 - Scan.pdf": "b.pdf"}
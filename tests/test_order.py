@@ -0,0 +1,86 @@
+import os
+import random
+
+import pytest
+
+import kambiosCore as core
+
+
+def simulate(names, steps):
+    # Ejecuta los pasos sobre {nombre: contenido}, fallando si alguno pisa un archivo o mueve uno que no está.
+    files = {name: name for name in names}
+    for src, dst in steps:
+        assert src in files, f"{src} no existe al moverlo"
+        assert dst not in files, f"{src} -> {dst} pisaría un archivo"
+        files[dst] = files.pop(src)
+    return files
+
+
+def expected(names, changes):
+    files = {name: name for name in names}
+    moved = {old: files.pop(old) for old, _ in changes}
+    files.update((new, moved[old]) for old, new in changes)
+    return files
+
+
+def test_chain_runs_from_the_end():
+    steps = core.order_renames([("a", "b"), ("b", "c"), ("c", "d")])
+    assert steps == [("c", "d"), ("b", "c"), ("a", "b")]
+
+
+def test_swap_uses_one_temp():
+    steps = core.order_renames([("a", "b"), ("b", "a")])
+    assert len(steps) == 3
+    temps = {dst for _, dst in steps if dst.startswith(core.TEMP_PREFIX)}
+    assert len(temps) == 1
+    assert simulate(["a", "b"], steps) == {"a": "b", "b": "a"}
+
+
+def test_one_temp_per_cycle():
+    changes = [("a", "b"), ("b", "c"), ("c", "a"), ("x", "y"), ("y", "x"), ("p", "q")]
+    steps = core.order_renames(changes)
+    assert len(steps) == len(changes) + 2
+    assert simulate(["a", "b", "c", "x", "y", "p"], steps) == expected(["a", "b", "c", "x", "y", "p"], changes)
+
+
+def test_temp_avoids_existing_names():
+    taken = f"{core.TEMP_PREFIX}{os.getpid()}_0"
+    steps = core.order_renames([("a", "b"), ("b", "a")], existing={"a", "b", taken})
+    assert all(taken not in step for step in steps)
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_random_permutations(seed):
+    rng = random.Random(seed)
+    names = [f"f{i}" for i in range(40)]
+    sources = rng.sample(names, 25)
+    targets = rng.sample(sources + [f"g{i}" for i in range(10)], 25)
+    changes = [(old, new) for old, new in zip(sources, targets) if old != new]
+    steps = core.order_renames(changes, existing=set(names))
+    assert simulate(names, steps) == expected(names, changes)
+    assert sorted(core.net_changes(steps)) == sorted(changes)
+
+
+def test_execute_plan_swaps_on_disk(make_folder, state):
+    folder = make_folder("a", "b", "c")
+    done = core.execute_plan(folder, [("a", "b"), ("b", "c"), ("c", "a")])
+    assert sorted(done) == [("a", "b"), ("b", "c"), ("c", "a")]
+    assert state(folder) == {"b": "a", "c": "b", "a": "c"}
+
+
+@pytest.mark.parametrize("error", [PermissionError(13, "denied"), ValueError("nombre imposible"), TypeError("boom")])
+def test_execute_plan_error_keeps_what_was_done(make_folder, state, monkeypatch, error):
+    # Sin diario también: cualquier error a mitad sale como RenameError con lo que sí se hizo.
+    folder = make_folder("a", "b", "c")
+    real = core.DirRenamer.rename
+
+    def rename(self, src, dst):
+        if src == "a":
+            raise error
+        return real(self, src, dst)
+    monkeypatch.setattr(core.DirRenamer, "rename", rename)
+    with pytest.raises(core.RenameError) as info:
+        core.execute_plan(folder, [("a", "b"), ("b", "c"), ("c", "d")])
+    assert info.value.error is error
+    assert sorted(info.value.done) == [("b", "c"), ("c", "d")]
+    assert state(folder) == {"a": "a", "c": "b", "d": "c"}
@@ -0,0 +1,124 @@
+import pytest
+
+import kambiosCore as core
+
+
+NAMES = [f"f{i:02d}" for i in range(30)]
+# Diez intercambios y diez sueltos: veinte grupos independientes.
+CHANGES = ([(NAMES[i], NAMES[i + 1]) for i in range(0, 20, 2)] + [(NAMES[i + 1], NAMES[i]) for i in range(0, 20, 2)]
+           + [(name, name.replace("f", "g")) for name in NAMES[20:]])
+
+
+def final_state():
+    files = {name: name for name in NAMES}
+    moved = {old: files.pop(old) for old, _ in CHANGES}
+    files.update((new, moved[old]) for old, new in CHANGES)
+    return files
+
+
+class Crash(BaseException):
+    pass
+
+
+def test_step_groups_split_independent_steps():
+    steps = [("a", "b"), ("c", "d"), ("b", "e"), ("x", "y")]
+    groups = sorted(core.step_groups(steps))
+    assert groups == [[0, 2], [1], [3]]
+
+
+def test_step_groups_keep_order_inside_a_group():
+    steps = core.order_renames([("a", "b"), ("b", "c"), ("c", "a"), ("p", "q")])
+    groups = core.step_groups(steps)
+    assert len(groups) == 2
+    for indices in groups:
+        assert indices == sorted(indices)
+
+
+def test_step_groups_ignore_case():
+    # En un recurso que no distingue mayúsculas, "B" y "b" son el mismo archivo.
+    assert len(core.step_groups([("a", "B"), ("b", "c")])) == 1
+
+
+def test_step_groups_merge_two_groups():
+    steps = [("a", "b"), ("c", "d"), ("b", "c")]
+    assert core.step_groups(steps) == [[0, 1, 2]]
+
+
+def test_parallel_apply_matches_serial(make_folder, state):
+    folder = make_folder(*NAMES)
+    before = state(folder)
+    core.apply_plan(folder, CHANGES, "test", workers=4)
+    assert state(folder) == final_state()
+    core.undo_operation(folder, workers=4)
+    assert state(folder) == before
+
+
+def test_failure_stops_only_its_group(make_folder, state, monkeypatch):
+    folder = make_folder(*NAMES)
+    real = core.DirRenamer.rename
+
+    def rename(self, src, dst):
+        if src == "f25":
+            raise PermissionError(13, "denied", src)
+        return real(self, src, dst)
+    monkeypatch.setattr(core.DirRenamer, "rename", rename)
+    with pytest.raises(core.RenameError) as info:
+        core.apply_plan(folder, CHANGES, "test", workers=4)
+    assert [src for src, _ in info.value.failures] == ["f25"]
+    assert len(info.value.done) == len(CHANGES) - 1
+    monkeypatch.undo()
+    core.undo_operation(folder)
+    assert state(folder) == {name: name for name in NAMES}
+
+
+def test_unexpected_error_in_a_worker_is_a_rename_error(make_folder, state, monkeypatch):
+    folder = make_folder(*NAMES)
+    real = core.DirRenamer.rename
+
+    def rename(self, src, dst):
+        if src == "f03":
+            raise TypeError("boom")
+        return real(self, src, dst)
+    monkeypatch.setattr(core.DirRenamer, "rename", rename)
+    with pytest.raises(core.RenameError) as info:
+        core.apply_plan(folder, CHANGES, "test", workers=4)
+    assert any(isinstance(error, TypeError) for _, error in info.value.failures)
+    assert core.read_journal(folder) is None
+    monkeypatch.undo()
+    if core.has_undo(folder):
+        core.undo_operation(folder)
+    assert state(folder) == {name: name for name in NAMES}
+
+
+@pytest.mark.parametrize("mode", ["rollback", "forward"])
+@pytest.mark.parametrize("failed", ["f02", "f11", "f27"])
+def test_recover_after_crash(make_folder, state, monkeypatch, failed, mode):
+    # Un grupo falla y el proceso muere antes de reescribir el diario: lo hecho no es un prefijo de lo apuntado.
+    folder = make_folder(*NAMES)
+    before = state(folder)
+    real = core.DirRenamer.rename
+
+    def rename(self, src, dst):
+        if src == failed:
+            raise OSError(5, "io error", src)
+        return real(self, src, dst)
+
+    def rewrite(self, steps):
+        raise Crash()
+    monkeypatch.setattr(core.DirRenamer, "rename", rename)
+    monkeypatch.setattr(core.RenameJournal, "rewrite", rewrite)
+    monkeypatch.setattr(core.RenameJournal, "abort", core.RenameJournal.close)
+    with pytest.raises(Crash):
+        core.apply_plan(folder, CHANGES, "test", workers=4)
+    monkeypatch.undo()
+
+    pending = core.read_journal(folder)
+    assert pending is not None and pending.completed is not None
+    core.recover_journal(folder, mode)
+    assert core.read_journal(folder) is None
+    if mode == "rollback":
+        assert state(folder) == before
+    else:
+        assert state(folder) == final_state()
+        core.undo_operation(folder)
+        assert state(folder) == before
@@ -0,0 +1,144 @@
+import os
+import random
+
+import pytest
+
+import kambiosCore as core
+import kambiosPlan as plans
+
+
+CHANGES = [("a", "b"), ("b", "c"), ("c", "d"), ("x", "y"), ("y", "x"), ("p", "q"), ("m", "n"), ("n", "o"), ("o", "m")]
+NAMES = ["a", "b", "c", "x", "y", "p", "m", "n", "o", "quieto"]
+
+
+def with_temps(folder):
+    # Como el fixture state, pero con los temporales: lo hecho puede dejar un archivo apartado en uno.
+    return {name: open(os.path.join(folder, name), encoding="utf-8").read() for name in os.listdir(folder)
+            if name not in core.INTERNAL_FILES and name != core.HISTORY_DIR}
+
+
+def expected(names, changes):
+    files = {name: name for name in names}
+    moved = {old: files.pop(old) for old, _ in changes}
+    files.update((new, moved[old]) for old, new in changes)
+    return files
+
+
+@pytest.mark.parametrize("budget", [None, 16])
+def test_plan_store_round_trip(budget):
+    # Con budget=16 el bloque pasa enseguida a un archivo temporal.
+    changes = [(f"viejo{i}", f"nuevo {i}.txt") for i in range(50)] + [("caf\udce9", "café")]
+    with plans.PlanStore(changes, budget=budget) as store:
+        assert (store._file is not None) == (budget is not None)
+        assert len(store) == len(changes)
+        assert list(store) == changes
+        assert store[-1] == ("caf\udce9", "café") and store[7] == changes[7]
+        store.append("otro", "más")  # Después de leer (mmap ya abierto) también se ve
+        assert store[-1] == ("otro", "más")
+        store.truncate(3)
+        assert list(store) == changes[:3]
+        store.append("y", "z")
+        assert list(store) == changes[:3] + [("y", "z")]
+    assert store._file is None
+
+
+def random_plan(seed, size=300):
+    rng = random.Random(seed)
+    names = [f"f{i}" for i in range(size)]
+    sources = rng.sample(names, size // 2)
+    targets = rng.sample(names + [f"g{i}" for i in range(size // 4)], size // 2)
+    targets[:5] = targets[5:10]  # Algún duplicado
+    return names, list(zip(sources, targets))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_spilled_check_finds_the_same_conflicts(seed):
+    names, changes = random_plan(seed)
+    results = []
+    for budget in (None, 10):
+        checker = plans.PlanChecker(budget=budget, with_folder=True)
+        for old, new in changes:
+            checker.add(old, new)
+        checker.add_existing(names)
+        assert checker.spilled == (budget is not None)
+        results.append(checker.finish())
+    in_memory, spilled = results
+    assert spilled.duplicates == in_memory.duplicates == sorted(core.find_duplicates(changes))
+    assert spilled.conflicts == sorted(in_memory.conflicts)
+    assert sorted(in_memory.conflicts) == sorted(set(core.find_conflicts(changes, set(names))))
+    # Un NameFilter puede decir que sí de más, pero nunca que no a un nombre que depende de otro.
+    assert isinstance(spilled.dependent, plans.NameFilter)
+    assert all(name in spilled.dependent for name in in_memory.dependent)
+
+
+def test_check_plan_matches_summarize_plan():
+    _, changes = random_plan(1)
+    assert plans.check_plan(changes, budget=10) == core.summarize_plan(changes)
+
+
+def test_name_filter_false_positives_are_rare():
+    names = [f"dentro{i}" for i in range(2000)]
+    bloom = plans.NameFilter(len(names))
+    bloom.update(names)
+    assert all(name in bloom for name in names)
+    positives = sum(f"fuera{i}" in bloom for i in range(2000))
+    assert positives < 200
+
+
+@pytest.mark.parametrize("budget", [plans.PLAN_MEMORY_BUDGET, 1])
+def test_apply_large_chains_and_cycles(make_folder, state, budget):
+    # Con budget=1 la revisión pasa a disco y las cadenas van por temporales (_parked_steps).
+    folder = make_folder(*NAMES)
+    before = state(folder)
+    with plans.apply_large(folder, lambda: iter(CHANGES), "test", budget=budget) as done:
+        assert sorted(done) == sorted(CHANGES)
+    assert state(folder) == expected(NAMES, CHANGES)
+    assert not any(name.startswith(core.TEMP_PREFIX) for name in os.listdir(folder))
+    core.undo_operation(folder)
+    assert state(folder) == before
+
+
+def test_apply_large_with_false_positives(make_folder, state, monkeypatch):
+    # En el peor caso el filtro dice que todo depende de algo: todo va por la parte lenta, pero bien.
+    monkeypatch.setattr(plans.NameFilter, "__contains__", lambda self, name: True)
+    folder = make_folder(*NAMES)
+    with plans.apply_large(folder, lambda: iter(CHANGES), "test", budget=1) as done:
+        assert sorted(done) == sorted(CHANGES)
+    assert state(folder) == expected(NAMES, CHANGES)
+
+
+@pytest.mark.parametrize("budget", [plans.PLAN_MEMORY_BUDGET, 1])
+@pytest.mark.parametrize("cut", [1, 6, 10])
+def test_apply_large_error_keeps_what_was_done(make_folder, state, monkeypatch, budget, cut):
+    folder = make_folder(*NAMES)
+    before = state(folder)
+    real = core.DirRenamer.rename
+    count = [0]
+
+    def rename(self, src, dst):
+        count[0] += 1
+        if count[0] == cut:
+            raise PermissionError(13, "denied", src)
+        return real(self, src, dst)
+    monkeypatch.setattr(core.DirRenamer, "rename", rename)
+    with pytest.raises(core.RenameError) as info:
+        with plans.apply_large(folder, lambda: iter(CHANGES), "test", budget=budget):
+            pass
+    monkeypatch.undo()
+    with info.value.done as done:
+        current = with_temps(folder)
+        for old, new in done:
+            assert current[new] == old
+    assert core.read_journal(folder) is None
+    if core.has_undo(folder):
+        core.undo_operation(folder)
+    assert state(folder) == before
+
+
+def test_apply_large_conflict_touches_nothing(make_folder, state):
+    folder = make_folder("a", "b", "c")
+    with pytest.raises(core.PlanConflictError) as info:
+        plans.apply_large(folder, lambda: iter([("a", "c"), ("zz", "y")]), "test")
+    assert sorted(info.value.conflicts) == [("c", "ya existe"), ("zz", "no existe")]
+    assert state(folder) == {"a": "a", "b": "b", "c": "c"}
+    assert core.read_journal(folder) is None
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+import kambiosCore as core
+
+
+@pytest.fixture(params=["renameat2", "fallback"])
+def renamer_mode(request, monkeypatch):
+    # Los mismos casos con renameat2 y con el plan B (comprobar y luego os.rename).
+    if request.param == "fallback":
+        monkeypatch.setattr(core, "_load_renameat2", lambda: None)
+    elif core._load_renameat2() is None:
+        pytest.skip("renameat2 no está disponible en este sistema")
+    return request.param
+
+
+def test_rename(make_folder, state, renamer_mode):
+    folder = make_folder("a")
+    with core.DirRenamer(folder) as renamer:
+        assert renamer.noreplace == (renamer_mode == "renameat2")
+        renamer.rename("a", "b")
+    assert state(folder) == {"b": "a"}
+
+
+def test_never_overwrites(make_folder, state, renamer_mode):
+    folder = make_folder("a", "b")
+    with core.DirRenamer(folder) as renamer:
+        with pytest.raises(FileExistsError):
+            renamer.rename("a", "b")
+    assert state(folder) == {"a": "a", "b": "b"}
+
+
+def test_missing_source(make_folder, renamer_mode):
+    folder = make_folder("a")
+    with core.DirRenamer(folder) as renamer:
+        with pytest.raises(FileNotFoundError):
+            renamer.rename("zz", "b")
+
+
+@pytest.mark.parametrize("src, dst", [("a", "b\0.txt"), ("a\0", "b"), ("a", "\0")])
+def test_nul_in_name_is_rejected(make_folder, state, renamer_mode, src, dst):
+    # Con ctypes, "b\0.txt" llegaría a libc como "b": nada de renombrar a un nombre cortado.
+    folder = make_folder("a")
+    with core.DirRenamer(folder) as renamer:
+        with pytest.raises(ValueError):
+            renamer.rename(src, dst)
+    assert state(folder) == {"a": "a"}
+
+
+def test_nul_name_is_a_rename_error(make_folder, state):
+    # En el motor, un nombre imposible no deja el diario a medias: sale como RenameError.
+    folder = make_folder("a", "b")
+    with core.RenameJournal(folder, "test") as journal:
+        with pytest.raises(core.RenameError):
+            core.run_steps(folder, [("b", "c"), ("a", "x\0")], journal)
+        assert journal.steps_done == 1
+        journal.commit(journal.steps_done)
+    core.undo_operation(folder)
+    assert state(folder) == {"a": "a", "b": "b"}
+
+
+@pytest.mark.parametrize("name", ["", ".", "..", "../fuera", "sub/x", "x\0"])
+def test_plan_rejects_names_that_are_not_files(make_folder, state, name):
+    folder = make_folder("a")
+    os.mkdir(os.path.join(folder, "sub"))
+    with pytest.raises(core.PlanConflictError) as info:
+        core.apply_plan(folder, [("a", name)], "test")
+    assert info.value.conflicts == [(name, "nombre no válido")]
+    assert state(folder) == {"a": "a"}
+    assert core.read_journal(folder) is None
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+import kambiosRules as rules
+
+
+def lit(find, value=""):
+    return {"type": "lit", "find": find, "with": value}
+
+
+def test_aho_corasick_finds_overlapping_matches():
+    automaton = rules.AhoCorasick(["he", "she", "his", "hers"])
+    found = sorted((start, end, automaton.patterns[index]) for start, end, index in automaton.finditer("ushers"))
+    assert found == [(1, 4, "she"), (2, 4, "he"), (2, 6, "hers")]
+
+
+@pytest.mark.parametrize("patterns, text, expected", [
+    (["he", "she", "hers"], "ushers", "u[she]rs"),           # Gana la que empieza antes
+    (["ab", "abcd", "bc"], "abcde", "[abcd]e"),              # En la misma posición, la más larga
+    (["aa"], "aaaaa", "[aa][aa]a"),                          # Sin solaparse, de izquierda a derecha
+    (["(USA)", "(Europe)", " "], "Juego (USA) (Europe)", "Juego[ ][(USA)][ ][(Europe)]"),
+    (["x", "y"], "nada", "nada"),
+])
+def test_aho_corasick_replace_is_leftmost_longest(patterns, text, expected):
+    automaton = rules.AhoCorasick(patterns)
+    assert automaton.replace(text, [f"[{p}]" for p in patterns]) == expected
+
+
+def test_replacements_are_not_matched_again():
+    pipeline = rules.Pipeline([lit("a", "b"), lit("b", "c")])
+    assert pipeline("ab") == "bc"
+
+
+def test_rules_run_in_order():
+    text = "lit _ => \" \"\nre \\(Rev (\\d+)\\) => v\\1\ncase title\nlit V => v\nsqueeze\n"
+    pipeline = rules.Pipeline(rules.parse_rules(text))
+    assert pipeline("  mi_juego  (Rev 2)") == "Mi Juego v2"
+    # Al revés ya no es lo mismo: "case title" después pone la V en mayúscula.
+    pipeline = rules.Pipeline(rules.parse_rules("re \\(Rev (\\d+)\\) => v\\1\ncase upper"))
+    assert pipeline("juego (Rev 2)") == "JUEGO V2"
+
+
+def test_same_literal_twice_the_first_wins():
+    assert rules.Pipeline([lit("a", "1"), lit("a", "2"), lit("b", "3")])("ab") == "13"
+
+
+def test_pipeline_plan_keeps_the_extension_and_skips_empty_names():
+    changes = rules.pipeline_plan(["Juego (USA).zip", "(USA).zip", "otro.zip"], [lit(" (USA)"), lit("(USA)")])
+    assert changes == [("Juego (USA).zip", "Juego.zip")]
+
+
+def test_rules_round_trip_through_text():
+    parsed = rules.parse_rules('lit "  " => " "\nrei \\[!\\] =>\ncase lower\nsqueeze\n# nada')
+    assert rules.parse_rules(rules.format_rules(parsed)) == parsed
+
+
+@pytest.mark.parametrize("rule, message", [
+    ({"type": "lit", "with": "x"}, "Regla 2: no hay nada que buscar"),
+    ({"type": "lit", "find": "", "with": "x"}, "Regla 2: no hay nada que buscar"),
+    ({"type": "re", "find": "a"}, "Regla 2: falta el texto que poner ('with')"),
+    ({"type": "case", "mode": "camel"}, "Regla 2: 'case' necesita lower, upper, title"),
+    ({"type": "borrar"}, "Regla 2: regla desconocida 'borrar' (válidas: lit, re, case, squeeze)"),
+    ("lit a => b", 'Regla 2: se esperaba un objeto, no "lit a => b"'),
+    ({"type": "re", "find": "(", "with": ""}, "Regla 2: regex no válida"),
+])
+def test_json_rules_are_checked(tmp_path, rule, message):
+    path = tmp_path / "reglas.json"
+    path.write_text(json.dumps({"rules": [lit("x"), rule]}), encoding="utf-8")
+    with pytest.raises(rules.RuleError) as info:
+        rules.load_rules_file(str(path))
+    assert str(info.value).startswith(message)
+
+
+def test_text_rule_errors_give_the_line(tmp_path):
+    path = tmp_path / "reglas.txt"
+    path.write_text("# limpiar\nlit a => b\nlit  => b\n", encoding="utf-8")
+    with pytest.raises(rules.RuleError) as info:
+        rules.load_rules_file(str(path))
+    assert info.value.line == 3
+
+
+def test_presets_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path))
+    chain = rules.parse_rules("lit (USA) =>\nsqueeze")
+    rules.save_preset("limpiar", chain)
+    assert rules.list_presets() == ["limpiar"]
+    assert rules.load_preset("limpiar") == chain
+    with pytest.raises(rules.RuleError):
+        rules.save_preset("malo", [{"type": "lit", "with": ""}])
+    with pytest.raises(rules.RuleError):
+        rules.load_preset("../fuera")
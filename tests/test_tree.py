@@ -0,0 +1,181 @@
+import os
+import threading
+
+import pytest
+
+import kambiosCore as core
+import kambiosTree as tree
+
+
+LAYOUT = {"": ["a", "b"], "uno": ["a", "c"], "uno/dos": ["a"], "tres": ["x"]}
+
+
+class Crash(BaseException):
+    pass
+
+
+@pytest.fixture
+def make_tree(tmp_path):
+    # make_tree({ruta: [nombres]}) crea el árbol; cada archivo lleva dentro su ruta relativa.
+    def make(layout=LAYOUT):
+        for reldir, names in layout.items():
+            folder = tmp_path / reldir
+            folder.mkdir(parents=True, exist_ok=True)
+            for name in names:
+                (folder / name).write_text(os.path.join(reldir, name), encoding="utf-8")
+        return str(tmp_path)
+    return make
+
+
+def tree_state(root):
+    # {ruta_relativa: contenido} de todo el árbol, sin los archivos de Kambios.
+    files = {}
+    for folder, dirs, names in os.walk(root):
+        dirs[:] = [d for d in dirs if d != core.HISTORY_DIR]
+        for name in names:
+            if not name.startswith(".kambios"):
+                path = os.path.join(folder, name)
+                files[os.path.relpath(path, root)] = open(path, encoding="utf-8").read()
+    return files
+
+
+def suffix_plan(root):
+    # Un plan por carpeta: a cada archivo se le añade "_n".
+    return tree.tree_plan(tree.walk_tree(root), lambda snapshot: [(name, name + "_n") for name in snapshot.names])
+
+
+def test_walk_lists_every_folder_in_order(make_tree):
+    root = make_tree()
+    walked = tree.walk_tree(root, workers=4)
+    assert [reldir for reldir, _ in walked] == ["", "tres", "uno", os.path.join("uno", "dos")]
+    assert sorted(dict(walked.folders)["uno"].names) == ["a", "c"]
+    assert len(walked) == 6
+    assert walked.errors == []
+
+
+def test_walk_depth_exclude_and_glob(make_tree):
+    root = make_tree()
+    assert [reldir for reldir, _ in tree.walk_tree(root, max_depth=0)] == [""]
+    assert [reldir for reldir, _ in tree.walk_tree(root, exclude=["uno"])] == ["", "tres"]
+    assert {reldir: sorted(s.names) for reldir, s in tree.walk_tree(root, include="a")} == \
+        {"": ["a"], "tres": [], "uno": ["a"], os.path.join("uno", "dos"): ["a"]}
+
+
+def test_walk_skips_folders_it_cannot_read(make_tree, monkeypatch):
+    root = make_tree()
+    real = tree._scan_one
+
+    def scan(root, reldir, *args):
+        if reldir == "tres":
+            raise PermissionError(13, "Permission denied", os.path.join(root, reldir))
+        return real(root, reldir, *args)
+    monkeypatch.setattr(tree, "_scan_one", scan)
+    walked = tree.walk_tree(root)
+    assert [reldir for reldir, _ in walked] == ["", "uno", os.path.join("uno", "dos")]
+    assert [path for path, _ in walked.errors] == [os.path.join(root, "tres")]
+
+
+def test_same_name_in_two_folders_is_not_a_duplicate(make_tree):
+    root = make_tree()
+    plan = tree.tree_plan(tree.walk_tree(root), lambda snapshot: [(name, "mismo") for name in snapshot.names[:1]])
+    assert plan.problems() == ([], [])
+    plan = tree.tree_plan(tree.walk_tree(root), lambda snapshot: [(name, "mismo") for name in snapshot.names])
+    duplicates, _ = plan.problems()
+    assert sorted(duplicates) == ["mismo", os.path.join("uno", "mismo")]
+
+
+def test_apply_and_undo_the_whole_tree(make_tree):
+    root = make_tree()
+    before = tree_state(root)
+    result = tree.apply_tree(suffix_plan(root), "test", workers=4)
+    assert result.count == 6 and not result.errors
+    assert tree_state(root) == {path + "_n": content for path, content in before.items()}
+    entry, = tree.list_tree_history(root)
+    assert entry.id == result.tree_id and entry.complete and entry.count == 6
+    assert tree.validate_tree_undo(root, entry) == []
+    undone = tree.undo_tree(root)
+    assert undone.count == 6
+    assert tree_state(root) == before
+    assert not tree.has_tree_undo(root)
+
+
+def test_a_failing_folder_does_not_stop_the_others(make_tree):
+    root = make_tree()
+    before = tree_state(root)
+    plan = suffix_plan(root)
+    open(os.path.join(root, "uno", "c_n"), "w").close()  # Aparece después de planear: choca al aplicar
+    result = tree.apply_tree(plan, "test")
+    assert [reldir for reldir, _ in result.errors] == ["uno"]
+    assert isinstance(result.errors[0][1], core.PlanConflictError)
+    assert result.count == 4
+    os.remove(os.path.join(root, "uno", "c_n"))
+    tree.undo_tree(root)
+    assert tree_state(root) == before
+
+
+def test_undo_is_validated_before_touching_any_folder(make_tree):
+    root = make_tree()
+    tree.apply_tree(suffix_plan(root), "test")
+    os.remove(os.path.join(root, "uno", "dos", "a_n"))
+    after = tree_state(root)
+    with pytest.raises(core.PlanConflictError) as info:
+        tree.undo_tree(root)
+    assert info.value.conflicts == [(os.path.join("uno", "dos", "a_n"), "no existe")]
+    assert tree_state(root) == after
+    result = tree.undo_tree(root, skip_missing=True)
+    assert not result.errors
+    assert "uno/dos/a_n" not in tree_state(root) and tree_state(root)["uno/a"] == "uno/a"
+
+
+def test_cancel_keeps_what_was_done_in_the_result(make_tree):
+    root = make_tree()
+    before = tree_state(root)
+    cancel = threading.Event()
+    with pytest.raises(core.Cancelled) as info:
+        tree.apply_tree(suffix_plan(root), "test", workers=1, progress=lambda done, total: cancel.set(),
+                        cancel=cancel)
+    result = info.value.result
+    assert 0 < result.count < 6
+    assert tree.list_tree_history(root)[0].count == result.count
+    tree.undo_tree(root)
+    assert tree_state(root) == before
+
+
+def test_cancelled_from_a_single_folder_has_no_tree_result():
+    assert core.Cancelled().result is None
+
+
+@pytest.mark.parametrize("mode", ["rollback", "forward"])
+def test_recover_a_tree_cut_halfway(make_tree, monkeypatch, mode):
+    root = make_tree()
+    before = tree_state(root)
+    plan = suffix_plan(root)
+    # El proceso "muere" en medio de la carpeta uno: su diario se queda y su línea del índice no llega.
+    monkeypatch.setattr(core.RenameJournal, "abort", core.RenameJournal.close)
+    real = core.DirRenamer.rename
+
+    def rename(self, src, dst):
+        if self.folder.endswith("uno") and src == "c":
+            raise Crash()
+        return real(self, src, dst)
+    monkeypatch.setattr(core.DirRenamer, "rename", rename)
+    with pytest.raises(Crash):
+        tree.apply_tree(plan, "test", workers=1)
+    monkeypatch.undo()
+
+    entry, = tree.list_tree_history(root)
+    assert not entry.complete and entry.pending == ["uno"]
+    assert tree.validate_tree_undo(root, entry)[0][0] == "."
+    result = tree.recover_tree(root, mode)
+    assert not result.errors
+    assert core.read_journal(os.path.join(root, "uno")) is None
+    entry, = tree.list_tree_history(root)
+    assert entry.complete
+    if mode == "rollback":
+        assert tree_state(root)["uno/a"] == "uno/a"
+        assert entry.count == 4
+    else:
+        assert tree_state(root)["uno/c_n"] == "uno/c"
+        assert entry.count == 6
+    tree.undo_tree(root)
+    assert tree_state(root) == before
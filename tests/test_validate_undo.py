@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+import kambiosCore as core
+
+
+def test_clean_undo_has_no_problems(make_folder):
+    folder = make_folder("a", "b", "c")
+    core.apply_plan(folder, [("a", "b"), ("b", "c"), ("c", "a")], "test")
+    assert core.validate_undo(folder) == []
+
+
+def test_missing_file(make_folder):
+    folder = make_folder("a", "b")
+    core.apply_plan(folder, [("a", "x"), ("b", "y")], "test")
+    os.remove(os.path.join(folder, "x"))
+    assert core.validate_undo(folder) == [("x", "no existe")]
+
+
+def test_original_name_taken(make_folder):
+    folder = make_folder("a", "b")
+    core.apply_plan(folder, [("a", "x")], "test")
+    open(os.path.join(folder, "a"), "w").close()
+    assert core.validate_undo(folder) == [("a", "ya existe")]
+
+
+def test_chain_frees_its_own_names(make_folder):
+    # Deshacer a->b, b->c pasa por nombres que la foto ve ocupados: la simulación sabe que se liberan antes.
+    folder = make_folder("a", "b")
+    core.apply_plan(folder, [("a", "b"), ("b", "c")], "test")
+    assert core.validate_undo(folder) == []
+
+
+def test_all_problems_at_once(make_folder):
+    folder = make_folder("a", "b", "c")
+    core.apply_plan(folder, [("a", "x"), ("b", "y"), ("c", "z")], "test")
+    os.remove(os.path.join(folder, "x"))
+    os.remove(os.path.join(folder, "z"))
+    open(os.path.join(folder, "b"), "w").close()
+    assert sorted(core.validate_undo(folder)) == [("b", "ya existe"), ("x", "no existe"), ("z", "no existe")]
+
+
+def test_conflict_leaves_folder_untouched(make_folder, state):
+    folder = make_folder("a", "b")
+    core.apply_plan(folder, [("a", "x"), ("b", "y")], "test")
+    open(os.path.join(folder, "a"), "w").close()
+    before = state(folder)
+    with pytest.raises(core.PlanConflictError) as info:
+        core.undo_operation(folder)
+    assert info.value.conflicts == [("a", "ya existe")]
+    assert state(folder) == before
+    assert len(core.list_history(folder)) == 1
+
+
+def test_skip_missing_undoes_the_rest(make_folder, state):
+    folder = make_folder("a", "b")
+    core.apply_plan(folder, [("a", "x"), ("b", "y")], "test")
+    os.remove(os.path.join(folder, "x"))
+    with pytest.raises(core.PlanConflictError):
+        core.undo_operation(folder)
+    core.undo_operation(folder, skip_missing=True)
+    assert state(folder) == {"b": "b"}
+    assert not core.has_undo(folder)
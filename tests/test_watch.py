@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+import kambiosCore as core
+import kambiosWatch as watch
+
+pytestmark = pytest.mark.skipif(not watch.inotify_available(), reason="inotify no está disponible en este sistema")
+
+
+def strip_raw(names):
+    return core.part_replace_plan(names, "raw_", "")
+
+
+@pytest.fixture
+def watcher(tmp_path):
+    # Un vigilante de la carpeta; los lotes se apuntan en watcher.batches como (hechos, problemas).
+    made = []
+
+    def make(plan=strip_raw, **kwargs):
+        batches = []
+        w = watch.IngestWatcher(str(tmp_path), plan, settle=0.0,
+                                on_batch=lambda done, problems: batches.append((done, problems)), **kwargs)
+        w.batches = batches
+        w.start()
+        made.append(w)
+        return w
+    yield make
+    for w in made:
+        w.stop()
+
+
+def arrive(folder, *names):
+    for name in names:
+        with open(os.path.join(folder, name), "w", encoding="utf-8") as f:
+            f.write(name)
+
+
+def settle(w):
+    # Los eventos de inotify ya están en la cola al cerrar el archivo; con settle=0 todo lo cerrado está listo.
+    w.handle_events()
+    return w.apply_ready(w.ready())
+
+
+def test_new_files_are_renamed_in_one_batch(tmp_path, state, watcher):
+    folder = str(tmp_path)
+    arrive(folder, "raw_old.txt")
+    w = watcher()
+    arrive(folder, "raw_a.txt", "raw_b.txt")
+    assert settle(w) == 2
+    assert state(folder) == {"raw_old.txt": "raw_old.txt", "a.txt": "raw_a.txt", "b.txt": "raw_b.txt"}
+    assert len(core.list_history(folder)) == 1
+    # Los eventos de nuestros propios renombres no son archivos nuevos.
+    assert settle(w) == 0
+    core.undo_operation(folder)
+    assert "raw_a.txt" in state(folder)
+
+
+def test_hidden_and_partial_files_are_left_alone(tmp_path, state, watcher):
+    folder = str(tmp_path)
+    w = watcher()
+    arrive(folder, ".raw_oculto", "raw_peli.mkv.part", "raw_x.crdownload")
+    assert settle(w) == 0
+    os.rename(os.path.join(folder, "raw_peli.mkv.part"), os.path.join(folder, "raw_peli.mkv"))
+    assert settle(w) == 1
+    assert "peli.mkv" in state(folder)
+
+
+def test_batches_are_separate_operations(tmp_path, watcher):
+    folder = str(tmp_path)
+    w = watcher(batch_size=2)
+    arrive(folder, *(f"raw_{i}.txt" for i in range(5)))
+    assert settle(w) == 5
+    assert [len(done) for done, _ in w.batches] == [2, 2, 1]
+    assert len(core.list_history(folder)) == 3
+
+
+def test_conflict_leaves_the_file_as_it_is(tmp_path, state, watcher):
+    folder = str(tmp_path)
+    arrive(folder, "a.txt")
+    w = watcher()
+    arrive(folder, "raw_a.txt", "raw_b.txt")
+    assert settle(w) == 1
+    assert state(folder) == {"a.txt": "a.txt", "raw_a.txt": "raw_a.txt", "b.txt": "raw_b.txt"}
+    (done, problems), = w.batches
+    assert problems == [("a.txt", "ya existe")]
+
+
+def test_error_without_a_file_name_is_reported(tmp_path, state, watcher, monkeypatch):
+    # Un error que no es de un archivo concreto (sin .filename) también sale en los problemas del lote.
+    folder = str(tmp_path)
+    w = watcher()
+    error = TypeError("boom")
+
+    def apply_plan(*args, **kwargs):
+        raise core.RenameError(error, [])
+    monkeypatch.setattr(core, "apply_plan", apply_plan)
+    arrive(folder, "raw_a.txt")
+    assert settle(w) == 0
+    assert w.batches == [([], [("?", error)])]
+    assert state(folder) == {"raw_a.txt": "raw_a.txt"}